@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""
+asyncio engine for the chat server (SERVER_MODE=asyncio)
+Runs the same REGISTER/LOGIN/command flows as ChatServer (ChatCore in
+server.py), but keeps every connection on one event loop instead of one OS
+thread per client.
+"""
+
+import asyncio
+import contextlib
+import os
+import signal
+import socket
+import time
+from collections import deque
+
+import redis.asyncio as aioredis
+
+import metrics
+import sharding
+import wire
+from server import (
+    HOST, PORT, REDIS_NODES, REDIS_PUBSUB_NODE, USE_TLS, TLS_HANDSHAKE_TIMEOUT,
+    REUSE_PORT, OUTBOUND_QUEUE_SIZE, SLOW_CONSUMER_POLICY, CLOSE_FLUSH_TIMEOUT, SHUTDOWN_TIMEOUT,
+    PUBLISH_WINDOW_MS, PUBLISH_BATCH_SIZE, PUBLISH_MAX_PENDING, ROOM_HISTORY_MAXLEN,
+    IDLE_TIMEOUT, SESSION_TTL, RECONCILE_INTERVAL, MAX_LINE_LENGTH,
+    WELCOME_TEXT, LINE_TOO_LONG_TEXT, ChatCore, Connection, LineTooLong,
+    create_server_context, take_batch, server_channel,
+)
+
+LISTEN_BACKLOG = int(os.getenv('LISTEN_BACKLOG', 4096))
+
+
+class AsyncOutboundQueue:
+    """Bounded outbound queue for one connection, drained by its own writer task"""
+
+    def __init__(self, writer, max_size=OUTBOUND_QUEUE_SIZE, policy=SLOW_CONSUMER_POLICY):
+        self.writer = writer
+        self.max_size = max_size
+        self.policy = policy
+        self.queue = deque()
+        self.ready = asyncio.Event()  # set when there is data or we are closing
+        self.space = asyncio.Event()  # set when a blocked reply may proceed
+        self.space.set()
+        self.closing = False
+        self.dropped = 0
+        self.close_handle = None
+        self.task = asyncio.create_task(self._run())
+
+    def send(self, data):
+        """Queue bytes without waiting; on overflow drop the oldest or disconnect"""
+        if self.closing:
+            return False
+        if len(self.queue) >= self.max_size:
+            if self.policy == 'disconnect':
+                print(f"[Slow Consumer] Disconnecting peer with {len(self.queue)} queued messages")
+                metrics.SLOW_CONSUMER_DISCONNECTS.inc()
+                self.abort()
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+            metrics.OUTBOUND_DROPPED.inc()
+        self.queue.append(data)
+        self.ready.set()
+        return True
+
+    async def reply(self, data):
+        """Queue a response to the client's own command, waiting for room"""
+        while len(self.queue) >= self.max_size and not self.closing:
+            self.space.clear()
+            await self.space.wait()
+        return self.send(data)
+
+    def close(self, timeout=CLOSE_FLUSH_TIMEOUT):
+        """Flush what is already queued, then close the connection"""
+        if self.closing:
+            return
+        self.closing = True
+        self.ready.set()
+        self.space.set()
+        # A stalled peer must not hold the connection open forever
+        self.close_handle = asyncio.get_running_loop().call_later(timeout, self.abort)
+
+    def abort(self):
+        """Discard anything queued and drop the connection now"""
+        self.closing = True
+        self.queue.clear()
+        self.ready.set()
+        self.space.set()
+        self.writer.transport.abort()
+
+    async def _run(self):
+        try:
+            while True:
+                while not self.queue and not self.closing:
+                    self.ready.clear()
+                    await self.ready.wait()
+                if not self.queue:
+                    break
+                # Everything queued goes out in one write, as in OutboundQueue
+                data = take_batch(self.queue)
+                self.space.set()
+                self.writer.write(data)
+                await self.writer.drain()
+        except Exception:
+            self.abort()
+        finally:
+            if self.close_handle:
+                self.close_handle.cancel()
+            self.writer.close()
+
+
+class AsyncPublishBatcher:
+    """Coalesces publishes from every connection task into pipelined batches"""
+
+    def __init__(self, redis_client, window=PUBLISH_WINDOW_MS / 1000,
+                 batch_size=PUBLISH_BATCH_SIZE, max_pending=PUBLISH_MAX_PENDING):
+        self.redis_client = redis_client
+        self.window = window
+        self.batch_size = max(1, batch_size)
+        self.max_pending = max(self.batch_size, max_pending)
+        self.pending = deque()  # (enqueue time, channel, payload, history)
+        # Created by run(): the server is built before asyncio.run() starts
+        # its loop, and on Python 3.9 an Event binds to the loop current
+        # when it is created
+        self.ready = None  # set when a window starts or a batch fills
+        self.space = None  # set when waiting publishers may proceed
+
+    async def publish(self, channel, payload, history=None):
+        """
+        Queue a publish for run(), which must have started; waits only when
+        max_pending publishes are queued. `history` is an optional (stream
+        key, fields) entry appended first.
+        """
+        if self.window <= 0:
+            await self._flush([(None, channel, payload, history)])
+            return
+        while len(self.pending) >= self.max_pending:
+            self.space.clear()
+            await self.space.wait()
+        self.pending.append((time.monotonic(), channel, payload, history))
+        if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+            self.ready.set()
+
+    async def run(self):
+        """Flush batches until cancelled, then flush what is left"""
+        if self.window <= 0:
+            return
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.pending:
+                    # The window runs from the oldest queued message
+                    remaining = self.pending[0][0] + self.window - time.monotonic()
+                    if len(self.pending) < self.batch_size and remaining > 0:
+                        try:
+                            await asyncio.wait_for(self.ready.wait(), remaining)
+                        except asyncio.TimeoutError:
+                            pass
+                        self.ready.clear()
+                        continue
+                    await self._flush_batch()
+        finally:
+            while self.pending:
+                await self._flush_batch()
+
+    async def _flush_batch(self):
+        count = min(len(self.pending), self.batch_size)
+        batch = [self.pending.popleft() for _ in range(count)]
+        self.space.set()
+        await self._flush(batch)
+
+    async def _flush(self, batch):
+        metrics.PUBLISH_BATCH_SIZE.observe(len(batch))
+        try:
+            payloads = await self._append_history(batch)
+            pipe = self.redis_client.pipeline(transaction=False)
+            for (_, channel, _, _), payload in zip(batch, payloads):
+                pipe.publish(channel, payload)
+            with metrics.REDIS_SECONDS.labels('PIPELINE').time():
+                await pipe.execute()
+        except Exception as e:
+            print(f"[Redis Pub Error] Dropped {len(batch)} messages: {e}")
+
+    async def _append_history(self, batch):
+        """XADD the batch's history entries in one pipeline; returns payloads with ids"""
+        payloads = [payload for _, _, payload, _ in batch]
+        appends = [(i, history) for i, (_, _, _, history) in enumerate(batch) if history]
+        if appends:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for _, (key, fields) in appends:
+                pipe.xadd(key, fields, maxlen=ROOM_HISTORY_MAXLEN, approximate=True)
+            with metrics.REDIS_SECONDS.labels('PIPELINE').time():
+                entry_ids = await pipe.execute()
+            for (i, _), entry_id in zip(appends, entry_ids):
+                payloads[i] = wire.attach_id(payloads[i], entry_id)
+        return payloads
+
+
+async def read_lines(reader):
+    """Yield stripped, non-empty newline-framed lines until the peer closes"""
+    while True:
+        try:
+            raw = await reader.readline()
+        except ValueError:
+            # StreamReader limit (MAX_LINE_LENGTH) exceeded
+            raise LineTooLong()
+        if not raw.endswith(b'\n'):
+            return
+        line = raw.decode(errors='replace').strip()
+        if line:
+            yield line
+
+
+class InstrumentedAsyncRedis(aioredis.Redis):
+    """asyncio Redis client that records the round-trip time of every command"""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            metrics.REDIS_SECONDS.labels(str(args[0]).upper()).observe(time.perf_counter() - start)
+
+
+class AsyncChatServer(ChatCore):
+    """asyncio engine: runs ChatCore's flows on one event loop, awaiting each call they yield"""
+
+    def __init__(self):
+        # Redis connections: one pool per shard, keys routed by user or room
+        self.redis_client = sharding.AsyncShardedRedis(
+            REDIS_NODES,
+            pubsub_node=REDIS_PUBSUB_NODE,
+            client_class=InstrumentedAsyncRedis,
+            decode_responses=True
+        )
+        # Pub/Sub payloads are binary (see wire.py), so this connection
+        # does not decode responses
+        self.redis_pubsub = aioredis.Redis(
+            host=REDIS_PUBSUB_NODE[0],
+            port=REDIS_PUBSUB_NODE[1]
+        ).pubsub()
+        # The event loop is single-threaded, so local state needs no lock
+        self.clients_lock = contextlib.nullcontext()
+        self._init_state()
+
+        # Subscribe and unsubscribe calls are applied in order by a single task
+        self.channel_ops = None  # asyncio.Queue of (subscribe, channel), created by serve()
+        self.handler_tasks = set()  # awaited at shutdown, before Redis is closed
+        self.publisher = AsyncPublishBatcher(self.redis_client)
+
+        print(f"[Server {self.server_id}] Initialized (asyncio)")
+        print(f"[Server {self.server_id}] Redis nodes: {', '.join(self.redis_client.node_names)}"
+              f" (Pub/Sub on {sharding.node_name(REDIS_PUBSUB_NODE)})")
+
+    async def _run(self, steps):
+        """Run a ChatCore flow, awaiting each call it yields; errors are raised inside the flow"""
+        result, error = None, None
+        while True:
+            try:
+                call = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            try:
+                result, error = await call, None
+            except Exception as e:
+                result, error = None, e
+
+    async def _reply(self, conn, data):
+        """Send a response to a client's own command, waiting for queue space"""
+        if not await conn.outbound.reply(data):
+            raise ConnectionError("connection closed")
+
+    def _wait(self, future):
+        return asyncio.wrap_future(future)
+
+    def _sleep(self, seconds):
+        return asyncio.sleep(seconds)
+
+    def _queue_channel_op(self, subscribe, channel):
+        self.channel_ops.put_nowait((subscribe, channel))
+
+    async def _redis_subscriber(self):
+        """Listen for messages from Redis pub/sub, catching up after a reconnect"""
+        lost_at = None
+        while self.running:
+            try:
+                if lost_at is not None:
+                    # PING reconnects, and redis-py resubscribes every channel
+                    await self.redis_pubsub.ping()
+                    await self._run(self._catch_up_rooms(lost_at))
+                    print(f"[Server {self.server_id}] Pub/Sub reconnected")
+                    lost_at = None
+                message = await self.redis_pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception as e:
+                if lost_at is None:
+                    lost_at = wire.now_ms()
+                    print(f"[Redis Sub Error] Connection lost: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message['type'] != 'message':
+                continue
+            try:
+                data = wire.decode(message['data'])
+                metrics.RECEIVED.labels(data.get('type')).inc()
+                await self._run(self._local_broadcast(data))
+            except Exception as e:
+                print(f"[Redis Sub Error] {e}")
+
+    async def _channel_worker(self):
+        """Apply queued subscribe/unsubscribe calls in order"""
+        while True:
+            subscribe, channel = await self.channel_ops.get()
+            try:
+                if subscribe:
+                    await self.redis_pubsub.subscribe(channel)
+                else:
+                    await self.redis_pubsub.unsubscribe(channel)
+            except Exception as e:
+                print(f"[Redis Sub Error] {channel}: {e}")
+
+    async def handle_client(self, reader, writer):
+        """Handle individual client connection"""
+        client_address = writer.get_extra_info('peername')
+        print(f"[Connection] New connection from {client_address}")
+
+        handler_task = asyncio.current_task()
+        self.handler_tasks.add(handler_task)
+        conn = Connection(writer, AsyncOutboundQueue(writer))
+        self.connections[writer] = conn
+
+        try:
+            await self._reply(conn, WELCOME_TEXT.encode())
+
+            lines = read_lines(reader)
+
+            # Authentication phase
+            authenticated = False
+            async for data in lines:
+                authenticated = await self._run(self._handle_login_line(conn, data))
+                if authenticated:
+                    break
+
+            if not authenticated:
+                return
+
+            # Main message loop
+            async for data in lines:
+                if not self.running or await self._run(self._handle_line(conn, data)):
+                    break
+
+        except LineTooLong:
+            try:
+                await self._reply(conn, LINE_TOO_LONG_TEXT.encode())
+            except Exception:
+                pass
+
+        except Exception as e:
+            print(f"[Error] Client {conn.username or client_address}: {e}")
+
+        finally:
+            if conn.username:
+                await self._run(self._end_session(conn))
+            self._close_connection(conn)
+            self.connections.pop(writer, None)
+            self.handler_tasks.discard(handler_task)
+
+    def _raise_fd_limit(self):
+        """Allow as many open sockets as the hard limit permits"""
+        try:
+            import resource
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+                print(f"[Server] Raised open file limit {soft} -> {hard}")
+        except (ImportError, ValueError, OSError):
+            pass
+
+    def _listen(self):
+        """Listening socket, bound as ChatServer.start() binds it"""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if REUSE_PORT:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind((HOST, PORT))
+        listener.listen(LISTEN_BACKLOG)
+        listener.setblocking(False)
+        return listener
+
+    async def _accept(self, listener, context):
+        """
+        Accept connections until cancelled. asyncio.start_server would run
+        the TLS handshake before any code of ours, so connections are
+        accepted here and the limiter refuses them before the handshake.
+        """
+        loop = asyncio.get_running_loop()
+        handshakes = set()
+        while True:
+            try:
+                sock, client_address = await loop.sock_accept(listener)
+            except OSError as e:
+                print(f"[Error] Accept failed: {e}")
+                await asyncio.sleep(0.1)  # e.g. out of file descriptors
+                continue
+            if not self.connect_limiter.allow():
+                metrics.RATE_LIMITED.labels('connect').inc()
+                sock.close()
+                continue
+            task = asyncio.create_task(self._open_connection(sock, client_address, context))
+            handshakes.add(task)
+            task.add_done_callback(handshakes.discard)
+
+    async def _open_connection(self, sock, client_address, context):
+        """Run the TLS handshake (if any) with a deadline, then hand the streams to handle_client"""
+        reader = asyncio.StreamReader(limit=MAX_LINE_LENGTH)
+        try:
+            await asyncio.get_running_loop().connect_accepted_socket(
+                lambda: asyncio.StreamReaderProtocol(reader, self.handle_client), sock,
+                ssl=context, ssl_handshake_timeout=TLS_HANDSHAKE_TIMEOUT if context else None
+            )
+        except Exception as e:
+            print(f"[TLS] Handshake with {client_address} failed: {e}")
+            sock.close()
+
+    async def serve(self):
+        """Run the server until cancelled"""
+        context = None
+        if USE_TLS:
+            context = create_server_context()
+            if context is None:
+                return
+            print(f"[Server] TLS enabled")
+
+        self._raise_fd_limit()
+        try:
+            # SIGTERM cancels serve(), so the cleanup below still runs
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except NotImplementedError:
+            pass
+        self.hash_pool.calibrate()
+        metrics.start_http_server()
+
+        self.channel_ops = asyncio.Queue()
+        await self._run(self._ensure_room_registry())
+        await self._run(self._ensure_subscription_index())
+        await self.redis_pubsub.subscribe(server_channel(self.server_id))
+        tasks = [
+            asyncio.create_task(self._redis_subscriber()),
+            asyncio.create_task(self._channel_worker()),
+            # The room sweep runs apart so it cannot delay session refreshes
+            asyncio.create_task(self._run(self._housekeeping(
+                [(IDLE_TIMEOUT / 4, self._reap_idle), (SESSION_TTL / 3, self._refresh_sessions)]))),
+            asyncio.create_task(self._run(self._housekeeping([(RECONCILE_INTERVAL, self._reconcile_rooms)]))),
+        ]
+        publisher_task = asyncio.create_task(self.publisher.run())
+
+        listener = self._listen()
+        print(f"[Server] Listening on {HOST}:{PORT}")
+        print(f"[Server] ID: {self.server_id}")
+
+        try:
+            await self._accept(listener, context)
+        finally:
+            self.running = False
+            listener.close()
+            # Sessions are removed by their handlers, so Redis stays open until they end
+            self._close_connections()
+            if self.handler_tasks:
+                handlers = asyncio.gather(*self.handler_tasks, return_exceptions=True)
+                try:
+                    await asyncio.wait_for(handlers, SHUTDOWN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    print(f"[Server] {len(self.handler_tasks)} connections still open after {SHUTDOWN_TIMEOUT:g}s")
+            for task in tasks:
+                task.cancel()
+            # Cancelling the publisher flushes anything still queued
+            publisher_task.cancel()
+            await asyncio.gather(publisher_task, return_exceptions=True)
+            await self.redis_pubsub.aclose()
+            await self.redis_client.aclose()
+            self.hash_pool.shutdown()
+
+    def start(self):
+        """Start the chat server"""
+        try:
+            asyncio.run(self.serve())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            print("\n[Server] Shutting down...")
+
+
+if __name__ == '__main__':
+    AsyncChatServer().start()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Memory and lookup cost of the local connection registry: the original
+parallel dicts (socket -> (username, session_id), username -> socket,
+socket -> room, socket -> subscriptions, socket -> queue) versus one
+slotted Connection per client indexed by socket and by username.
+
+Sockets and output queues are stand-in objects, the same in both layouts,
+so only the registry itself is measured.
+
+Usage: python benchmarks/connection_registry.py [--connections N] [--rooms N] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import Connection  # noqa: E402
+
+
+class LegacyRegistry:
+    """Local state as ChatServer kept it before Connection"""
+
+    def __init__(self):
+        self.clients = {}  # socket -> (username, session_id)
+        self.user_sockets = {}  # username -> socket
+        self.room_members = {}  # room -> set of sockets
+        self.client_rooms = {}  # socket -> current room
+        self.client_subscriptions = {}  # socket -> set of publishers
+        self.outbound = {}  # socket -> queue
+
+    def add(self, sock, queue, username, session_id, room):
+        self.outbound[sock] = queue
+        self.clients[sock] = (username, session_id)
+        self.user_sockets[username] = sock
+        self.client_rooms[sock] = room
+        self.room_members.setdefault(room, set()).add(sock)
+        self.client_subscriptions.setdefault(sock, set())
+
+    def find(self, username, session_id):
+        """_disconnect_local_user before: scan every client"""
+        return [sock for sock, info in self.clients.items()
+                if info[0] == username and info[1] == session_id]
+
+
+class ConnectionRegistry:
+    """Local state as ChatServer keeps it now"""
+
+    def __init__(self):
+        self.connections = {}  # socket -> Connection
+        self.users = {}  # username -> Connection
+        self.room_members = {}  # room -> set of Connections
+
+    def add(self, sock, queue, username, session_id, room):
+        conn = Connection(sock, queue)
+        conn.username = username
+        conn.session_id = session_id
+        conn.room = room
+        self.connections[sock] = conn
+        self.users[username] = conn
+        self.room_members.setdefault(room, set()).add(conn)
+
+    def find(self, username, session_id):
+        conn = self.users.get(username)
+        return [conn] if conn is not None and conn.session_id == session_id else []
+
+
+def measure(registry_class, connections, rooms):
+    # Everything both layouts share is allocated before tracing starts
+    socks = [object() for _ in range(connections)]
+    queues = [object() for _ in range(connections)]
+    names = [f'user{i}' for i in range(connections)]
+    session_ids = [f'{i:032x}' for i in range(connections)]
+    room_names = [f'room{i}' for i in range(rooms)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    registry = registry_class()
+    for i in range(connections):
+        registry.add(socks[i], queues[i], names[i], session_ids[i], room_names[i % rooms])
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    target = connections - 1
+    iterations = max(1, 1000000 // connections)
+    lookup = timeit.timeit(lambda: registry.find(names[target], session_ids[target]), number=iterations)
+    return {
+        'layout': registry_class.__name__,
+        'connections': connections,
+        'bytes_per_connection': round(used / connections, 1),
+        'total_mb': round(used / 1e6, 2),
+        'find_user_us': round(lookup / iterations * 1e6, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connections', type=int, default=100000)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = [measure(cls, args.connections, args.rooms) for cls in (LegacyRegistry, ConnectionRegistry)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'layout':<22}{'bytes/conn':>12}{'total MB':>10}{'find user us':>14}")
+    for r in results:
+        print(f"{r['layout']:<22}{r['bytes_per_connection']:>12.1f}{r['total_mb']:>10.2f}{r['find_user_us']:>14.3f}")
+    print(f"{args.connections} connections over {args.rooms} rooms; find user = _disconnect_local_user's lookup")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Room fan-out cost on the thread engine: the original delivery (format and
+encode the line per recipient, one sendall per message per client) versus
+encode-once fan-out with queued messages joined into one sendall.
+
+Every member is a real socketpair drained by its own OutboundQueue writer
+thread; sendall calls are counted on the way to the kernel. CPU time is
+the whole process (fan-out plus writer threads) until every byte is written.
+Two scenarios: clients reading as fast as messages arrive, and clients that
+fall behind (small send buffer, nobody reading until the burst is queued),
+which is where a busy room spends its write syscalls.
+
+Usage: python benchmarks/fanout_write.py [--members N] [--messages N] [--sndbuf BYTES] [--json]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import Connection, OutboundQueue, close_socket  # noqa: E402
+
+
+class CountingSocket:
+    """Socket wrapper counting sendall calls (one write syscall each for small sends)"""
+
+    def __init__(self, sock, counter):
+        self.sock = sock
+        self.counter = counter
+
+    def sendall(self, data):
+        self.counter.add(len(data))
+        return self.sock.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.bytes = 0
+
+    def add(self, size):
+        with self.lock:
+            self.calls += 1
+            self.bytes += size
+
+
+class LegacyOutboundQueue(OutboundQueue):
+    """OutboundQueue writing one message per sendall, as before batching"""
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing:
+                    self.cond.wait()
+                if not self.queue:
+                    break
+                data = self.queue.popleft()
+                self.cond.notify_all()
+            try:
+                self.sock.sendall(data)
+            except Exception:
+                self.abort()
+                break
+        close_socket(self.sock)
+
+
+def legacy_fanout(members, room, sender, content):
+    for conn in members:
+        if conn.username == sender:
+            continue
+        formatted = f"[{room}] {sender}: {content}\n"
+        conn.outbound.send(formatted.encode())
+
+
+def current_fanout(members, room, sender, content):
+    payload = f"[{room}] {sender}: {content}\n".encode()
+    for conn in members:
+        if conn.username != sender:
+            conn.outbound.send(payload)
+
+
+def drain(peers, stop):
+    """Read every peer socket so writers never block on a full buffer"""
+    import selectors
+    selector = selectors.DefaultSelector()
+    for peer in peers:
+        peer.setblocking(False)
+        selector.register(peer, selectors.EVENT_READ)
+    while not stop.is_set():
+        for key, _ in selector.select(0.05):
+            try:
+                key.fileobj.recv(1 << 16)
+            except OSError:
+                pass
+    selector.close()
+
+
+def run(queue_class, fanout, members, messages, behind=False, sndbuf=4096):
+    counter = Counter()
+    conns, peers = [], []
+    for i in range(members):
+        a, b = socket.socketpair()
+        if behind:
+            a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        conn = Connection(a, queue_class(CountingSocket(a, counter), max_size=messages + 1))
+        conn.username = f'user{i}'
+        conns.append(conn)
+        peers.append(b)
+    stop = threading.Event()
+    reader = threading.Thread(target=drain, args=(peers, stop), daemon=True)
+    if not behind:
+        reader.start()
+
+    content = 'hey everyone, is the lab submission due tonight?'
+    expected = (members - 1) * messages * len(f"[lobby] user0: {content}\n")
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(messages):
+        fanout(conns, 'lobby', 'user0', content)
+    fanout_s = time.perf_counter() - wall_start
+    if behind:
+        reader.start()
+    while counter.bytes < expected:
+        time.sleep(0.001)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    stop.set()
+    reader.join()
+    for conn in conns:
+        conn.outbound.abort()
+    for peer in peers:
+        peer.close()
+    return {
+        'sendall_calls': counter.calls,
+        'bytes': counter.bytes,
+        'cpu_s': round(cpu, 3),
+        'wall_s': round(wall, 3),
+        'fanout_us_per_message': round(fanout_s / messages * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=200, help='messages broadcast back to back')
+    parser.add_argument('--sndbuf', type=int, default=4096, help='send buffer when clients fall behind')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = {}
+    for scenario, behind in (('keeping_up', False), ('behind', True)):
+        results[scenario] = {
+            name: run(queue_class, fanout, args.members, args.messages, behind, args.sndbuf)
+            for name, queue_class, fanout in (('legacy', LegacyOutboundQueue, legacy_fanout),
+                                              ('current', OutboundQueue, current_fanout))
+        }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'clients':<12}{'delivery':<10}{'sendall calls':>15}{'cpu s':>9}{'wall s':>9}{'fan-out us/msg':>16}")
+    for scenario, runs in results.items():
+        for name, r in runs.items():
+            print(f"{scenario:<12}{name:<10}{r['sendall_calls']:>15}{r['cpu_s']:>9.3f}"
+                  f"{r['wall_s']:>9.3f}{r['fanout_us_per_message']:>16.1f}")
+    print(f"{args.members}-member room, {args.messages} messages, "
+          f"{results['behind']['current']['bytes']} bytes each run")
+
+
+if __name__ == '__main__':
+    main()
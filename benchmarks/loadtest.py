@@ -0,0 +1,608 @@
+#!/usr/bin/env python3
+"""
+Load test for the chat server
+
+Starts one or more server processes against a Redis, drives them with
+headless clients on one event loop, and reports throughput, end-to-end
+delivery latency and per-server CPU/memory as JSON.
+
+Scenarios:
+  login_storm  every client connects and logs in at once
+  hot_room     every client in one room, the first --senders of them chatting
+  fanout       one publisher outside any room, every other client subscribed to it
+  rooms        clients spread over --rooms rooms, the first --senders chatting
+
+Without --redis-port a fakeredis TCP server is started as a stand-in
+(pip install fakeredis). It is much slower than Redis, so its numbers are
+only comparable with other fakeredis runs.
+
+Usage:
+  python benchmarks/loadtest.py --scenario hot_room --clients 200 --servers 2
+  python benchmarks/loadtest.py --scenario all --output results.json
+  python benchmarks/loadtest.py --scenario all --baseline results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+
+import bcrypt  # noqa: E402
+import redis  # noqa: E402
+
+import server as chat  # noqa: E402
+
+SCENARIOS = ('login_storm', 'hot_room', 'fanout', 'rooms')
+PASSWORD = 'bench'
+MARK = 'bench:'  # message content is bench:<sender>:<perf_counter at send>
+
+# socketserver's default listen backlog of 5 resets connections when a
+# server opens its Redis pool under load; Redis itself uses 511
+FAKEREDIS_SERVER = """
+import sys
+from fakeredis import TcpFakeServer
+TcpFakeServer.request_queue_size = 511
+TcpFakeServer(('127.0.0.1', int(sys.argv[1])), server_type='redis').serve_forever()
+"""
+
+
+def log(text):
+    print(text, file=sys.stderr, flush=True)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    """Block until something accepts connections on a local port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout}s")
+
+
+def raise_fd_limit():
+    """Every client is a socket in this process"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def percentiles(samples):
+    """Latency summary in milliseconds"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'p50': pick(0.50),
+        'p99': pick(0.99),
+        'p999': pick(0.999),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class ProcessStats:
+    """CPU time and resident memory of one process, read from /proc (Linux only)"""
+
+    TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self.start_cpu = None
+        self.start_time = None
+
+    def cpu(self):
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self.TICKS  # utime + stime
+        except (OSError, IndexError):
+            return None
+
+    def rss_mb(self):
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+
+    def begin(self):
+        self.start_cpu = self.cpu()
+        self.start_time = time.monotonic()
+
+    def sample(self):
+        rss = self.rss_mb()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def report(self):
+        cpu = self.cpu()
+        elapsed = time.monotonic() - self.start_time
+        if cpu is None or self.start_cpu is None:
+            return {'cpu_s': None, 'cpu_percent': None, 'rss_mb': None, 'peak_rss_mb': None}
+        used = cpu - self.start_cpu
+        rss = self.rss_mb()
+        return {
+            'cpu_s': round(used, 3),
+            'cpu_percent': round(100 * used / elapsed, 1) if elapsed > 0 else None,
+            'rss_mb': round(rss, 1) if rss is not None else None,
+            'peak_rss_mb': round(max(self.peak_rss, rss or 0), 1),
+        }
+
+
+class Servers:
+    """Chat server processes sharing one Redis"""
+
+    def __init__(self, args, redis_port, log_dir, label):
+        self.procs = []
+        self.ports = []
+        self.stats = []
+        for i in range(args.servers):
+            port = free_port()
+            env = dict(
+                os.environ,
+                SERVER_HOST='127.0.0.1', SERVER_PORT=str(port), SERVER_ID=f'bench_{label}_{i}',
+                REDIS_HOST=args.redis_host, REDIS_PORT=str(redis_port),
+                SERVER_MODE=args.mode, USE_TLS='true' if args.tls else 'false',
+                PYTHONUNBUFFERED='1',
+            )
+            env.update(args.server_env)
+            output = open(os.path.join(log_dir, f'{label}_server_{i}.log'), 'w')
+            proc = subprocess.Popen(
+                [sys.executable, 'server.py'], cwd=REPO, env=env,
+                stdout=output, stderr=subprocess.STDOUT
+            )
+            self.procs.append(proc)
+            self.ports.append(port)
+            self.stats.append(ProcessStats(proc.pid))
+        for port in self.ports:
+            wait_for_port(port)
+
+    def begin(self):
+        for stats in self.stats:
+            stats.begin()
+
+    def sample(self):
+        for stats in self.stats:
+            stats.sample()
+
+    def report(self):
+        return [dict(server=i, **stats.report()) for i, stats in enumerate(self.stats)]
+
+    def stop(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+class Tally:
+    """Deliveries seen by every client in one scenario"""
+
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.last_delivery = None
+        self.latencies = []
+        self.login_latencies = []
+        self.errors = 0
+
+
+class BenchClient:
+    """One headless session speaking the line protocol"""
+
+    def __init__(self, name, port, tally, ssl_context=None):
+        self.name = name
+        self.port = port
+        self.tally = tally
+        self.ssl_context = ssl_context
+        self.reader = None
+        self.writer = None
+        self.reading = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            '127.0.0.1', self.port, ssl=self.ssl_context,
+            server_hostname='localhost' if self.ssl_context else None,
+            limit=chat.MAX_LINE_LENGTH
+        )
+
+    async def command(self, line, expect):
+        """Send one line and wait for the reply line containing `expect`"""
+        self.writer.write(f"{line}\n".encode())
+        await self.writer.drain()
+        while True:
+            reply = await self.reader.readline()
+            if not reply:
+                raise ConnectionError(f"{self.name}: connection closed after {line.split()[0]}")
+            reply = reply.decode(errors='replace')
+            if expect in reply:
+                return reply
+            if reply.startswith('ERROR'):
+                raise RuntimeError(f"{self.name}: {reply.strip()}")
+
+    async def login(self):
+        start = time.perf_counter()
+        await self.command(f'LOGIN {self.name} {PASSWORD}', 'Welcome')
+        self.tally.login_latencies.append(time.perf_counter() - start)
+
+    def start_reading(self):
+        self.reading = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self):
+        own = f"{MARK}{self.name}:"
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            line = line.decode(errors='replace')
+            at = line.find(MARK)
+            if at < 0 or line.startswith(own, at):
+                continue
+            try:
+                sent_at = float(line[at:].rsplit(':', 1)[1])
+            except ValueError:
+                continue
+            now = time.perf_counter()
+            self.tally.delivered += 1
+            self.tally.last_delivery = now
+            self.tally.latencies.append(now - sent_at)
+
+    async def chat(self, rate, duration):
+        """Send at a fixed rate for `duration` seconds"""
+        interval = 1.0 / rate
+        start = time.perf_counter()
+        sent = 0
+        while True:
+            now = time.perf_counter()
+            if now - start >= duration:
+                break
+            self.writer.write(f"{MARK}{self.name}:{now!r}\n".encode())
+            sent += 1
+            self.tally.sent += 1
+            await self.writer.drain()
+            delay = start + sent * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return sent
+
+    async def close(self):
+        if self.reading:
+            self.reading.cancel()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
+
+async def gather_limited(limit, coros):
+    """Run coroutines with at most `limit` in flight; returns exceptions instead of raising"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(c) for c in coros), return_exceptions=True)
+
+
+def register_users(redis_client, names):
+    """Create accounts directly in Redis so setup does not pay for bcrypt"""
+    hashed = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds=4)).decode()
+    pipe = redis_client.pipeline(transaction=False)
+    for name in names:
+        pipe.hset(f'user:{name}', mapping={'password': hashed, 'created': datetime.now().isoformat()})
+    pipe.execute()
+
+
+async def sample_while(servers, task, interval=0.5):
+    """Sample server memory until a task finishes"""
+    while not task.done():
+        servers.sample()
+        await asyncio.sleep(interval)
+    servers.sample()
+    return await task
+
+
+async def drain(tally, expected, timeout):
+    """Wait for in-flight deliveries, up to `timeout` seconds"""
+    deadline = time.perf_counter() + timeout
+    while tally.delivered < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def run_scenario(name, args, redis_port, redis_client, log_dir):
+    label = f'{name}_{uuid.uuid4().hex[:6]}'
+    names = [f'{label}_{i}' for i in range(args.clients)]
+    register_users(redis_client, names)
+
+    ssl_context = None
+    if args.tls:
+        ssl_context = ssl.create_default_context(cafile=os.path.join(REPO, chat.CERT_FILE))
+        ssl_context.check_hostname = False
+
+    tally = Tally()
+    servers = Servers(args, redis_port, log_dir, label)
+    clients = [
+        BenchClient(n, servers.ports[i % len(servers.ports)], tally, ssl_context)
+        for i, n in enumerate(names)
+    ]
+    result = {'clients': args.clients, 'servers': args.servers, 'mode': args.mode}
+    try:
+        if name == 'login_storm':
+            servers.begin()
+            start = time.perf_counter()
+            outcomes = await sample_while(servers, asyncio.ensure_future(asyncio.gather(
+                *(connect_and_login(c) for c in clients), return_exceptions=True
+            )))
+            elapsed = time.perf_counter() - start
+            tally.errors = sum(1 for o in outcomes if isinstance(o, Exception))
+            result.update({
+                'duration_s': round(elapsed, 3),
+                'logins': len(tally.login_latencies),
+                'logins_per_s': round(len(tally.login_latencies) / elapsed, 1),
+            })
+        else:
+            outcomes = await gather_limited(args.connect_concurrency, (connect_and_login(c) for c in clients))
+            failed = [o for o in outcomes if isinstance(o, Exception)]
+            if failed:
+                raise RuntimeError(f"{len(failed)} clients failed to log in, first: {failed[0]}")
+
+            senders, expected_per_message = await arrange(name, args, label, clients)
+            for client in clients:
+                client.start_reading()
+
+            servers.begin()
+            start = time.perf_counter()
+            chatting = asyncio.ensure_future(asyncio.gather(
+                *(c.chat(args.rate, args.duration) for c in senders)
+            ))
+            sent_counts = await sample_while(servers, chatting)
+            expected = sum(count * expected_per_message[c.name] for c, count in zip(senders, sent_counts))
+            await drain(tally, expected, args.drain)
+            elapsed = (tally.last_delivery or time.perf_counter()) - start
+            result.update({
+                'senders': len(senders),
+                'duration_s': round(elapsed, 3),
+                'sent': tally.sent,
+                'expected': expected,
+                'delivered': tally.delivered,
+                'loss': round(1 - tally.delivered / expected, 6) if expected else 0.0,
+                'sent_per_s': round(tally.sent / args.duration, 1),
+                'delivered_per_s': round(tally.delivered / elapsed, 1),
+                'latency_ms': percentiles(tally.latencies),
+            })
+        result['login_ms'] = percentiles(tally.login_latencies)
+        result['errors'] = tally.errors
+        result['server_stats'] = servers.report()
+    finally:
+        await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+        servers.stop()
+    return result
+
+
+async def connect_and_login(client):
+    await client.connect()
+    await client.login()
+
+
+async def arrange(name, args, label, clients):
+    """Put clients in rooms or subscriptions; returns senders and deliveries per message"""
+    limit = args.connect_concurrency
+    if name == 'hot_room':
+        room = f'{label}_hot'
+        await gather_limited(limit, (c.command(f'/join {room}', 'Joined room') for c in clients))
+        senders = clients[:args.senders]
+        return senders, {c.name: len(clients) - 1 for c in senders}
+
+    if name == 'fanout':
+        publisher = clients[0]
+        await publisher.command('/leave', 'Left room')
+        await gather_limited(limit, (
+            c.command(f'/subscribe {publisher.name}', 'Subscribed to') for c in clients[1:]
+        ))
+        # Everyone else stays in the lobby; only room traffic would reach them there
+        return [publisher], {publisher.name: len(clients) - 1}
+
+    if name == 'rooms':
+        rooms = [f'{label}_r{i}' for i in range(args.rooms)]
+        await gather_limited(limit, (
+            c.command(f'/join {rooms[i % len(rooms)]}', 'Joined room') for i, c in enumerate(clients)
+        ))
+        members = {room: 0 for room in rooms}
+        for i in range(len(clients)):
+            members[rooms[i % len(rooms)]] += 1
+        senders = clients[:args.senders]
+        return senders, {
+            c.name: members[rooms[i % len(rooms)]] - 1 for i, c in enumerate(senders)
+        }
+
+    raise ValueError(f"unknown scenario {name}")
+
+
+def lookup(result, path):
+    value = result
+    for part in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def compare(baseline, results, tolerance):
+    """Regressions against an earlier run: lower throughput or higher tail latency"""
+    regressions = []
+    checks = (
+        ('delivered_per_s', False), ('logins_per_s', False),
+        ('latency_ms.p99', True), ('login_ms.p99', True),
+    )
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        for metric, higher_is_worse in checks:
+            old, new = lookup(previous, metric), lookup(current, metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change > tolerance) if higher_is_worse else (change < -tolerance):
+                regressions.append(f"{name} {metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def start_redis_stand_in(port):
+    try:
+        import fakeredis  # noqa: F401
+    except ImportError:
+        sys.exit("No --redis-port given and fakeredis is not installed (pip install fakeredis)")
+    proc = subprocess.Popen([sys.executable, '-c', FAKEREDIS_SERVER, str(port)])
+    wait_for_port(port)
+    return proc
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test for the chat server')
+    parser.add_argument('--scenario', default='all', choices=SCENARIOS + ('all',))
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--servers', type=int, default=1)
+    parser.add_argument('--mode', default='threads', choices=('threads', 'asyncio'), help='SERVER_MODE of the servers')
+    parser.add_argument('--senders', type=int, default=10, help='clients sending in hot_room and rooms')
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=20, help='messages per second per sender')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of chat per scenario')
+    parser.add_argument('--drain', type=float, default=5, help='seconds to wait for in-flight deliveries')
+    parser.add_argument('--connect-concurrency', type=int, default=200)
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', type=int, help='use this Redis instead of a fakeredis stand-in')
+    parser.add_argument('--tls', action='store_true', help='run servers with USE_TLS=true')
+    parser.add_argument('--server-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment for the servers, repeatable')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--baseline', help='earlier JSON results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed relative change against --baseline')
+    args = parser.parse_args()
+    args.server_env = dict(item.split('=', 1) for item in args.server_env)
+    args.server_env.setdefault('BCRYPT_ROUNDS', '4')
+    # The scenarios push connection, login and room rates on purpose
+    for name in ('CONNECT_RATE', 'LOGIN_RATE', 'ROOM_MSG_RATE'):
+        args.server_env.setdefault(name, '0')
+    # Receiving clients send nothing for the whole run
+    args.server_env.setdefault('IDLE_TIMEOUT', '0')
+    return args
+
+
+async def main_async(args, redis_port, redis_client, log_dir):
+    scenarios = SCENARIOS if args.scenario == 'all' else (args.scenario,)
+    results = {}
+    for name in scenarios:
+        log(f"[Bench] {name}: {args.clients} clients, {args.servers} {args.mode} server(s)")
+        results[name] = await run_scenario(name, args, redis_port, redis_client, log_dir)
+        summary = results[name]
+        if 'latency_ms' in summary:
+            log(f"[Bench] {name}: {summary['delivered_per_s']} deliveries/s, "
+                f"p99 {lookup(summary, 'latency_ms.p99')} ms, loss {summary['loss']}")
+        else:
+            log(f"[Bench] {name}: {summary['logins_per_s']} logins/s, p99 {lookup(summary, 'login_ms.p99')} ms")
+    return results
+
+
+def main():
+    args = parse_args()
+    raise_fd_limit()
+    log_dir = tempfile.mkdtemp(prefix='chat_bench_')
+
+    stand_in = None
+    redis_port = args.redis_port
+    if redis_port is None:
+        redis_port = free_port()
+        stand_in = start_redis_stand_in(redis_port)
+    redis_client = redis.Redis(host=args.redis_host, port=redis_port)
+    # fakeredis drops the connection on NOSCRIPT, so load every script up front
+    for name in dir(chat):
+        if name.endswith('_LUA'):
+            redis_client.script_load(getattr(chat, name))
+
+    try:
+        scenarios = asyncio.run(main_async(args, redis_port, redis_client, log_dir))
+    finally:
+        if stand_in:
+            stand_in.terminate()
+
+    results = {
+        'meta': {
+            'time': datetime.now().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'redis': f'{args.redis_host}:{redis_port}' if stand_in is None else 'fakeredis',
+            'server_logs': log_dir,
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        },
+        'scenarios': scenarios,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for line in regressions:
+            log(f"[Regression] {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Redis sharding: how many keys move when a node is added, and how the
+server's session and room traffic spreads as nodes are added.
+
+Key movement compares the consistent hash ring of sharding.py with plain
+hash % N over the same entity names. The workload runs the Redis calls of
+LOGIN, /join, /subscribe and logout (the server's own Lua scripts, through
+AsyncShardedRedis) for --users users against 1, 2, 4... nodes, counting the
+commands each node serves.
+
+Redis executes commands on one thread, so a deployment is capped by its
+busiest node: the projected ceiling is the one-node rate divided by the
+busiest node's share of commands. Measured rates only rise with nodes when
+each node has a core of its own; on a single machine, and with the
+fakeredis stand-ins started when --redis-ports is not given, they stay
+flat or fall, and only the ceiling shows the gain.
+
+Usage: python benchmarks/redis_shards.py [--nodes 1,2,4] [--redis-ports P1,P2,...] [--users N] [--json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import zlib
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import redis  # noqa: E402
+import redis.asyncio as aioredis  # noqa: E402
+
+import server as chat  # noqa: E402
+import sharding  # noqa: E402
+from loadtest import free_port, start_redis_stand_in  # noqa: E402
+
+
+def key_movement(max_nodes, entities):
+    """Share of entities that change node going from N to N + 1 nodes"""
+    names = [f'user{i}' for i in range(entities)]
+    rows = []
+    for n in range(1, max_nodes):
+        before = sharding.HashRing([f'node{i}' for i in range(n)])
+        after = sharding.HashRing([f'node{i}' for i in range(n + 1)])
+        ring_moved = sum(before.index_for(name) != after.index_for(name) for name in names)
+        modulo_moved = sum(zlib.crc32(name.encode()) % n != zlib.crc32(name.encode()) % (n + 1) for name in names)
+        counts = [0] * (n + 1)
+        for name in names:
+            counts[after.index_for(name)] += 1
+        rows.append({
+            'nodes': f'{n}->{n + 1}',
+            'ideal_moved': round(1 / (n + 1), 3),
+            'ring_moved': round(ring_moved / entities, 3),
+            'modulo_moved': round(modulo_moved / entities, 3),
+            'ring_max_over_mean': round(max(counts) / (entities / (n + 1)), 3),
+        })
+    return rows
+
+
+class CountingRedis(aioredis.Redis):
+    """Counts the commands sent to each node (pipelines count each command)"""
+    counts = {}
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.name = f"{options['host']}:{options['port']}"
+
+    async def execute_command(self, *args, **options):
+        CountingRedis.counts[self.name] = CountingRedis.counts.get(self.name, 0) + 1
+        return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        original = pipe.execute
+
+        async def execute(raise_on_error=True):
+            CountingRedis.counts[self.name] = CountingRedis.counts.get(self.name, 0) + len(pipe.command_stack)
+            return await original(raise_on_error)
+        pipe.execute = execute
+        return pipe
+
+
+class Workload:
+    """The Redis calls the server makes for a user's session, as AsyncChatServer makes them"""
+
+    def __init__(self, client, rooms):
+        self.client = client
+        self.rooms = rooms
+        self.create_session = client.register_script(chat.CREATE_SESSION_LUA)
+        self.remove_session = client.register_script(chat.REMOVE_SESSION_LUA)
+        self.join_room = client.register_script(chat.JOIN_ROOM_LUA)
+        self.room_member = client.register_script(chat.ROOM_MEMBER_LUA)
+
+    def here(self, username, *rooms):
+        """Rooms whose room:* set shares the node of the user's session"""
+        node = self.client.node_for(f'session:{username}')
+        return [room for room in rooms if room and self.client.node_for(chat.room_key(room)) is node]
+
+    async def join_elsewhere(self, username, new_room, here):
+        if new_room and new_room not in here:
+            await self.room_member(keys=[chat.room_key(new_room)], args=[username, '', new_room])
+
+    async def leave_elsewhere(self, username, old_room, new_room, here):
+        if old_room and old_room != new_room and old_room not in here:
+            await self.room_member(keys=[chat.room_key(old_room)], args=[username, old_room, ''])
+
+    async def session(self, index, users):
+        username = f'user{index}'
+        session_id = f'{index:032x}'
+        await self.client.hgetall(f'user:{username}')
+        here = self.here(username, 'lobby')
+        await self.join_elsewhere(username, 'lobby', here)
+        old_room, _ = await self.create_session(
+            keys=[f'session:{username}', f'subscriptions:{username}'] + [chat.room_key(r) for r in here],
+            args=[username, 'bench', datetime.now().isoformat(), session_id, 'lobby', chat.SESSION_TTL] + here)
+        await self.leave_elsewhere(username, old_room, 'lobby', here)
+        room = f'room{index % self.rooms}'
+        here = self.here(username, 'lobby', room)
+        await self.join_elsewhere(username, room, here)
+        old_room = await self.join_room(keys=[f'session:{username}'] + [chat.room_key(r) for r in here],
+                                        args=[username, room] + here)
+        await self.leave_elsewhere(username, old_room, room, here)
+        target = f'user{(index + 1) % users}'
+        pipe = self.client.pipeline(transaction=True)
+        pipe.sadd(f'subscribers:{target}', username)
+        pipe.sadd(f'subscriptions:{username}', target)
+        await pipe.execute()
+        here = self.here(username, room)
+        removed = await self.remove_session(keys=[f'session:{username}'] + [chat.room_key(r) for r in here],
+                                            args=['bench', session_id, 'bench', username] + here)
+        if removed:
+            await self.leave_elsewhere(username, removed[0], None, here)
+
+
+async def run_workload(ports, users, rooms, concurrency):
+    client = sharding.AsyncShardedRedis([('127.0.0.1', port) for port in ports],
+                                        client_class=CountingRedis, decode_responses=True)
+    for port in ports:
+        node = redis.Redis(port=port)
+        node.flushall()
+        for name in dir(chat):
+            if name.endswith('_LUA'):
+                node.script_load(getattr(chat, name))
+        node.close()
+    workload = Workload(client, rooms)
+    CountingRedis.counts = {}
+    queue = iter(range(users))
+
+    async def worker():
+        for index in queue:
+            await workload.session(index, users)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await client.aclose()
+    commands = sum(CountingRedis.counts.values())
+    return {
+        'nodes': len(ports),
+        'commands': commands,
+        'sessions_per_s': round(users / elapsed, 1),
+        'commands_per_s': round(commands / elapsed, 1),
+        'busiest_node_share': round(max(CountingRedis.counts.values()) / commands, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--nodes', default='1,2,4', help='node counts to run the workload on')
+    parser.add_argument('--redis-ports', help='Redis ports on 127.0.0.1 to use as nodes (default: fakeredis stand-ins)')
+    parser.add_argument('--users', type=int, default=2000, help='sessions per run')
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--entities', type=int, default=100000, help='names hashed for the key movement table')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    counts = [int(n) for n in args.nodes.split(',')]
+    stand_ins = []
+    if args.redis_ports:
+        ports = [int(p) for p in args.redis_ports.split(',')]
+        if len(ports) < max(counts):
+            sys.exit(f"--nodes needs {max(counts)} Redis ports, got {len(ports)}")
+    else:
+        ports = [free_port() for _ in range(max(counts))]
+        stand_ins = [start_redis_stand_in(port) for port in ports]
+    try:
+        runs = [asyncio.run(run_workload(ports[:n], args.users, args.rooms, args.concurrency)) for n in counts]
+    finally:
+        for proc in stand_ins:
+            proc.terminate()
+    single = next((r['sessions_per_s'] for r in runs if r['nodes'] == 1), None)
+    for r in runs:
+        r['projected_sessions_per_s'] = round(single / r['busiest_node_share'], 1) if single else None
+    results = {'key_movement': key_movement(max(counts + [4]), args.entities), 'workload': runs,
+               'backend': 'redis' if args.redis_ports else 'fakeredis'}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'nodes':<8}{'ideal':>8}{'ring':>8}{'hash % N':>10}{'ring max/mean':>15}")
+    for r in results['key_movement']:
+        print(f"{r['nodes']:<8}{r['ideal_moved']:>8.1%}{r['ring_moved']:>8.1%}"
+              f"{r['modulo_moved']:>10.1%}{r['ring_max_over_mean']:>15.2f}")
+    print(f"Share of {args.entities} entities moved when a node is added")
+    print()
+    print(f"{'nodes':<7}{'commands':>10}{'sessions/s':>12}{'commands/s':>12}{'busiest node':>14}{'ceiling sessions/s':>20}")
+    for r in runs:
+        projected = f"{r['projected_sessions_per_s']:.1f}" if r['projected_sessions_per_s'] else '-'
+        print(f"{r['nodes']:<7}{r['commands']:>10}{r['sessions_per_s']:>12.1f}{r['commands_per_s']:>12.1f}"
+              f"{r['busiest_node_share']:>14.1%}{projected:>20}")
+    print(f"{args.users} login/join/subscribe/logout sessions per run on {results['backend']}; "
+          f"ceiling = one-node rate / busiest node's share")
+
+
+if __name__ == '__main__':
+    main()
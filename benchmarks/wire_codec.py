@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Encode/decode cost and size of inter-server messages: the original JSON
+payload (ISO timestamp, every key present) versus the wire.py binary format.
+
+Usage: python benchmarks/wire_codec.py [--iterations N] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import wire  # noqa: E402
+
+
+def legacy_message(msg_type, sender, content, room=None, target=None):
+    """Payload exactly as _publish_message built it before wire.py"""
+    return {
+        'type': msg_type,
+        'sender': sender,
+        'content': content,
+        'room': room,
+        'target': target,
+        'server_id': 'server_1',
+        'timestamp': datetime.now().isoformat()
+    }
+
+
+def current_message(msg_type, sender, content, room=None, target=None):
+    """Payload as _publish_message builds it now"""
+    message = legacy_message(msg_type, sender, content, room, target)
+    message['timestamp'] = wire.now_ms()
+    return message
+
+
+SAMPLES = {
+    'room_message': ('room_message', 'vivek', 'hey everyone, is the lab submission due tonight?', 'lobby'),
+    'pubsub_message': ('pubsub_message', 'sakshi', 'new blog post is up', None),
+    'short_line': ('room_message', 'a', 'ok', 'dev'),
+}
+
+
+def measure(fn, iterations):
+    """Nanoseconds per call"""
+    return timeit.timeit(fn, number=iterations) / iterations * 1e9
+
+
+def run(iterations):
+    results = []
+    for name, args in SAMPLES.items():
+        legacy = legacy_message(*args)
+        current = current_message(*args)
+        legacy_payload = json.dumps(legacy)
+        binary_payload = wire.encode(current, 'binary')
+        json_payload = wire.encode(current, 'json')
+
+        results.append({
+            'sample': name,
+            'legacy_json_bytes': len(legacy_payload.encode()),
+            'wire_json_bytes': len(json_payload),
+            'binary_bytes': len(binary_payload),
+            'legacy_json_encode_ns': measure(lambda: json.dumps(legacy_message(*args)), iterations),
+            'legacy_json_decode_ns': measure(lambda: json.loads(legacy_payload), iterations),
+            'binary_encode_ns': measure(lambda: wire.encode(current_message(*args), 'binary'), iterations),
+            'binary_decode_ns': measure(lambda: wire.decode(binary_payload), iterations),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'sample':<16}{'bytes json/bin':>16}{'encode ns json/bin':>22}{'decode ns json/bin':>22}")
+    for r in results:
+        print(f"{r['sample']:<16}"
+              f"{r['legacy_json_bytes']:>9}/{r['binary_bytes']:<6}"
+              f"{r['legacy_json_encode_ns']:>13.0f}/{r['binary_encode_ns']:<8.0f}"
+              f"{r['legacy_json_decode_ns']:>13.0f}/{r['binary_decode_ns']:<8.0f}")
+    print("encode includes building the message dict, as _publish_message does")
+
+
+if __name__ == '__main__':
+    main()
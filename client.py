@@ -1,20 +1,43 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import random
+import re
 import socket
 import ssl
 import threading
 import sys
 import os
+import time
 
 # Configuration
 HOST = os.getenv('SERVER_HOST', 'localhost')
 PORT = int(os.getenv('SERVER_PORT', 9999))
 USE_TLS = os.getenv('USE_TLS', 'true').lower() == 'true'
 CA_CERT = os.getenv('CA_CERT', 'server.crt')
+RECONNECT_BASE = float(os.getenv('RECONNECT_BASE', 0.5))  # seconds, doubled per failed attempt
+RECONNECT_MAX = float(os.getenv('RECONNECT_MAX', 30))  # cap on the reconnect delay
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL', 30))  # seconds of silence before a /ping, 0 disables
+EXPECT_TIMEOUT = 10  # seconds a script waits for an !expect line
+INBOX_SIZE = 1000  # received lines kept per session for !expect
+STAMPS_KEPT = 100000  # send times remembered for latency matching
+
+# Appended to scripted chat lines so any session in the process can time them
+STAMP_PATTERN = re.compile(r' \[t:(\d+):(\d+)\]$')
+TAKEOVER_NOTICE = 'logged out'
+# Keeps an idle connection under the server's IDLE_TIMEOUT; replies are not shown
+HEARTBEAT = '/ping'
+HEARTBEAT_REPLY = 'PONG'
+# Commands whose effect a new session has to repeat after a reconnect
+STATE_COMMANDS = ('/join', '/leave', '/subscribe', '/unsubscribe')
 
 class ChatClient:
     def __init__(self):
         self.socket = None
         self.running = True
+        self.send_lock = threading.Lock()  # typed lines and heartbeats share the socket
+        self.last_sent = time.monotonic()
     
     def connect(self):
         """Connect to the chat server"""
@@ -37,10 +60,11 @@ class ChatClient:
                     self.socket,
                     server_hostname=HOST
                 )
-                print("[Client] TLS connection established")
             
             # Connect to server
             self.socket.connect((HOST, PORT))
+            if USE_TLS:
+                print("[Client] TLS connection established")
             print(f"[Client] Connected to {HOST}:{PORT}")
             return True
         
@@ -50,6 +74,7 @@ class ChatClient:
     
     def receive_messages(self):
         """Receive messages from server in separate thread"""
+        buffer = b''
         while self.running:
             try:
                 data = self.socket.recv(4096)
@@ -59,8 +84,12 @@ class ChatClient:
                     self.running = False
                     break
                 
-                message = data.decode()
-                print(message, end='')
+                # Whole lines only, so heartbeat replies can be left out
+                *lines, buffer = (buffer + data).split(b'\n')
+                for line in lines:
+                    message = line.decode(errors='replace')
+                    if message.strip() != HEARTBEAT_REPLY:
+                        print(message)
             
             except Exception as e:
                 if self.running:
@@ -81,7 +110,8 @@ class ChatClient:
                     self.running = False
                     break
                 
-                self.socket.sendall(message.encode())
+                # The server frames commands by newline
+                self.send_line(message)
             
             except KeyboardInterrupt:
                 print("\n[Exiting...]")
@@ -94,6 +124,23 @@ class ChatClient:
                 self.running = False
                 break
     
+    def send_line(self, line):
+        with self.send_lock:
+            self.socket.sendall((line + '\n').encode())
+            self.last_sent = time.monotonic()
+    
+    def send_heartbeats(self):
+        """Send a /ping whenever nothing was sent for HEARTBEAT_INTERVAL"""
+        while self.running:
+            wait = self.last_sent + HEARTBEAT_INTERVAL - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                self.send_line(HEARTBEAT)
+            except Exception:
+                break
+    
     def start(self):
         """Start the client"""
         if not self.connect():
@@ -102,6 +149,8 @@ class ChatClient:
         # Start receive thread
         receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
         receive_thread.start()
+        if HEARTBEAT_INTERVAL > 0:
+            threading.Thread(target=self.send_heartbeats, daemon=True).start()
         
         # Send messages in main thread
         self.send_messages()
@@ -114,6 +163,369 @@ class ChatClient:
         
         print("[Client] Disconnected")
 
+
+class ResumingContext(ssl.SSLContext):
+    """
+    Client context that offers the TLS session of its previous connection,
+    so a reconnect skips the full handshake. asyncio has no way to pass
+    session= to a connection, so wrap_bio supplies it. A session is only
+    accepted by the context that created it: one context per session.
+    """
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session or self.session)
+
+
+def create_client_context():
+    """TLS context that trusts CA_CERT, or None when TLS is off"""
+    if not USE_TLS:
+        return None
+    if not os.path.exists(CA_CERT):
+        raise SystemExit(f"[ERROR] TLS enabled but CA certificate not found: {CA_CERT}")
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False  # For self-signed certs
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(CA_CERT)
+    return context
+
+
+def parse_script(text):
+    """Script lines -> steps; see --help for the directives"""
+    steps = []
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip() or line.startswith('#'):
+            continue
+        if not line.startswith('!'):
+            steps.append(('send', line))
+            continue
+        name, _, rest = line[1:].partition(' ')
+        try:
+            if name == 'sleep':
+                steps.append(('sleep', float(rest)))
+            elif name == 'expect':
+                steps.append(('expect', rest))
+            elif name == 'repeat':
+                count, interval, line = rest.split(' ', 2)
+                steps.append(('repeat', int(count), float(interval), line))
+            else:
+                raise ValueError(f"unknown directive !{name}")
+        except ValueError as e:
+            raise SystemExit(f"[ERROR] Script line {number}: {e}")
+    return steps
+
+
+def percentiles(samples):
+    """p50/p99/p999/max of latency samples in seconds, reported in ms"""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return {'count': len(samples), 'p50': round(pick(0.5), 3), 'p99': round(pick(0.99), 3),
+            'p999': round(pick(0.999), 3), 'max': round(samples[-1] * 1000, 3)}
+
+
+class SessionLost(Exception):
+    """The connection closed or failed; the session may reconnect"""
+
+
+class LoginFailed(Exception):
+    """The server refused the credentials; retrying will not help"""
+
+
+class HeadlessSession:
+    """One scripted connection: logs in, runs the script, reconnects with jittered backoff"""
+
+    def __init__(self, runner, index):
+        self.runner = runner
+        self.index = index
+        self.username = f'{runner.args.user_prefix}{index}'
+        self.step = 0  # next script step, kept across reconnects
+        self.repeated = 0  # lines already sent by the current !repeat step
+        self.seq = 0
+        self.state_lines = []  # room and subscription commands sent so far
+        self.latest = {}  # sender session index -> newest stamp seen, skips history replays
+        self.reader = None
+        self.writer = None
+        self.inbox = None
+        self.arrived = None
+        self.lost = None
+        self.taken_over = False
+        self.heartbeat_task = None
+        self.last_sent = 0.0
+        self.tls_context = create_client_context()  # keeps the TLS session between connections
+
+    def log(self, text):
+        print(f"[Client {self.username}] {text}", file=sys.stderr)
+
+    async def run(self):
+        attempt = 0
+        while True:
+            try:
+                await self._connect()
+                attempt = 0
+                await self._run_script()
+                await self._sleep(self.runner.args.linger)
+                return
+            except LoginFailed as e:
+                self.log(f"Login failed: {e}")
+                self.runner.stats['login_failures'] += 1
+                return
+            except (SessionLost, OSError, asyncio.TimeoutError) as e:
+                self.runner.stats['disconnects'] += 1
+                if not self.runner.args.reconnect or self.taken_over:
+                    self.log(f"Connection lost: {e or type(e).__name__}")
+                    return
+                # Full jitter: a crowd dropped at once spreads its reconnects
+                # over the whole backoff window instead of arriving together
+                delay = random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * 2 ** attempt))
+                attempt += 1
+                self.log(f"Connection lost ({e or type(e).__name__}), reconnecting in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                self.runner.stats['reconnects'] += 1
+            finally:
+                self._close()
+
+    async def _connect(self):
+        self.inbox = []
+        self.arrived = asyncio.Event()
+        self.lost = asyncio.Event()
+        context = self.tls_context
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(
+            HOST, PORT, ssl=context, server_hostname=HOST if context else None
+        ), EXPECT_TIMEOUT)
+        if context is not None and self.writer.get_extra_info('ssl_object').session_reused:
+            self.runner.stats['tls_resumed'] += 1
+        self.reader_task = asyncio.create_task(self._receive())
+        self.last_sent = time.monotonic()
+        if HEARTBEAT_INTERVAL > 0:
+            self.heartbeat_task = asyncio.create_task(self._heartbeat())
+        password = self.runner.args.password
+        if self.runner.args.register:
+            self._send_line(f'REGISTER {self.username} {password}')
+            await self._expect(('SUCCESS', 'ERROR'))
+        self._send_line(f'LOGIN {self.username} {password}')
+        reply = await self._expect(('Welcome', 'ERROR'))
+        if 'Invalid username or password' in reply:
+            raise LoginFailed(reply)
+        if 'ERROR' in reply:
+            raise SessionLost(reply)  # rate limited or overloaded: back off and retry
+        self.runner.stats['logins'] += 1
+        # A new session starts in the lobby with the stored subscriptions
+        for line in self.state_lines:
+            self._send_line(line)
+
+    def _close(self):
+        if self.writer is not None:
+            ssl_object = self.writer.get_extra_info('ssl_object')
+            if ssl_object is not None and ssl_object.session is not None:
+                # TLS 1.3 tickets arrive after the handshake, so take it last
+                self.tls_context.session = ssl_object.session
+            self.reader_task.cancel()
+            if self.heartbeat_task is not None:
+                self.heartbeat_task.cancel()
+            self.writer.close()
+            self.writer = None
+
+    async def _receive(self):
+        try:
+            while True:
+                raw = await self.reader.readline()
+                if not raw:
+                    break
+                now = time.perf_counter()
+                line = raw.decode(errors='replace').rstrip('\r\n')
+                if line == HEARTBEAT_REPLY:
+                    continue
+                self.runner.received(self, line, now)
+                if TAKEOVER_NOTICE in line and line.startswith('[SYSTEM]'):
+                    self.taken_over = True
+                self.inbox.append(line)
+                del self.inbox[:-INBOX_SIZE]
+                self.arrived.set()
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            pass
+        self.lost.set()
+        self.arrived.set()
+
+    def _send_line(self, line):
+        if self.lost.is_set():
+            raise SessionLost("connection closed by server")
+        self.runner.transcript(self, '>', line)
+        self.writer.write((line + '\n').encode())
+        self.last_sent = time.monotonic()
+
+    async def _heartbeat(self):
+        """Send a /ping whenever the session sent nothing for HEARTBEAT_INTERVAL"""
+        while True:
+            wait = self.last_sent + HEARTBEAT_INTERVAL - time.monotonic()
+            if wait <= 0:
+                self.writer.write(f'{HEARTBEAT}\n'.encode())
+                self.last_sent = time.monotonic()
+                wait = HEARTBEAT_INTERVAL
+            await asyncio.sleep(wait)
+
+    async def _send_scripted(self, line, counter=0):
+        line = (line.replace('{user}', self.username).replace('{session}', str(self.index))
+                .replace('{i}', str(counter)))
+        if self.runner.args.stamp and not line.startswith('/'):
+            self.seq += 1
+            self.runner.stamp((self.index, self.seq))
+            line = f'{line} [t:{self.index}:{self.seq}]'
+        elif line.split(' ', 1)[0].lower() in STATE_COMMANDS:
+            self.state_lines.append(line)
+        self._send_line(line)
+        self.runner.stats['sent'] += 1
+        await self.writer.drain()
+
+    async def _sleep(self, seconds):
+        """Sleep, but raise as soon as the connection is lost"""
+        try:
+            await asyncio.wait_for(self.lost.wait(), seconds)
+        except asyncio.TimeoutError:
+            return
+        raise SessionLost("connection closed by server")
+
+    async def _expect(self, needles, timeout=EXPECT_TIMEOUT):
+        """Consume received lines until one contains any of needles"""
+        deadline = time.monotonic() + timeout
+        while True:
+            while self.inbox:
+                line = self.inbox.pop(0)
+                if any(needle in line for needle in needles):
+                    return line
+            if self.lost.is_set():
+                raise SessionLost("connection closed by server")
+            self.arrived.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"no line containing {needles!r}")
+            try:
+                await asyncio.wait_for(self.arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_script(self):
+        steps = self.runner.steps
+        while self.step < len(steps):
+            step = steps[self.step]
+            if step[0] == 'send':
+                await self._send_scripted(step[1])
+            elif step[0] == 'sleep':
+                await self._sleep(step[1])
+            elif step[0] == 'expect':
+                await self._expect((step[1],))
+            else:
+                _, count, interval, line = step
+                while self.repeated < count:
+                    await self._send_scripted(line, self.repeated)
+                    self.repeated += 1
+                    await self._sleep(interval)
+                self.repeated = 0
+            self.step += 1
+
+
+class HeadlessRunner:
+    """Many HeadlessSessions in one process, with shared latency accounting"""
+
+    def __init__(self, args, steps):
+        self.args = args
+        self.steps = steps
+        self.sent = {}  # (session index, seq) -> send time
+        self.rtt = []  # own echo, per stamped line
+        self.delivery = []  # other sessions in this process receiving it
+        self.stats = dict.fromkeys(
+            ('logins', 'login_failures', 'disconnects', 'reconnects', 'tls_resumed', 'sent', 'received', 'rate_limited'), 0)
+        self.log_file = open(args.log, 'w') if args.log else None
+
+    def stamp(self, key):
+        self.sent[key] = time.perf_counter()
+        if len(self.sent) > STAMPS_KEPT:
+            # Dicts keep insertion order: forget the oldest half
+            for old in list(self.sent)[:STAMPS_KEPT // 2]:
+                del self.sent[old]
+
+    def transcript(self, session, direction, line):
+        if self.log_file is not None:
+            self.log_file.write(f"{time.time():.6f} {session.username} {direction} {line}\n")
+
+    def received(self, session, line, now):
+        self.transcript(session, '<', line)
+        self.stats['received'] += 1
+        if line.startswith('ERROR: rate limited'):
+            self.stats['rate_limited'] += 1
+        match = STAMP_PATTERN.search(line)
+        if match:
+            key = (int(match.group(1)), int(match.group(2)))
+            sent_at = self.sent.get(key)
+            if sent_at is not None and key[1] > session.latest.get(key[0], 0):
+                session.latest[key[0]] = key[1]
+                (self.rtt if key[0] == session.index else self.delivery).append(now - sent_at)
+
+    async def run(self):
+        sessions = [HeadlessSession(self, self.args.first + i) for i in range(self.args.sessions)]
+        started = time.perf_counter()
+
+        async def start(i, session):
+            # Ramp up evenly instead of connecting every session at once
+            await asyncio.sleep(self.args.ramp * i / len(sessions))
+            await session.run()
+
+        await asyncio.gather(*(start(i, session) for i, session in enumerate(sessions)))
+        if self.log_file is not None:
+            self.log_file.close()
+        return dict(
+            self.stats,
+            sessions=len(sessions),
+            elapsed_s=round(time.perf_counter() - started, 3),
+            rtt_ms=percentiles(self.rtt),
+            delivery_ms=percentiles(self.delivery),
+        )
+
+
+def run_headless(argv=None):
+    """Run scripted sessions and print a JSON summary"""
+    parser = argparse.ArgumentParser(
+        description='Chat client. Without --headless it runs interactively.',
+        epilog='Script lines are sent as typed, after login. {user}, {session} and {i} '
+               '(the !repeat counter) are substituted. Directives: !sleep SECONDS, '
+               '!expect TEXT, !repeat COUNT INTERVAL LINE. Lines starting with # are skipped.'
+    )
+    parser.add_argument('--headless', action='store_true', help='run scripted sessions instead of the interactive client')
+    parser.add_argument('--script', default='-', help="script file, '-' for stdin (default)")
+    parser.add_argument('--sessions', type=int, default=1, help='concurrent sessions')
+    parser.add_argument('--first', type=int, default=0, help='index of the first session')
+    parser.add_argument('--user-prefix', default='user', help='usernames are <prefix><index>')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--register', action='store_true', help='REGISTER before LOGIN (an existing user is fine)')
+    parser.add_argument('--ramp', type=float, default=1.0, help='seconds over which sessions connect')
+    parser.add_argument('--linger', type=float, default=1.0, help='seconds to keep receiving after the script')
+    parser.add_argument('--no-reconnect', dest='reconnect', action='store_false', help='stop a session when its connection drops')
+    parser.add_argument('--no-stamp', dest='stamp', action='store_false', help='do not tag chat lines for latency measurement')
+    parser.add_argument('--log', help='write every sent (>) and received (<) line with a timestamp to this file')
+    parser.add_argument('--output', help='write the JSON summary here instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.script == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.script) as f:
+            text = f.read()
+    try:
+        summary = asyncio.run(HeadlessRunner(args, parse_script(text)).run())
+    except KeyboardInterrupt:
+        return
+    result = json.dumps(summary, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+    else:
+        print(result)
+
+
 if __name__ == '__main__':
-    client = ChatClient()
-    client.start()
+    if '--headless' in sys.argv[1:] or '-h' in sys.argv[1:] or '--help' in sys.argv[1:]:
+        run_headless()
+    else:
+        client = ChatClient()
+        client.start()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+In-process metrics for the chat server, exposed in Prometheus text format
+
+Counters, gauges and histograms are plain Python objects; recording is a
+lock acquire plus an addition (a bisect for histograms), so it stays on the
+hot paths. When METRICS_PORT is set, a daemon thread serves GET /metrics.
+"""
+
+import abc
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # 0 disables the endpoint
+
+# Seconds, from 50 us to 10 s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+REGISTRY = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """The child for one combination of label values"""
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """A new child recording one combination of label values"""
+
+    def _default(self):
+        # Metrics without labels record on their only child
+        return self.labels()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self.children.items()):
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self, name, label_names, values):
+        return [f'{name}{_format_labels(label_names, values)} {_format_value(self.value)}']
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function() at scrape time"""
+        self.function = function
+
+    def render(self, name, label_names, values):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                return []
+        return [f'{name}{_format_labels(label_names, values)} {_format_value(value)}']
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, set directly or read from a function"""
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class _Timer:
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the seconds spent inside it"""
+        return _Timer(self)
+
+    def render(self, name, label_names, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(label_names, values, ('le', _format_value(float(bound))))
+            lines.append(f'{name}_bucket{labels} {cumulative}')
+        labels = _format_labels(label_names, values)
+        lines.append(f'{name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{name}_count{labels} {cumulative}')
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class TimedLock:
+    """threading.Lock that records how long callers waited to acquire it"""
+
+    def __init__(self, histogram):
+        self._lock = threading.Lock()
+        self._observe = histogram.labels().observe
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        self._observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+        return False
+
+
+def render():
+    """Every registered metric in Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /metrics from a daemon thread; returns the server, or None if disabled"""
+    if not port:
+        return None
+    try:
+        httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        print(f"[Error] Metrics endpoint on {host}:{port} failed: {e}")
+        return None
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"[Server] Metrics on http://{host}:{port}/metrics")
+    return httpd
+
+
+# Chat server metrics, shared by both engines
+COMMAND_SECONDS = Histogram(
+    'chat_command_seconds', 'Time to handle one client line, by command', ('command',))
+FANOUT_RECIPIENTS = Histogram(
+    'chat_fanout_recipients', 'Local recipients of one broadcast', ('type',), buckets=SIZE_BUCKETS)
+FANOUT_SECONDS = Histogram(
+    'chat_fanout_seconds', 'Time to queue one broadcast for its local recipients', ('type',))
+REDIS_SECONDS = Histogram(
+    'chat_redis_seconds', 'Redis round-trip time, by command', ('command',))
+BCRYPT_SECONDS = Histogram(
+    'chat_bcrypt_seconds', 'Password hash or check time including queueing', ('op',))
+LOCK_WAIT_SECONDS = Histogram(
+    'chat_clients_lock_wait_seconds', 'Time spent waiting for clients_lock')
+PUBLISH_BATCH_SIZE = Histogram(
+    'chat_publish_batch_size', 'Messages per publish pipeline', buckets=SIZE_BUCKETS)
+PUBLISHED = Counter('chat_published_total', 'Messages published to Redis, by type', ('type',))
+RECEIVED = Counter('chat_received_total', 'Messages received from Redis Pub/Sub, by type', ('type',))
+RATE_LIMITED = Counter('chat_rate_limited_total', 'Requests refused by a rate limit, by scope', ('scope',))
+OUTBOUND_DROPPED = Counter('chat_outbound_dropped_total', 'Messages dropped for slow consumers')
+SLOW_CONSUMER_DISCONNECTS = Counter('chat_slow_consumer_disconnects_total', 'Connections cut because their queue overflowed')
+IDLE_DISCONNECTS = Counter('chat_idle_disconnects_total', 'Connections closed after IDLE_TIMEOUT without a line')
+CONNECTIONS = Gauge('chat_connections', 'Open client connections')
+SESSIONS = Gauge('chat_sessions', 'Logged-in local sessions')
+CHANNELS = Gauge('chat_pubsub_channels', 'Redis Pub/Sub channels subscribed')
+THREADS = Gauge('chat_threads', 'Live threads in the server process')
@@ -4,14 +4,24 @@ Thread-Based Chat Server with Authentication, Rooms, Pub-Sub, Redis, and TLS
 CS60008 - Internet Architecture and Protocols
 """
 
+import json
 import socket
 import threading
 import ssl
-import json
 import bcrypt
 import redis
+import wire
+import metrics
+import sharding
 import os
 import uuid
+import time
+import multiprocessing
+import signal
+import subprocess
+import sys
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import datetime
 
 # Configuration
@@ -19,147 +29,1305 @@ HOST = os.getenv('SERVER_HOST', '0.0.0.0')
 PORT = int(os.getenv('SERVER_PORT', 9999))
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+REDIS_NODES = sharding.parse_nodes(os.getenv('REDIS_NODES', f'{REDIS_HOST}:{REDIS_PORT}'))  # data shards, host:port,...
+REDIS_PUBSUB_NODE = sharding.parse_nodes(os.getenv('REDIS_PUBSUB_NODE', sharding.node_name(REDIS_NODES[0])))[0]
 USE_TLS = os.getenv('USE_TLS', 'true').lower() == 'true'
 CERT_FILE = os.getenv('CERT_FILE', 'server.crt')
 KEY_FILE = os.getenv('KEY_FILE', 'server.key')
+TLS_HANDSHAKE_TIMEOUT = float(os.getenv('TLS_HANDSHAKE_TIMEOUT', 10))
+TLS_SESSION_TICKETS = int(os.getenv('TLS_SESSION_TICKETS', 2))  # TLS 1.3 tickets per handshake, 0 disables
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))  # bcrypt cost factor for new hashes
+BCRYPT_WORKERS = int(os.getenv('BCRYPT_WORKERS', os.cpu_count() or 1))  # 0 hashes inline
+BCRYPT_MAX_PENDING = int(os.getenv('BCRYPT_MAX_PENDING', 64))  # queued + running hashes before rejecting
+PARENT_CHECK_INTERVAL = 1  # seconds between a hash worker's checks that the server is still alive
+MAX_LINE_LENGTH = int(os.getenv('MAX_LINE_LENGTH', 8192))  # bytes per protocol line
+RECV_BUFFER_SIZE = 65536
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', 50))  # entries per /rooms or /subscriptions page
+SERVER_MODE = os.getenv('SERVER_MODE', 'threads').lower()  # threads or asyncio
+SUBSCRIBER_CACHE_SIZE = int(os.getenv('SUBSCRIBER_CACHE_SIZE', 10000))
+SUBSCRIBER_CACHE_TTL = float(os.getenv('SUBSCRIBER_CACHE_TTL', 60))
+ROUTE_CACHE_SIZE = int(os.getenv('ROUTE_CACHE_SIZE', 10000))  # users whose server is remembered for /msg
+ROUTE_CACHE_TTL = float(os.getenv('ROUTE_CACHE_TTL', 5))  # seconds a user -> server lookup is reused
+INBOX_SIZE = int(os.getenv('INBOX_SIZE', 100))  # direct messages kept for an offline user
+OUTBOUND_QUEUE_SIZE = int(os.getenv('OUTBOUND_QUEUE_SIZE', 1000))  # messages per connection
+SLOW_CONSUMER_POLICY = os.getenv('SLOW_CONSUMER_POLICY', 'drop_oldest').lower()  # drop_oldest or disconnect
+CLOSE_FLUSH_TIMEOUT = float(os.getenv('CLOSE_FLUSH_TIMEOUT', 5))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 10))  # seconds shutdown waits for handlers to end their sessions
+WRITE_BATCH_BYTES = int(os.getenv('WRITE_BATCH_BYTES', 65536))  # queued messages joined into one send, up to this size
+PUBLISH_WINDOW_MS = float(os.getenv('PUBLISH_WINDOW_MS', 2))  # max wait to coalesce publishes, 0 publishes directly
+PUBLISH_BATCH_SIZE = int(os.getenv('PUBLISH_BATCH_SIZE', 100))  # publishes per pipeline flush
+PUBLISH_MAX_PENDING = int(os.getenv('PUBLISH_MAX_PENDING', 10000))  # queued publishes before senders wait
+ROOM_HISTORY_MAXLEN = int(os.getenv('ROOM_HISTORY_MAXLEN', 1000))  # messages kept per room (approximate), 0 disables history
+HISTORY_ON_JOIN = int(os.getenv('HISTORY_ON_JOIN', 20))  # messages replayed after /join, 0 disables
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 50))  # stream entries read per round trip while replaying
+HISTORY_DEFAULT = 20  # /history without a count
+TAKEOVER_TIMEOUT = float(os.getenv('TAKEOVER_TIMEOUT', 3))  # seconds to wait for another server to end a session
+TAKEOVER_ACK_TTL = 30  # seconds an unclaimed takeover acknowledgement is kept
+IDLE_TIMEOUT = float(os.getenv('IDLE_TIMEOUT', 120))  # seconds without a line (heartbeats count) before closing, 0 disables
+SESSION_TTL = int(os.getenv('SESSION_TTL', 90))  # seconds a session outlives its server's last refresh, 0 disables
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', 60))  # seconds between stale room member sweeps, 0 disables
+SESSION_REFRESH_BATCH = 1000  # session TTLs refreshed per pipeline
+RECONCILE_BATCH = 500  # room members checked per pipeline
+USER_MSG_RATE = float(os.getenv('USER_MSG_RATE', 50))  # lines per second per user, 0 disables
+USER_MSG_BURST = int(os.getenv('USER_MSG_BURST', 100))
+ROOM_MSG_RATE = float(os.getenv('ROOM_MSG_RATE', 500))  # messages per second per room on this server, 0 disables
+ROOM_MSG_BURST = int(os.getenv('ROOM_MSG_BURST', 1000))
+CONNECT_RATE = float(os.getenv('CONNECT_RATE', 200))  # new connections per second on this server, 0 disables
+CONNECT_BURST = int(os.getenv('CONNECT_BURST', 500))
+LOGIN_RATE = float(os.getenv('LOGIN_RATE', 50))  # LOGIN/REGISTER attempts per second on this server, 0 disables
+LOGIN_BURST = int(os.getenv('LOGIN_BURST', 100))
+RATE_LIMIT_KEYS = 10000  # buckets kept per limiter before idle ones are pruned
+WORKERS = int(os.getenv('WORKERS', 1))  # server processes sharing PORT, >1 runs a supervisor
+REUSE_PORT = os.getenv('REUSE_PORT', 'false').lower() == 'true'  # bind with SO_REUSEPORT
+WORKER_RESTART_DELAY = 1  # seconds before a crashed worker is started again
+PUBSUB_POLL_INTERVAL = 0.01  # seconds the subscriber thread waits for a message before applying queued (un)subscribes
 
-class ChatServer:
-    def __init__(self):
-        # Redis connection
-        self.redis_client = redis.Redis(
-            host=REDIS_HOST,
-            port=REDIS_PORT,
-            decode_responses=True
-        )
-        self.redis_pubsub = self.redis_client.pubsub()
+
+WELCOME_TEXT = (
+    "=== Chat Server ===\n"
+    "Commands: REGISTER <username> <password> or LOGIN <username> <password>\n"
+)
+
+RATE_LIMITED_TEXT = "ERROR: rate limited\n"
+SESSION_EXPIRED_TEXT = "ERROR: Session expired. Please reconnect and LOGIN again.\n"
+LINE_TOO_LONG_TEXT = f"ERROR: Line too long (max {MAX_LINE_LENGTH} bytes)\n"
+
+# Heartbeat accepted before and after LOGIN; any line resets the idle timer
+HEARTBEAT_COMMAND = '/ping'
+HEARTBEAT_REPLY = "PONG\n"
+IDLE_TIMEOUT_TEXT = "[SYSTEM] Closing idle connection\n"
+
+COMMANDS_HINT = "Commands: /join <room>, /leave, /rooms, /history, /msg <user> <text>, /subscribe <user>, /unsubscribe <user>, /subscriptions, /help, /quit\n"
+
+# Metrics label values for client lines; anything else is 'unknown'
+AUTH_COMMANDS = ('REGISTER', 'LOGIN')
+CHAT_COMMANDS = ('/join', '/leave', '/rooms', '/history', '/msg', '/subscribe', '/unsubscribe',
+                 '/subscriptions', '/ping', '/help', '/quit')
+
+HELP_TEXT = """
+Available commands:
+  /join <room>             - Join a chat room
+  /leave                   - Leave current room
+  /rooms [cursor]          - List rooms with member counts
+  /history [n]             - Show the last n messages of your room
+  /msg <user> <text>       - Send a direct message (kept until next login if offline)
+  /subscribe <user>        - Subscribe to a user's messages
+  /unsubscribe <user>      - Unsubscribe from a user
+  /subscriptions [cursor]  - List your subscriptions
+  /ping                    - Heartbeat, answered with PONG (keeps an idle connection open)
+  /help                    - Show this help
+  /quit                    - Disconnect
+"""
+
+
+# Session and room transitions run as Lua scripts. Keys are sharded by user
+# or room (see sharding.py): when the rooms involved live on the node of the
+# user's session hash, one script on that node updates the session, room:*
+# and the node's rooms registry atomically. A room on another node is
+# updated by ROOM_MEMBER_LUA there, joined before the session script and left
+# after it, so a failure in between leaves only extra members, which the
+# stale member sweep (_reconcile_rooms) removes.
+
+ROOMS_REGISTRY = 'rooms'  # sorted set on every node: its rooms -> current member count
+RECONCILE_LOCK = 'reconcile:rooms'  # held by the server running the stale member sweep
+SUBSCRIPTIONS_INDEXED = 'subscriptions-indexed'  # set on every node once its subscribers:* sets are in subscriptions:*
+
+# Prepended to the scripts that move room members. move_member keeps
+# room:<name> and this node's registry in step; here(first, room) is room if
+# it is among ARGV[first..], the rooms the caller found on this node, else ''.
+ROOM_MEMBER_FUNCTIONS = """
+local function move_member(username, old_room, new_room)
+    if old_room ~= '' and redis.call('SREM', 'room:' .. old_room, username) == 1 then
+        if tonumber(redis.call('ZINCRBY', 'rooms', -1, old_room)) <= 0 then
+            redis.call('ZREM', 'rooms', old_room)
+        end
+    end
+    if new_room ~= '' and redis.call('SADD', 'room:' .. new_room, username) == 1 then
+        redis.call('ZINCRBY', 'rooms', 1, new_room)
+    end
+end
+local function here(first, room)
+    for i = first, #ARGV do
+        if ARGV[i] == room then
+            return room
+        end
+    end
+    return ''
+end
+"""
+
+# KEYS: room:<room to leave> and/or room:<room to join>, on one node
+# ARGV: username, room to leave ('' if none), room to join ('' if none)
+ROOM_MEMBER_LUA = ROOM_MEMBER_FUNCTIONS + """
+move_member(ARGV[1], ARGV[2], ARGV[3])
+"""
+
+# KEYS: room:<room>, on its node
+# ARGV: room, usernames to drop
+# Returns how many were members. Used by the stale member sweep.
+DROP_ROOM_MEMBERS_LUA = """
+local removed = redis.call('SREM', KEYS[1], unpack(ARGV, 2))
+if removed > 0 and tonumber(redis.call('ZINCRBY', 'rooms', -removed, ARGV[1])) <= 0 then
+    redis.call('ZREM', 'rooms', ARGV[1])
+end
+return removed
+"""
+
+# KEYS: session:<user>, subscriptions:<user>, room:* of the rooms on this node
+# ARGV: username, server_id, login_time, session_id, first room, TTL (0 for
+# none), rooms on this node
+# Returns {room of a session it replaced or '', the user's subscriptions}
+# so login needs no extra round trip. The owning server keeps pushing the
+# TTL back while the connection lives (see _refresh_sessions).
+CREATE_SESSION_LUA = ROOM_MEMBER_FUNCTIONS + """
+local old_room = redis.call('HGET', KEYS[1], 'room') or ''
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'username', ARGV[1], 'server_id', ARGV[2], 'room', ARGV[5],
+           'login_time', ARGV[3], 'session_id', ARGV[4])
+if tonumber(ARGV[6]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[6])
+end
+move_member(ARGV[1], here(7, old_room), here(7, ARGV[5]))
+return {old_room, redis.call('SMEMBERS', KEYS[2])}
+"""
+
+# KEYS: session:<user>, room:* of the rooms on this node
+# ARGV: owning server_id, owning session_id ('' and '' to remove
+# unconditionally), calling server_id, username, rooms on this node
+# Returns nil if nothing was removed, else {room the user was in, server to
+# tell that its session ended ('' if none), that session's id}. Only an
+# unconditional removal of another server's session needs telling.
+REMOVE_SESSION_LUA = ROOM_MEMBER_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local session = redis.call('HMGET', KEYS[1], 'server_id', 'session_id', 'room')
+if ARGV[1] ~= '' and (session[1] ~= ARGV[1] or session[2] ~= ARGV[2]) then
+    return nil
+end
+redis.call('DEL', KEYS[1])
+local room = session[3] or 'lobby'
+move_member(ARGV[4], here(5, room), '')
+local owner = session[1] or ''
+if ARGV[1] ~= '' or owner == ARGV[3] then
+    owner = ''
+end
+return {room, owner, session[2] or ''}
+"""
+
+# KEYS: session:<user>, room:* of the rooms on this node
+# ARGV: username, new room, rooms on this node
+# Returns the previous room ('' if none), or nil if the session is gone.
+JOIN_ROOM_LUA = ROOM_MEMBER_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local old_room = redis.call('HGET', KEYS[1], 'room') or ''
+redis.call('HSET', KEYS[1], 'room', ARGV[2])
+move_member(ARGV[1], here(3, old_room), here(3, ARGV[2]))
+return old_room
+"""
+
+# KEYS: session:<user>, room:* of the rooms on this node
+# ARGV: username, rooms on this node
+# Returns the room that was left ('' if none), or nil if the session is gone.
+LEAVE_ROOM_LUA = ROOM_MEMBER_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local old_room = redis.call('HGET', KEYS[1], 'room') or ''
+if old_room ~= '' then
+    redis.call('HSET', KEYS[1], 'room', '')
+    move_member(ARGV[1], here(2, old_room), '')
+end
+return old_room
+"""
+
+# KEYS: user:<target>, session:<target>, inbox:<target>
+# ARGV: inbox entry, inbox size, server_id to skip ('' for none)
+# Returns the server holding the target's session, '' once the entry is in
+# the inbox instead, or nil if the user does not exist.
+SEND_DIRECT_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local owner = redis.call('HGET', KEYS[2], 'server_id')
+if owner and owner ~= ARGV[3] then
+    return owner
+end
+redis.call('RPUSH', KEYS[3], ARGV[1])
+redis.call('LTRIM', KEYS[3], -tonumber(ARGV[2]), -1)
+return ''
+"""
+
+
+
+def parse_cursor(parts):
+    """Cursor argument of a paged listing command: 0 if absent, None if invalid"""
+    if len(parts) < 2:
+        return 0
+    try:
+        cursor = int(parts[1])
+    except ValueError:
+        return None
+    return cursor if cursor >= 0 else None
+
+
+def format_rooms_page(rooms, cursor):
+    """Render one ZSCAN page of the rooms registry"""
+    if not rooms:
+        return f"No more rooms, continue with: /rooms {cursor}\n" if cursor else "No rooms available\n"
+    text = "Available rooms: " + ', '.join(f"{name} ({int(count)})" for name, count in rooms) + "\n"
+    if cursor:
+        text += f"More rooms: /rooms {cursor}\n"
+    return text
+
+
+def format_subscriptions_page(publishers, cursor):
+    """Render one SSCAN page of a user's subscriptions"""
+    if not publishers:
+        if cursor:
+            return f"No more subscriptions, continue with: /subscriptions {cursor}\n"
+        return "You have no subscriptions\n"
+    text = f"You are subscribed to: {', '.join(publishers)}\n"
+    if cursor:
+        text += f"More subscriptions: /subscriptions {cursor}\n"
+    return text
+
+
+def parse_history_count(parts):
+    """Count argument of /history: HISTORY_DEFAULT if absent, None if invalid"""
+    if len(parts) < 2:
+        return HISTORY_DEFAULT
+    try:
+        count = int(parts[1])
+    except ValueError:
+        return None
+    return min(count, ROOM_HISTORY_MAXLEN) if count > 0 else None
+
+
+def format_history_entry(room, entry_id, fields):
+    """Render one room history entry with the time it was sent"""
+    ts = int(fields.get('ts') or stream_id_key(entry_id)[0])
+    clock = datetime.fromtimestamp(ts / 1000).strftime('%H:%M:%S')
+    return f"[{room} {clock}] {fields.get('sender')}: {fields.get('content')}\n"
+
+
+def room_key(room):
+    """Set of a room's members (the Lua scripts build the same name)"""
+    return f'room:{room}'
+
+def history_key(room):
+    return f'history:{room}'
+
+def stream_id_key(entry_id):
+    """Stream id as a comparable (milliseconds, sequence) tuple"""
+    ms, _, seq = entry_id.partition('-')
+    return int(ms), int(seq or 0)
+
+def next_stream_id(key):
+    """Smallest stream id after a (milliseconds, sequence) tuple, for XRANGE paging"""
+    return f'{key[0]}-{key[1] + 1}'
+
+
+def inbox_key(username):
+    return f'inbox:{username}'
+
+def inbox_entry(data):
+    """Serialized direct message for the inbox of an offline user"""
+    return json.dumps({'sender': data.get('sender'), 'content': data.get('content'), 'ts': data.get('timestamp')})
+
+def format_direct_message(sender, content, clock=None):
+    return f"[DM from {sender} {clock}]: {content}\n" if clock else f"[DM from {sender}]: {content}\n"
+
+def format_inbox(entries):
+    """Render the direct messages stored while a user was offline"""
+    text = f"--- {len(entries)} direct message(s) while you were away ---\n"
+    for raw in entries:
+        entry = json.loads(raw)
+        clock = datetime.fromtimestamp(int(entry.get('ts') or 0) / 1000).strftime('%Y-%m-%d %H:%M:%S')
+        text += format_direct_message(entry.get('sender'), entry.get('content'), clock)
+    return text + "--- End of direct messages ---\n"
+
+
+def takeover_key(session_id):
+    """List the old server pushes to once a taken-over session is closed"""
+    return f'takeover:{session_id}'
+
+
+def command_label(line):
+    """Metrics label for one line from a logged-in client"""
+    if not line.startswith('/'):
+        return 'message'
+    name = line.split(None, 1)[0].lower()
+    return name if name in CHAT_COMMANDS else 'unknown'
+
+
+# Redis Pub/Sub channel names (sharded by interest instead of one firehose)
+def room_channel(room):
+    return f'room:{room}'
+
+def user_channel(username):
+    return f'user:{username}'
+
+def server_channel(server_id):
+    return f'server:{server_id}'
+
+
+def create_server_context():
+    """Build the server TLS context, or None if the certificate is missing"""
+    if not os.path.exists(CERT_FILE) or not os.path.exists(KEY_FILE):
+        print(f"[ERROR] TLS enabled but certificate files not found!")
+        print(f"[ERROR] Looking for: {CERT_FILE}, {KEY_FILE}")
+        return None
+    
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(CERT_FILE, KEY_FILE)
+    
+    # Session resumption: tickets (TLS 1.3 and 1.2) plus OpenSSL's server-side
+    # session cache (TLS 1.2), so reconnecting clients skip the full handshake.
+    # Tickets are encrypted with per-process keys, so resumption works against
+    # the same server process.
+    if TLS_SESSION_TICKETS > 0:
+        context.options &= ~ssl.OP_NO_TICKET
+        context.num_tickets = TLS_SESSION_TICKETS
+    else:
+        context.options |= ssl.OP_NO_TICKET
+        context.num_tickets = 0
+    return context
+
+
+def take_batch(queue, limit=WRITE_BATCH_BYTES):
+    """Pop queued messages, at least one, until limit bytes; joined for one write"""
+    data = queue.popleft()
+    if not queue:
+        return data
+    parts = [data]
+    size = len(data)
+    while queue and size + len(queue[0]) <= limit:
+        data = queue.popleft()
+        parts.append(data)
+        size += len(data)
+    return b''.join(parts)
+
+
+def close_socket(sock):
+    """Shut down and close a socket, waking any thread blocked in recv"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except:
+        pass
+    try:
+        sock.close()
+    except:
+        pass
+
+
+class OutboundQueue:
+    """Bounded outbound queue for one connection, drained by its own writer thread"""
+
+    def __init__(self, sock, max_size=OUTBOUND_QUEUE_SIZE, policy=SLOW_CONSUMER_POLICY):
+        self.sock = sock
+        self.max_size = max_size
+        self.policy = policy
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.closing = False
+        self.dropped = 0
+        self.close_timer = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def send(self, data, block=False):
+        """
+        Queue bytes for the peer. Broadcasts never block: on overflow the
+        oldest message is dropped or the connection is cut, per policy.
+        Replies to the client's own commands block until there is room.
+        Returns False if the data was not queued.
+        """
+        with self.cond:
+            if block:
+                while len(self.queue) >= self.max_size and not self.closing:
+                    self.cond.wait()
+            if self.closing:
+                return False
+            if len(self.queue) >= self.max_size:
+                if self.policy == 'disconnect':
+                    print(f"[Slow Consumer] Disconnecting peer with {len(self.queue)} queued messages")
+                    metrics.SLOW_CONSUMER_DISCONNECTS.inc()
+                    self._abort_locked()
+                    return False
+                self.queue.popleft()
+                self.dropped += 1
+                metrics.OUTBOUND_DROPPED.inc()
+            self.queue.append(data)
+            self.cond.notify_all()
+            return True
+
+    def close(self, timeout=CLOSE_FLUSH_TIMEOUT):
+        """Flush what is already queued, then close the socket"""
+        with self.cond:
+            if self.closing:
+                return
+            self.closing = True
+            # A stalled peer must not hold the connection open forever
+            self.close_timer = threading.Timer(timeout, self.abort)
+            self.close_timer.daemon = True
+            self.cond.notify_all()
+        self.close_timer.start()
+
+    def abort(self):
+        """Discard anything queued and close the socket now"""
+        with self.cond:
+            self._abort_locked()
+
+    def _abort_locked(self):
+        self.closing = True
+        self.queue.clear()
+        self.cond.notify_all()
+        close_socket(self.sock)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing:
+                    self.cond.wait()
+                if not self.queue:
+                    break
+                # Everything queued goes out in one sendall (one TLS record
+                # per 16 KB) instead of one per message
+                data = take_batch(self.queue)
+                self.cond.notify_all()
+            try:
+                self.sock.sendall(data)
+            except Exception:
+                self.abort()
+                break
+        if self.close_timer:
+            self.close_timer.cancel()
+        close_socket(self.sock)
+
+
+class PublishBatcher:
+    """
+    Coalesces publishes from every connection thread into pipelined batches.
+    A batch is flushed once its oldest message has waited `window` seconds
+    or `batch_size` messages are queued, whichever comes first.
+    """
+
+    def __init__(self, redis_client, window=PUBLISH_WINDOW_MS / 1000,
+                 batch_size=PUBLISH_BATCH_SIZE, max_pending=PUBLISH_MAX_PENDING):
+        self.redis_client = redis_client
+        self.window = window
+        self.batch_size = max(1, batch_size)
+        self.max_pending = max(self.batch_size, max_pending)
+        self.pending = deque()  # (enqueue time, channel, payload, history)
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = None
+        if self.window > 0:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def publish(self, channel, payload, history=None):
+        """
+        Queue a publish; waits only when max_pending publishes are queued.
+        `history` is an optional (stream key, fields) entry appended before
+        publishing, whose id is then stamped on the payload.
+        """
+        if self.thread is None:
+            self._flush([(None, channel, payload, history)])
+            return
+        with self.cond:
+            while len(self.pending) >= self.max_pending and self.running:
+                self.cond.wait()
+            self.pending.append((time.monotonic(), channel, payload, history))
+            # Wake the flusher to start a window or to flush a full batch
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.cond.notify_all()
+
+    def close(self, timeout=CLOSE_FLUSH_TIMEOUT):
+        """Flush what is queued and stop the flusher thread"""
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and self.running:
+                    self.cond.wait()
+                if not self.pending:
+                    break
+                # Messages queued while the last batch was in flight have
+                # already waited, so the window runs from the oldest one
+                while len(self.pending) < self.batch_size and self.running:
+                    remaining = self.pending[0][0] + self.window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                count = min(len(self.pending), self.batch_size)
+                batch = [self.pending.popleft() for _ in range(count)]
+                self.cond.notify_all()
+            self._flush(batch)
+
+    def _flush(self, batch):
+        metrics.PUBLISH_BATCH_SIZE.observe(len(batch))
+        try:
+            payloads = self._append_history(batch)
+            pipe = self.redis_client.pipeline(transaction=False)
+            for (_, channel, _, _), payload in zip(batch, payloads):
+                pipe.publish(channel, payload)
+            with metrics.REDIS_SECONDS.labels('PIPELINE').time():
+                pipe.execute()
+        except Exception as e:
+            print(f"[Redis Pub Error] Dropped {len(batch)} messages: {e}")
+
+    def _append_history(self, batch):
+        """XADD the batch's history entries in one pipeline; returns payloads with ids"""
+        payloads = [payload for _, _, payload, _ in batch]
+        appends = [(i, history) for i, (_, _, _, history) in enumerate(batch) if history]
+        if appends:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for _, (key, fields) in appends:
+                pipe.xadd(key, fields, maxlen=ROOM_HISTORY_MAXLEN, approximate=True)
+            with metrics.REDIS_SECONDS.labels('PIPELINE').time():
+                entry_ids = pipe.execute()
+            for (i, _), entry_id in zip(appends, entry_ids):
+                payloads[i] = wire.attach_id(payloads[i], entry_id)
+        return payloads
+
+
+class LineTooLong(Exception):
+    """Raised when a client sends more than MAX_LINE_LENGTH bytes without a newline"""
+
+
+class LineReader:
+    """
+    Buffered newline-framed reader over a socket. Every complete line in a
+    recv() is handed out in one pass, so clients may pipeline commands and
+    a command split across segments is reassembled.
+    """
+
+    def __init__(self, sock, max_line=MAX_LINE_LENGTH):
+        self.sock = sock
+        self.max_line = max_line
+        self.buffer = b''
+
+    def lines(self):
+        """Yield stripped, non-empty lines until the peer closes"""
+        while True:
+            data = self.sock.recv(RECV_BUFFER_SIZE)
+            if not data:
+                return
+            self.buffer += data
+            if b'\n' in data:
+                *batch, self.buffer = self.buffer.split(b'\n')
+                for raw in batch:
+                    if len(raw) > self.max_line:
+                        raise LineTooLong()
+                    line = raw.decode(errors='replace').strip()
+                    if line:
+                        yield line
+            # Checked after the complete lines went out, so they are not lost
+            # to an over-long fragment that follows them in the same recv()
+            if len(self.buffer) > self.max_line:
+                raise LineTooLong()
+
+
+class Overloaded(Exception):
+    """Raised when a bounded worker pool has no room for more work"""
+
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check_password(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+def _exit_with_parent(parent_pid):
+    """Pool worker initializer: exit once the server process is gone, even if it was killed"""
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(PARENT_CHECK_INTERVAL)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+class HashPool:
+    """
+    Bounded process pool for bcrypt. Hashing runs on every core despite the
+    GIL, and once max_pending jobs are queued or running new requests are
+    rejected immediately instead of piling up behind a login storm.
+    """
+
+    def __init__(self, workers=BCRYPT_WORKERS, max_pending=BCRYPT_MAX_PENDING, rounds=BCRYPT_ROUNDS):
+        self.rounds = rounds
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.executor = None
+        if workers > 0:
+            # spawn, not fork: the server already runs threads
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_exit_with_parent,
+                initargs=(os.getpid(),)
+            )
+
+    def submit(self, fn, *args):
+        """Schedule fn(*args), returning a concurrent.futures.Future"""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise Overloaded(f"{self.pending} password hashes already pending")
+            self.pending += 1
         
+        if self.executor is None:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            try:
+                future = self.executor.submit(fn, *args)
+            except Exception:
+                self._done(None)
+                raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, _future):
+        with self.lock:
+            self.pending -= 1
+
+    def _timed(self, op, fn, *args):
+        start = time.perf_counter()
+        future = self.submit(fn, *args)
+        observe = metrics.BCRYPT_SECONDS.labels(op).observe
+        future.add_done_callback(lambda _future: observe(time.perf_counter() - start))
+        return future
+
+    def hash_password(self, password):
+        return self._timed('hash', _hash_password, password.encode(), self.rounds)
+
+    def check_password(self, password, hashed):
+        return self._timed('check', _check_password, password.encode(), hashed.encode())
+
+    def calibrate(self):
+        """Time one hash at the configured cost, after warming up a worker"""
+        self.submit(_hash_password, b'warmup', 4).result()
+        start = time.perf_counter()
+        self.hash_password('calibration').result()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"[Server] bcrypt cost {self.rounds}: {elapsed_ms:.0f} ms per hash, "
+              f"up to {self.max_pending} pending")
+        return elapsed_ms
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SubscriberCache:
+    """Bounded LRU cache of publisher -> subscriber usernames with TTL"""
+
+    def __init__(self, max_size=SUBSCRIBER_CACHE_SIZE, ttl=SUBSCRIBER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # publisher -> (expires_at, subscribers)
+        self.version = 0  # bumped on every invalidation
+        self.lock = threading.Lock()
+
+    def lookup(self, publisher):
+        """Return (subscribers or None on a miss, version to pass to store())"""
+        with self.lock:
+            entry = self.entries.get(publisher)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(publisher)
+                return entry[1], self.version
+            return None, self.version
+
+    def store(self, publisher, subscribers, version):
+        """Cache a loaded subscriber set unless an invalidation raced with the load"""
+        subscribers = frozenset(subscribers)
+        with self.lock:
+            if version == self.version:
+                self.entries[publisher] = (time.monotonic() + self.ttl, subscribers)
+                self.entries.move_to_end(publisher)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return subscribers
+
+    def get(self, publisher, loader):
+        """Return cached subscribers, calling loader() on a miss"""
+        subscribers, version = self.lookup(publisher)
+        if subscribers is None:
+            subscribers = self.store(publisher, loader(), version)
+        return subscribers
+
+    def invalidate(self, publisher):
+        with self.lock:
+            self.version += 1
+            self.entries.pop(publisher, None)
+
+
+class RouteCache:
+    """Bounded LRU cache of username -> server_id holding their session, with TTL"""
+
+    def __init__(self, max_size=ROUTE_CACHE_SIZE, ttl=ROUTE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # username -> (expires_at, server_id)
+        self.lock = threading.Lock()
+
+    def get(self, username):
+        """Cached server for username, or None"""
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(username)
+                return entry[1]
+            return None
+
+    def store(self, username, server_id):
+        with self.lock:
+            self.entries[username] = (time.monotonic() + self.ttl, server_id)
+            self.entries.move_to_end(username)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self.lock:
+            self.entries.pop(username, None)
+
+
+class RateLimiter:
+    """Token buckets by key: `rate` tokens per second, saving up to `burst`"""
+    
+    def __init__(self, rate, burst, max_keys=RATE_LIMIT_KEYS):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.buckets = {}  # key -> [tokens, last refill]
+        self.lock = threading.Lock()
+    
+    def allow(self, key=None):
+        """Take one token from key's bucket; False when it is empty"""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = self.buckets[key] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1
+            return True
+    
+    def _prune(self, now):
+        # A bucket that has refilled completely is the same as a new one
+        idle = [key for key, (tokens, last) in self.buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for key in idle:
+            del self.buckets[key]
+
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client that records the round-trip time of every command"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            metrics.REDIS_SECONDS.labels(str(args[0]).upper()).observe(time.perf_counter() - start)
+
+
+class Connection:
+    """One client connection: socket, session, local room and subscriptions, output queue"""
+    __slots__ = ('sock', 'outbound', 'username', 'session_id', 'room', 'subscriptions', 'last_seen',
+                 'held', 'replayed_until')
+    
+    def __init__(self, sock, outbound):
+        self.sock = sock  # StreamWriter in the asyncio engine
+        self.outbound = outbound
+        self.username = None  # set by create_session
+        self.session_id = None
+        self.room = None
+        self.subscriptions = None  # set of publishers, created on first use
+        self.last_seen = time.monotonic()  # when the client last sent a line
+        self.held = None  # live room messages held back while /join replays history
+        self.replayed_until = None  # id key of the last message that replay sent
+    
+    def __repr__(self):
+        return f'<Connection {self.username or "-"}>'
+
+
+class ChatCore:
+    """
+    What both engines share: local connection state, fan-out to local
+    clients, and every command and session flow.
+
+    A flow is a generator that yields each call that may block (Redis, a
+    reply, a bcrypt result, a sleep) and is sent back its result, so one
+    copy serves both engines: ChatServer's calls have already returned
+    when they are yielded, AsyncChatServer awaits them. Engines run a flow
+    with _run(); flows call each other with `yield from`. An engine
+    provides _run, _reply, _wait, _sleep and _queue_channel_op, and sets
+    redis_client and clients_lock (a no-op in the asyncio engine) before
+    _init_state() and publisher after it.
+    """
+
+    def _init_state(self):
+        """Scripts, local state, caches and limiters over self.redis_client"""
+        self.create_session_script = self.redis_client.register_script(CREATE_SESSION_LUA)
+        self.remove_session_script = self.redis_client.register_script(REMOVE_SESSION_LUA)
+        self.join_room_script = self.redis_client.register_script(JOIN_ROOM_LUA)
+        self.leave_room_script = self.redis_client.register_script(LEAVE_ROOM_LUA)
+        self.send_direct_script = self.redis_client.register_script(SEND_DIRECT_LUA)
+        self.room_member_script = self.redis_client.register_script(ROOM_MEMBER_LUA)
+        self.drop_members_script = self.redis_client.register_script(DROP_ROOM_MEMBERS_LUA)
         # Local state (connections only, sessions in Redis)
-        self.clients = {}  # socket -> (username, session_id)
-        self.clients_lock = threading.Lock()
-        
+        self.connections = {}  # socket (StreamWriter in the asyncio engine) -> Connection
+        self.users = {}  # username -> Connection (logged-in local sessions)
+        self.room_members = {}  # room -> set of Connections (local members only)
+
         # Server identification for multi-instance support
         self.server_id = os.getenv('SERVER_ID', f'server_{os.getpid()}')
-        
-        # Start Redis subscriber thread
+
+        # Pub/Sub channels this server listens on, reference counted by local interest
+        self.channel_refs = {}  # channel -> number of local users needing it
+        self.subscriber_cache = SubscriberCache()
+        self.route_cache = RouteCache()  # /msg target -> server, refreshed on a miss
+
+        # Newest history id delivered per local room, and ids already replayed
+        # after a Pub/Sub reconnect. Guarded by clients_lock: the subscriber
+        # advances them and _set_local_room drops a room's entries
+        self.room_cursors = {}  # room -> (ms, seq)
+        self.replayed_until = {}  # room -> (ms, seq)
+
+        # bcrypt runs in a bounded process pool, off the connection threads or event loop
+        self.hash_pool = HashPool()
+
+        # Admission and flood control, checked before any Redis or bcrypt work
+        self.user_limiter = RateLimiter(USER_MSG_RATE, USER_MSG_BURST)
+        self.room_limiter = RateLimiter(ROOM_MSG_RATE, ROOM_MSG_BURST)
+        self.connect_limiter = RateLimiter(CONNECT_RATE, CONNECT_BURST)
+        self.login_limiter = RateLimiter(LOGIN_RATE, LOGIN_BURST)
         self.running = True
-        self.pubsub_thread = threading.Thread(target=self._redis_subscriber, daemon=True)
-        self.pubsub_thread.start()
-        
-        print(f"[Server {self.server_id}] Initialized")
-        print(f"[Server {self.server_id}] Redis connection: {REDIS_HOST}:{REDIS_PORT}")
-    
-    def _redis_subscriber(self):
-        """Listen for messages from Redis pub/sub"""
-        self.redis_pubsub.subscribe('chat_broadcast')
-        
-        for message in self.redis_pubsub.listen():
-            if not self.running:
-                break
-            
-            if message['type'] == 'message':
+
+        metrics.CONNECTIONS.set_function(lambda: len(self.connections))
+        metrics.SESSIONS.set_function(lambda: len(self.users))
+        metrics.CHANNELS.set_function(lambda: len(self.channel_refs) + 1)  # + this server's own channel
+        metrics.THREADS.set_function(threading.active_count)
+
+    def _ensure_room_registry(self):
+        """Build each node's rooms registry from its room:* sets if it is missing"""
+        for name, node in zip(self.redis_client.node_names, self.redis_client.nodes):
+            if (yield node.exists(ROOMS_REGISTRY)):
+                continue
+            counts = {}
+            cursor = None
+            while cursor != 0:
+                cursor, keys = yield node.scan(cursor or 0, match='room:*', count=1000)
+                for key in keys:
+                    count = yield node.scard(key)
+                    if count:
+                        counts[key.split(':', 1)[1]] = count
+            if counts:
+                yield node.zadd(ROOMS_REGISTRY, counts)
+                print(f"[Server {self.server_id}] Rebuilt rooms registry on {name} ({len(counts)} rooms)")
+
+    def _ensure_subscription_index(self):
+        """
+        Fill subscriptions:<user> from the subscribers:<target> sets of each
+        node not yet indexed. Login reads only the reverse index, so
+        subscriptions made before it existed would stop delivering.
+        """
+        for name, node in zip(self.redis_client.node_names, self.redis_client.nodes):
+            if (yield node.exists(SUBSCRIPTIONS_INDEXED)):
+                continue
+            count = 0
+            cursor = None
+            while cursor != 0:
+                cursor, keys = yield node.scan(cursor or 0, match='subscribers:*', count=1000)
+                for key in keys:
+                    target = key.split(':', 1)[1]
+                    pipe = self.redis_client.pipeline(transaction=False)
+                    members_cursor = None
+                    while members_cursor != 0:
+                        members_cursor, subscribers = yield node.sscan(key, members_cursor or 0, count=1000)
+                        for subscriber in subscribers:
+                            pipe.sadd(f'subscriptions:{subscriber}', target)
+                    count += len(pipe)
+                    yield pipe.execute()
+            yield node.set(SUBSCRIPTIONS_INDEXED, 1)
+            if count:
+                print(f"[Server {self.server_id}] Indexed {count} subscriptions on {name}")
+
+    def _scan_rooms(self, cursor):
+        """
+        One page of the rooms registries, node after node. The cursor is
+        the node's ZSCAN cursor times the node count plus the node index.
+        """
+        nodes = self.redis_client.nodes
+        index, cursor = cursor % len(nodes), cursor // len(nodes)
+        while True:
+            cursor, rooms = yield nodes[index].zscan(ROOMS_REGISTRY, cursor, count=LIST_PAGE_SIZE)
+            if cursor:
+                return cursor * len(nodes) + index, rooms
+            index += 1
+            if index == len(nodes):
+                return 0, rooms
+            if rooms:
+                return index, rooms
+
+    def _housekeeping(self, jobs):
+        """
+        Run periodic (interval, job) pairs on their own intervals; an
+        interval of 0 disables its job. Jobs are flows, or plain methods
+        when they need no I/O.
+        """
+        jobs = [[interval, job, time.monotonic() + interval] for interval, job in jobs if interval > 0]
+        while self.running and jobs:
+            yield self._sleep(max(0, min(due for _, _, due in jobs) - time.monotonic()))
+            for entry in jobs:
+                interval, job, due = entry
+                if due > time.monotonic():
+                    continue
                 try:
-                    data = json.loads(message['data'])
-                    # Only broadcast if this server has the recipient
-                    self._local_broadcast(data)
+                    steps = job()
+                    if steps is not None:
+                        yield from steps
                 except Exception as e:
-                    print(f"[Redis Sub Error] {e}")
-    
+                    print(f"[Housekeeping Error] {job.__name__}: {e}")
+                entry[2] = time.monotonic() + interval
+
+    def _reap_idle(self):
+        """Close connections that sent nothing, not even a heartbeat, for IDLE_TIMEOUT"""
+        deadline = time.monotonic() - IDLE_TIMEOUT
+        for conn in list(self.connections.values()):
+            if conn.last_seen < deadline and not conn.outbound.closing:
+                print(f"[Idle] Closing {conn.username or 'unauthenticated connection'} after {IDLE_TIMEOUT:g}s")
+                metrics.IDLE_DISCONNECTS.inc()
+                self._deliver(conn, IDLE_TIMEOUT_TEXT.encode())
+                self._close_connection(conn)
+
+    def _refresh_sessions(self):
+        """Push back the TTL of every live local session; close the ones already gone"""
+        with self.clients_lock:
+            sessions = [(username, conn.session_id) for username, conn in self.users.items()
+                        if not conn.outbound.closing]
+        for start in range(0, len(sessions), SESSION_REFRESH_BATCH):
+            batch = sessions[start:start + SESSION_REFRESH_BATCH]
+            pipe = self.redis_client.pipeline(transaction=False)
+            for username, _ in batch:
+                pipe.expire(f'session:{username}', SESSION_TTL)
+            refreshed = yield pipe.execute()
+            for (username, session_id), alive in zip(batch, refreshed):
+                if not alive:
+                    self._disconnect_local_user(username, reason="Your session has expired", session_id=session_id)
+
+    def _reconcile_rooms(self):
+        """
+        Drop room members whose session expired (their server died) or is
+        now in another room. One server per interval runs the sweep.
+        """
+        if not (yield self.redis_client.set(RECONCILE_LOCK, self.server_id, nx=True,
+                                            ex=max(1, int(RECONCILE_INTERVAL)))):
+            return
+        dropped = 0
+        for node in self.redis_client.nodes:
+            cursor = None
+            while cursor != 0:
+                cursor, rooms = yield node.zscan(ROOMS_REGISTRY, cursor or 0, count=RECONCILE_BATCH)
+                for room, _ in rooms:
+                    stale = []
+                    members_cursor = None
+                    while members_cursor != 0:
+                        members_cursor, usernames = yield node.sscan(room_key(room), members_cursor or 0,
+                                                                     count=RECONCILE_BATCH)
+                        if usernames:
+                            stale += yield from self._stale_members(room, usernames)
+                    for start in range(0, len(stale), RECONCILE_BATCH):
+                        dropped += yield self.drop_members_script(keys=[room_key(room)],
+                                                                  args=[room] + stale[start:start + RECONCILE_BATCH])
+        if dropped:
+            print(f"[Reconcile] Dropped {dropped} stale room members")
+
+    def _stale_members(self, room, usernames):
+        """The usernames whose session is gone or in another room"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        for username in usernames:
+            pipe.hget(f'session:{username}', 'room')
+        current = yield pipe.execute()
+        return [username for username, their_room in zip(usernames, current) if their_room != room]
+
+    def _catch_up_rooms(self, lost_at):
+        """Deliver room messages that were published while Pub/Sub was down"""
+        if ROOM_HISTORY_MAXLEN <= 0:
+            return
+        with self.clients_lock:
+            rooms = list(self.room_members)
+        for room in rooms:
+            # Rooms with no message since join fall back to the local clock
+            with self.clients_lock:
+                cursor = self.room_cursors.get(room)
+            start = next_stream_id(cursor) if cursor else f'{lost_at}-0'
+            while True:
+                entries = yield self.redis_client.xrange(history_key(room), min=start, count=HISTORY_PAGE_SIZE)
+                for entry_id, fields in entries:
+                    yield from self._local_broadcast({
+                        'type': 'room_message',
+                        'sender': fields.get('sender'),
+                        'content': fields.get('content'),
+                        'room': room,
+                        'id': entry_id
+                    })
+                if len(entries) < HISTORY_PAGE_SIZE:
+                    break
+                start = next_stream_id(stream_id_key(entries[-1][0]))
+            # The same messages may still arrive live on the resubscribed channel
+            with self.clients_lock:
+                if room in self.room_cursors:
+                    self.replayed_until[room] = self.room_cursors[room]
+
+    def _advance_room_cursor(self, room, entry_id):
+        """Record a delivered history id; False if it was already replayed (caller holds clients_lock)"""
+        key = stream_id_key(entry_id)
+        replayed = self.replayed_until.get(room)
+        if replayed is not None and key <= replayed:
+            return False
+        if key > self.room_cursors.get(room, (0, 0)):
+            self.room_cursors[room] = key
+        return True
+
+    def _acquire_channel(self, channel):
+        """Subscribe to a channel when the first local user needs it (caller holds clients_lock)"""
+        count = self.channel_refs.get(channel, 0)
+        self.channel_refs[channel] = count + 1
+        if count == 0:
+            self._queue_channel_op(True, channel)
+
+    def _release_channel(self, channel):
+        """Unsubscribe from a channel when the last local user leaves it (caller holds clients_lock)"""
+        count = self.channel_refs.get(channel, 0)
+        if count <= 1:
+            self.channel_refs.pop(channel, None)
+            if count == 1:
+                self._queue_channel_op(False, channel)
+        else:
+            self.channel_refs[channel] = count - 1
+
     def _local_broadcast(self, data):
         """Broadcast message to local clients only"""
         msg_type = data.get('type')
         sender = data.get('sender')
         content = data.get('content')
         room = data.get('room')
-        
-        with self.clients_lock:
-            for client_sock, client_info in list(self.clients.items()):
-                username = client_info[0]
-                try:
-                    # Check if message is for this user
-                    if msg_type == 'room_message':
-                        # Check if user is in the room
-                        user_room = self.redis_client.hget(f'session:{username}', 'room')
-                        if user_room == room and username != sender:
-                            formatted = f"[{room}] {sender}: {content}\n"
-                            client_sock.sendall(formatted.encode())
-                    
-                    elif msg_type == 'pubsub_message':
-                        # Check if user is subscribed to sender
-                        subscribers = self.redis_client.smembers(f'subscribers:{sender}')
-                        if username in subscribers:
-                            formatted = f"[@{sender}]: {content}\n"
-                            client_sock.sendall(formatted.encode())
-                    
-                    elif msg_type == 'system':
-                        # Optional server-scoped system messages to specific user
-                        target = data.get('target')
-                        target_server = data.get('target_server_id')
-                        if target == username and (not target_server or target_server == self.server_id):
-                            client_sock.sendall(f"[SYSTEM] {content}\n".encode())
-                    
-                    elif msg_type == 'force_logout':
-                        # Force logout only if this server holds the old connection
-                        target = data.get('target')
-                        old_server = data.get('old_server_id')
-                        notice = data.get('content') or "You have been logged out (new login detected)"
-                        if target == username and old_server == self.server_id:
-                            try:
-                                client_sock.sendall(f"[SYSTEM] {notice}\n".encode())
-                            except:
-                                pass
-                            try:
-                                client_sock.close()
-                            except:
-                                pass
-                            self._remove_local_client(client_sock)
-                
-                except Exception as e:
-                    print(f"[Broadcast Error] {username}: {e}")
-    
+
+        if msg_type == 'room_message':
+            entry_id = data.get('id')
+            # Only local members of the room, no Redis lookups per recipient
+            start = time.perf_counter()
+            # Formatted and encoded once; every recipient queues the same bytes
+            payload = f"[{room}] {sender}: {content}\n".encode()
+            key = stream_id_key(entry_id) if entry_id else None
+            with self.clients_lock:
+                if entry_id and not self._advance_room_cursor(room, entry_id):
+                    return
+                members = list(self.room_members.get(room, ()))
+                for conn in members:
+                    if conn.username == sender:
+                        continue
+                    if conn.held is not None:
+                        conn.held.append((key, payload))
+                    elif key is None or conn.replayed_until is None or key > conn.replayed_until:
+                        self._deliver(conn, payload)
+            metrics.FANOUT_SECONDS.labels(msg_type).observe(time.perf_counter() - start)
+            metrics.FANOUT_RECIPIENTS.labels(msg_type).observe(len(members))
+            return
+
+        if msg_type == 'subscribers_changed':
+            self.subscriber_cache.invalidate(data.get('target'))
+            return
+
+        if msg_type == 'direct_message':
+            target = data.get('target')
+            with self.clients_lock:
+                conn = self.users.get(target)
+            if conn is not None:
+                self._deliver(conn, format_direct_message(sender, content).encode())
+            else:
+                # Logged out or moved since the sender looked the user up
+                self.route_cache.invalidate(target)
+                yield from self._route_direct_message(data, skip=self.server_id)
+            return
+
+        if msg_type == 'force_logout':
+            # Only the server holding the old connection acts, then confirms
+            self.route_cache.invalidate(data.get('target'))
+            if data.get('old_server_id') == self.server_id:
+                notice = data.get('content') or "You have been logged out (new login detected)"
+                self._disconnect_local_user(data.get('target'), reason=notice, session_id=data.get('id'))
+                yield from self._ack_takeover(data.get('id'))
+            return
+
+        if msg_type == 'session_ended':
+            # Another server removed one of our sessions (see REMOVE_SESSION_LUA)
+            self.route_cache.invalidate(data.get('target'))
+            self._disconnect_local_user(data.get('target'), reason="Your session has ended", session_id=data.get('id'))
+            return
+
+        if msg_type == 'pubsub_message':
+            # One cached set lookup per message instead of one SMEMBERS per client
+            subscribers, version = self.subscriber_cache.lookup(sender)
+            if subscribers is None:
+                loaded = yield self.redis_client.smembers(f'subscribers:{sender}')
+                subscribers = self.subscriber_cache.store(sender, loaded, version)
+            start = time.perf_counter()
+            with self.clients_lock:
+                if len(subscribers) <= len(self.users):
+                    local = [self.users.get(u) for u in subscribers]
+                else:
+                    local = [conn for u, conn in self.users.items() if u in subscribers]
+                payload = f"[@{sender}]: {content}\n".encode()
+                delivered = 0
+                for conn in local:
+                    if conn is None:
+                        continue
+                    self._deliver(conn, payload)
+                    delivered += 1
+            metrics.FANOUT_SECONDS.labels(msg_type).observe(time.perf_counter() - start)
+            metrics.FANOUT_RECIPIENTS.labels(msg_type).observe(delivered)
+            return
+
+        if msg_type == 'system':
+            # Optional server-scoped system messages to specific user
+            target_server = data.get('target_server_id')
+            if target_server and target_server != self.server_id:
+                return
+            with self.clients_lock:
+                conn = self.users.get(data.get('target'))
+            if conn is not None:
+                self._deliver(conn, f"[SYSTEM] {content}\n".encode())
+
+    def _message(self, msg_type, **fields):
+        """A message from this server, for _publish"""
+        return dict(fields, type=msg_type, server_id=self.server_id, timestamp=wire.now_ms())
+
+    def _channel_for(self, data):
+        """Pick the Pub/Sub channel that reaches only interested servers"""
+        msg_type = data.get('type')
+        if msg_type == 'room_message':
+            return room_channel(data.get('room'))
+        if msg_type == 'pubsub_message':
+            return user_channel(data.get('sender'))
+        if msg_type == 'subscribers_changed':
+            return user_channel(data.get('target'))
+        if msg_type == 'force_logout':
+            return server_channel(data.get('old_server_id'))
+        if msg_type == 'direct_message':
+            return server_channel(data.get('target_server_id'))
+        # System notices go only to the server holding the target session
+        target_server = data.get('target_server_id')
+        if not target_server:
+            target_server = yield self.redis_client.hget(f'session:{data.get("target")}', 'server_id')
+        return server_channel(target_server or self.server_id)
+
+    def _publish(self, data):
+        """Publish a payload on the channel chosen for it (coalesced by the engine's publisher)"""
+        history = None
+        if data.get('type') == 'room_message' and ROOM_HISTORY_MAXLEN > 0:
+            history = (history_key(data.get('room')), {
+                'sender': data.get('sender'),
+                'content': data.get('content'),
+                'ts': data.get('timestamp')
+            })
+        channel = yield from self._channel_for(data)
+        yield self.publisher.publish(channel, wire.encode(data), history)
+        metrics.PUBLISHED.labels(data.get('type')).inc()
+
     def _publish_message(self, msg_type, sender, content, room=None, target=None):
         """Publish message to Redis for cross-server communication"""
-        data = {
-            'type': msg_type,
-            'sender': sender,
-            'content': content,
-            'room': room,
-            'target': target,
-            'server_id': self.server_id,
-            'timestamp': datetime.now().isoformat()
-        }
-        self.redis_client.publish('chat_broadcast', json.dumps(data))
-    
+        yield from self._publish(self._message(msg_type, sender=sender, content=content, room=room, target=target))
+
+    def _route_direct_message(self, data, skip=''):
+        """
+        Publish a direct message to the server holding the target's session,
+        or store it in the target's inbox if there is none (other than skip).
+        Returns the owning server, '' if stored, None if the user does not exist.
+        """
+        target = data.get('target')
+        owner = None if skip else self.route_cache.get(target)
+        if owner is None:
+            owner = yield self.send_direct_script(
+                keys=[f'user:{target}', f'session:{target}', inbox_key(target)],
+                args=[inbox_entry(data), INBOX_SIZE, skip]
+            )
+            if not owner:
+                return owner
+            self.route_cache.store(target, owner)
+        yield from self._publish(dict(data, target_server_id=owner))
+        return owner
+
+    def _deliver_inbox(self, conn, username):
+        """Send and clear the direct messages stored while the user was offline"""
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.lrange(inbox_key(username), 0, -1)
+        pipe.delete(inbox_key(username))
+        entries, _ = yield pipe.execute()
+        if entries:
+            yield self._reply(conn, format_inbox(entries).encode())
+
     def register_user(self, username, password):
         """Register a new user with hashed password"""
-        if self.redis_client.exists(f'user:{username}'):
+        if (yield self.redis_client.exists(f'user:{username}')):
             return False, "Username already exists"
-        
-        # Hash password with bcrypt
-        salt = bcrypt.gensalt()
-        hashed = bcrypt.hashpw(password.encode(), salt)
-        
+
+        # Hash password with bcrypt in the bounded worker pool
+        try:
+            hashed = yield self._wait(self.hash_pool.hash_password(password))
+        except Overloaded:
+            return False, "Server busy, please retry"
+
         # Store in Redis
-        self.redis_client.hset(f'user:{username}', mapping={
+        yield self.redis_client.hset(f'user:{username}', mapping={
             'password': hashed.decode(),
             'created': datetime.now().isoformat()
         })
-        
+
         return True, "Registration successful"
-    
+
     def authenticate(self, username, password):
         """Authenticate user credentials"""
-        user_data = self.redis_client.hgetall(f'user:{username}')
-        
+        user_data = yield self.redis_client.hgetall(f'user:{username}')
+
         if not user_data:
             return False, "Invalid username or password"
-        
-        stored_hash = user_data['password'].encode()
-        
-        if bcrypt.checkpw(password.encode(), stored_hash):
+
+        try:
+            valid = yield self._wait(self.hash_pool.check_password(password, user_data['password']))
+        except Overloaded:
+            return False, "Server busy, please retry"
+
+        if valid:
             return True, "Authentication successful"
-        
+
         return False, "Invalid username or password"
-    
+
     def check_duplicate_login(self, username):
         """
         Check if user is already logged in
@@ -167,357 +1335,745 @@ class ChatServer:
         Returns: (has_existing_session, session_data)
         """
         session_key = f'session:{username}'
-        session_data = self.redis_client.hgetall(session_key)
-        
+        session_data = yield self.redis_client.hgetall(session_key)
+
         if session_data:
             return True, session_data
         return False, None
-    
-    def create_session(self, username, client_socket):
-        """Create user session in Redis"""
-        session_key = f'session:{username}'
-        session_id = uuid.uuid4().hex
-        
-        self.redis_client.hset(session_key, mapping={
-            'username': username,
-            'server_id': self.server_id,
-            'room': 'lobby',
-            'login_time': datetime.now().isoformat(),
-            'session_id': session_id
-        })
-        
-        # Add to lobby by default
-        self.redis_client.sadd('room:lobby', username)
-        
+
+    def create_session(self, username, conn):
+        """Create user session in Redis"""
+        session_key = f'session:{username}'
+        session_id = uuid.uuid4().hex
+
+        # Session hash, subscription lookup and the lobby in one script
+        # when the lobby's set shares the session's node
+        here = self._rooms_here(username, 'lobby')
+        yield from self._join_elsewhere(username, 'lobby', here)
+        old_room, publishers = yield self.create_session_script(
+            keys=[session_key, f'subscriptions:{username}'] + [room_key(room) for room in here],
+            args=[username, self.server_id, datetime.now().isoformat(), session_id, 'lobby', SESSION_TTL] + here
+        )
+        yield from self._leave_elsewhere(username, old_room, 'lobby', here)
+        self.route_cache.invalidate(username)
+
         # Register local connection
         with self.clients_lock:
-            self.clients[client_socket] = (username, session_id)
-    
-    def remove_session(self, username, client_socket=None):
+            conn.username = username
+            conn.session_id = session_id
+            replaced = self.users.get(username)
+            self.users[username] = conn
+            self._set_local_room(conn, 'lobby')
+            for publisher in publishers:
+                self._set_local_subscription(conn, publisher, True)
+        if replaced is not None and replaced is not conn:
+            # A concurrent login on this server slipped past the takeover
+            self._close_connection(replaced)
+            self._remove_local_client(replaced)
+
+    def remove_session(self, username, conn=None):
         """Remove user session from Redis and local state"""
         session_key = f'session:{username}'
-        session_data = self.redis_client.hgetall(session_key)
-        should_delete_redis = False
 
-        if session_data:
-            if client_socket is None:
-                # Administrative cleanup (e.g., duplicate login) - delete regardless of server_id
-                should_delete_redis = True
-            else:
-                # Only delete if this connection owns the active session
-                local_session_id = None
-                with self.clients_lock:
-                    client_info = self.clients.get(client_socket)
-                    if client_info:
-                        local_session_id = client_info[1]
-                if (
-                    session_data.get('server_id') == self.server_id
-                    and local_session_id
-                    and session_data.get('session_id') == local_session_id
-                ):
-                    should_delete_redis = True
-
-        if should_delete_redis and session_data:
-            current_room = session_data.get('room', 'lobby')
-            self.redis_client.srem(f'room:{current_room}', username)
-            self.redis_client.delete(session_key)
-        
+        removed = None
+        if conn is None:
+            # Administrative cleanup (e.g., duplicate login) - delete regardless of server_id
+            removed = yield self.remove_session_script(keys=[session_key], args=['', '', self.server_id, username])
+            here = []
+        else:
+            # Only delete if this connection owns the active session; the
+            # ownership check and delete happen atomically in the script
+            with self.clients_lock:
+                local_session_id = conn.session_id
+                here = self._rooms_here(username, conn.room)
+            if local_session_id:
+                removed = yield self.remove_session_script(
+                    keys=[session_key] + [room_key(room) for room in here],
+                    args=[self.server_id, local_session_id, self.server_id, username] + here
+                )
+        if removed:
+            room, owner, session_id = removed
+            yield from self._leave_elsewhere(username, room, None, here)
+            if owner:
+                # The owning server drops the connection (see REMOVE_SESSION_LUA)
+                yield from self._publish(self._message(
+                    'session_ended', target=username, id=session_id, target_server_id=owner))
+
+        self.route_cache.invalidate(username)
+
         # Remove from local clients
-        if client_socket:
-            self._remove_local_client(client_socket)
+        if conn is not None:
+            self._remove_local_client(conn)
+
+    def _end_session(self, conn):
+        """Remove the session of a closed connection; on failure at least forget it locally"""
+        username = conn.username
+        print(f"[Disconnect] {username}")
+        try:
+            yield from self.remove_session(username, conn)
+        except Exception as e:
+            print(f"[Error] Cleanup for {username}: {e}")
+            # Left registered, the session would be refreshed forever
+            self._remove_local_client(conn)
 
-    def _disconnect_local_user(self, username, reason=None):
-        """Disconnect all local sockets for a username"""
-        sockets = []
+    def _disconnect_local_user(self, username, reason=None, session_id=None):
+        """Disconnect the local connection of a username (if it holds session_id)"""
         with self.clients_lock:
-            for sock, client_info in list(self.clients.items()):
-                if client_info[0] == username:
-                    sockets.append(sock)
-        for sock in sockets:
-            if reason:
-                try:
-                    sock.sendall(f"[SYSTEM] {reason}\n".encode())
-                except:
-                    pass
-            try:
-                sock.close()
-            except:
-                pass
-            self._remove_local_client(sock)
+            conn = self.users.get(username)
+        if conn is None or (session_id and conn.session_id != session_id):
+            return
+        if reason:
+            self._deliver(conn, f"[SYSTEM] {reason}\n".encode())
+        self._close_connection(conn)
+        self._remove_local_client(conn)
+
+    def _take_over_session(self, username, old_session):
+        """
+        End an existing session before a new login replaces it. A session on
+        another server is closed by that server, which acknowledges on the
+        takeover key; we wait at most TAKEOVER_TIMEOUT for it.
+        """
+        old_server = old_session.get('server_id')
+        reason = "You have been logged out (new login from another location)"
+        if old_server == self.server_id:
+            self._disconnect_local_user(username, reason=reason)
+        else:
+            session_id = old_session.get('session_id')
+            yield from self._publish(self._message(
+                'force_logout', target=username, old_server_id=old_server, content=reason, id=session_id))
+            if session_id and not (yield self.redis_client.blpop(takeover_key(session_id), timeout=TAKEOVER_TIMEOUT)):
+                print(f"[Takeover] No acknowledgement from {old_server} for {username} within {TAKEOVER_TIMEOUT}s")
+        # Clean up old session in Redis
+        yield from self.remove_session(username)
+
+    def _ack_takeover(self, session_id):
+        """Tell the server waiting on a takeover that the old session is closed"""
+        if not session_id:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.rpush(takeover_key(session_id), self.server_id)
+        pipe.expire(takeover_key(session_id), TAKEOVER_ACK_TTL)
+        yield pipe.execute()
+
+    def _rooms_here(self, username, *rooms):
+        """The rooms whose room:* set is on the node of the user's session hash"""
+        node = self.redis_client.node_for(f'session:{username}')
+        return [room for room in rooms if room and self.redis_client.node_for(room_key(room)) is node]
+
+    def _join_elsewhere(self, username, new_room, here):
+        """First step of a move across nodes: join a room the session script cannot"""
+        if new_room and new_room not in here:
+            yield self.room_member_script(keys=[room_key(new_room)], args=[username, '', new_room])
+
+    def _leave_elsewhere(self, username, old_room, new_room, here):
+        """Last step of a move across nodes: leave a room the session script could not"""
+        if old_room and old_room != new_room and old_room not in here:
+            yield self.room_member_script(keys=[room_key(old_room)], args=[username, old_room, ''])
+
+    def _deliver(self, conn, data):
+        """Enqueue bytes for a client without blocking the caller"""
+        conn.outbound.send(data)
+
+    def _close_connection(self, conn):
+        """Flush queued output and close, waking the connection's handler"""
+        conn.outbound.close()
+
+    def _close_connections(self):
+        """Close every connection at shutdown; each handler then ends its session"""
+        for conn in list(self.connections.values()):
+            self._close_connection(conn)
+
+    def _replay_history(self, conn, room, count):
+        """
+        Send the last `count` messages of a room, oldest first. Pages are
+        read newest first, so no pass over the stream is spent finding the
+        start. Returns the id key of the newest message sent, None if none.
+        """
+        key = history_key(room)
+        pages = []
+        end = '+'
+        while count > 0:
+            size = min(count, HISTORY_PAGE_SIZE)
+            entries = yield self.redis_client.xrevrange(key, max=end, min='-', count=size)
+            if entries:
+                pages.append(entries)
+            if len(entries) < size:
+                break
+            count -= size
+            end = '(' + entries[-1][0]
+        if not pages:
+            return None
+        yield self._reply(conn, f"--- History of '{room}' ---\n".encode())
+        for entries in reversed(pages):
+            page = ''.join(format_history_entry(room, entry_id, fields) for entry_id, fields in reversed(entries))
+            yield self._reply(conn, page.encode())
+        yield self._reply(conn, b"--- End of history ---\n")
+        return stream_id_key(pages[0][0][0])
+
+    def _end_join_replay(self, conn, replayed_until):
+        """
+        Deliver the live messages held during a join replay that it did not
+        include, and drop later ones it did (caller holds clients_lock)
+        """
+        held, conn.held = conn.held, None
+        conn.replayed_until = replayed_until
+        for key, payload in held or ():
+            if key is None or replayed_until is None or key > replayed_until:
+                self._deliver(conn, payload)
+
+    def _set_local_room(self, conn, room):
+        """Move a connection between local room indexes (caller holds clients_lock)"""
+        old_room, conn.room = conn.room, None
+        conn.held = conn.replayed_until = None
+        if old_room:
+            members = self.room_members.get(old_room)
+            if members is not None:
+                members.discard(conn)
+                if not members:
+                    del self.room_members[old_room]
+                    self._release_channel(room_channel(old_room))
+                    self.room_cursors.pop(old_room, None)
+                    self.replayed_until.pop(old_room, None)
+        if room and self._is_registered(conn):
+            conn.room = room
+            members = self.room_members.setdefault(room, set())
+            if not members:
+                self._acquire_channel(room_channel(room))
+            members.add(conn)
+
+    def _set_local_subscription(self, conn, publisher, subscribed):
+        """Track a local pub-sub subscription (caller holds clients_lock)"""
+        publishers = conn.subscriptions
+        if publishers is None:
+            publishers = conn.subscriptions = set()
+        if subscribed and publisher not in publishers and self._is_registered(conn):
+            publishers.add(publisher)
+            self._acquire_channel(user_channel(publisher))
+        elif not subscribed and publisher in publishers:
+            publishers.discard(publisher)
+            self._release_publisher_channel(publisher)
 
-    def _remove_local_client(self, client_socket):
-        """Remove a client socket from local tracking only"""
+    def _release_publisher_channel(self, publisher):
+        """Release a publisher channel; without it, cache invalidations stop arriving"""
+        channel = user_channel(publisher)
+        self._release_channel(channel)
+        if channel not in self.channel_refs:
+            self.subscriber_cache.invalidate(publisher)
+
+    def _is_registered(self, conn):
+        """True while conn holds its user's local session (caller holds clients_lock)"""
+        return conn.username is not None and self.users.get(conn.username) is conn
+
+    def _forget_local_client(self, conn):
+        """Drop a connection from all local indexes (caller holds clients_lock)"""
+        if self._is_registered(conn):
+            del self.users[conn.username]
+        conn.session_id = None
+        self._set_local_room(conn, None)
+        for publisher in conn.subscriptions or ():
+            self._release_publisher_channel(publisher)
+        conn.subscriptions = None
+
+    def _publish_subscribers_changed(self, publisher):
+        """Tell servers caching this publisher's subscribers to drop the entry"""
+        self.subscriber_cache.invalidate(publisher)
+        yield from self._publish(self._message('subscribers_changed', target=publisher))
+
+    def _remove_local_client(self, conn):
+        """Remove a connection from local tracking only"""
         with self.clients_lock:
-            self.clients.pop(client_socket, None)
-    
-    def handle_client(self, client_socket, client_address):
-        """Handle individual client connection"""
-        print(f"[Connection] New connection from {client_address}")
-        
-        username = None
-        authenticated = False
-        
-        try:
-            # Send welcome message
-            client_socket.sendall(b"=== Chat Server ===\n")
-            client_socket.sendall(b"Commands: REGISTER <username> <password> or LOGIN <username> <password>\n")
-            
-            # Authentication phase
-            while not authenticated:
-                data = client_socket.recv(4096).decode().strip()
-                
-                if not data:
-                    break
-                
-                parts = data.split()
-                
-                if len(parts) < 3:
-                    client_socket.sendall(b"ERROR: Invalid command format\n")
-                    continue
-                
-                command = parts[0].upper()
-                username_input = parts[1]
-                password_input = parts[2]
-                
-                if command == 'REGISTER':
-                    success, message = self.register_user(username_input, password_input)
-                    if success:
-                        client_socket.sendall(f"SUCCESS: {message}\n".encode())
-                        client_socket.sendall(b"Now please LOGIN\n")
-                    else:
-                        client_socket.sendall(f"ERROR: {message}\n".encode())
-                
-                elif command == 'LOGIN':
-                    # Authenticate
-                    success, message = self.authenticate(username_input, password_input)
-                    
-                    if not success:
-                        client_socket.sendall(f"ERROR: {message}\n".encode())
-                        continue
-                    
-                    # Check for duplicate login (Force Logout Policy)
-                    has_duplicate, old_session = self.check_duplicate_login(username_input)
-                    
-                    if has_duplicate:
-                        # Force logout the old session
-                        old_server = old_session.get('server_id')
-                        if old_server == self.server_id:
-                            self._disconnect_local_user(
-                                username_input,
-                                reason="You have been logged out (new login from another location)"
-                            )
-                        else:
-                            self.redis_client.publish('chat_broadcast', json.dumps({
-                                'type': 'force_logout',
-                                'target': username_input,
-                                'old_server_id': old_server,
-                                'content': 'You have been logged out (new login from another location)',
-                                'server_id': self.server_id,
-                                'timestamp': datetime.now().isoformat()
-                            }))
-                        # Give time for message to be delivered
-                        threading.Event().wait(0.5)
-                        # Clean up old session in Redis
-                        self.remove_session(username_input)
-                    
-                    # Create new session
-                    username = username_input
-                    self.create_session(username, client_socket)
-                    authenticated = True
-                    
-                    client_socket.sendall(f"SUCCESS: Welcome {username}! You are in 'lobby'\n".encode())
-                    client_socket.sendall(b"Commands: /join <room>, /leave, /rooms, /subscribe <user>, /unsubscribe <user>, /subscriptions, /help, /quit\n")
-                
-                else:
-                    client_socket.sendall(b"ERROR: Unknown command. Use REGISTER or LOGIN\n")
-            
-            if not authenticated:
-                return
-            
-            # Main message loop
-            while self.running:
-                data = client_socket.recv(4096).decode().strip()
-                
-                if not data:
-                    break
-                
-                # Handle commands
-                if data.startswith('/'):
-                    should_disconnect = self.handle_command(username, client_socket, data)
-                    if should_disconnect:
-                        break
+            self._forget_local_client(conn)
+
+    def _handle_login_line(self, conn, data):
+        """Handle one line before LOGIN; True once the connection is logged in"""
+        conn.last_seen = time.monotonic()
+        if data.lower() == HEARTBEAT_COMMAND:
+            yield self._reply(conn, HEARTBEAT_REPLY.encode())
+            return False
+        parts = data.split()
+
+        if len(parts) < 3:
+            yield self._reply(conn, b"ERROR: Invalid command format\n")
+            return False
+
+        command = parts[0].upper()
+        username = parts[1]
+        password = parts[2]
+
+        if command in AUTH_COMMANDS and not self.login_limiter.allow():
+            metrics.RATE_LIMITED.labels('login').inc()
+            yield self._reply(conn, RATE_LIMITED_TEXT.encode())
+            return False
+
+        # Timed as one command, bcrypt included
+        with metrics.COMMAND_SECONDS.labels(command if command in AUTH_COMMANDS else 'unknown').time():
+            if command == 'REGISTER':
+                success, message = yield from self.register_user(username, password)
+                if success:
+                    yield self._reply(conn, f"SUCCESS: {message}\nNow please LOGIN\n".encode())
                 else:
-                    # Regular message - check current mode
-                    session = self.redis_client.hgetall(f'session:{username}')
-                    if not session:
-                        client_socket.sendall(b"ERROR: Session expired. Please reconnect and LOGIN again.\n")
-                        break
-                    current_room = session.get('room', 'lobby')
-                    
-                    if current_room:
-                        # Room-based messaging
-                        self._publish_message('room_message', username, data, room=current_room)
-                        # Echo to sender
-                        client_socket.sendall(f"[{current_room}] {username}: {data}\n".encode())
-                    else:
-                        # Pub-sub mode
-                        self._publish_message('pubsub_message', username, data)
-                        # Echo to sender
-                        client_socket.sendall(f"[@{username}]: {data}\n".encode())
-        
-        except Exception as e:
-            print(f"[Error] Client {username or client_address}: {e}")
-        
-        finally:
-            if username:
-                print(f"[Disconnect] {username}")
-                self.remove_session(username, client_socket)
-            
-            try:
-                client_socket.close()
-            except:
-                pass
-    
-    def handle_command(self, username, client_socket, command):
-        """Handle client commands"""
+                    yield self._reply(conn, f"ERROR: {message}\n".encode())
+
+            elif command == 'LOGIN':
+                # Authenticate
+                success, message = yield from self.authenticate(username, password)
+
+                if not success:
+                    yield self._reply(conn, f"ERROR: {message}\n".encode())
+                    return False
+
+                # Check for duplicate login (Force Logout Policy)
+                has_duplicate, old_session = yield from self.check_duplicate_login(username)
+
+                if has_duplicate:
+                    # Force logout the old session
+                    yield from self._take_over_session(username, old_session)
+
+                # Create new session; from here on the engine ends it on disconnect
+                yield from self.create_session(username, conn)
+
+                yield self._reply(conn, f"SUCCESS: Welcome {username}! You are in 'lobby'\n{COMMANDS_HINT}".encode())
+                yield from self._deliver_inbox(conn, username)
+                return True
+
+            else:
+                yield self._reply(conn, b"ERROR: Unknown command. Use REGISTER or LOGIN\n")
+        return False
+
+    def _handle_line(self, conn, data):
+        """Handle one line from a logged-in client; True to disconnect"""
+        username = conn.username
+        conn.last_seen = time.monotonic()
+
+        if not self.user_limiter.allow(username):
+            metrics.RATE_LIMITED.labels('user').inc()
+            yield self._reply(conn, RATE_LIMITED_TEXT.encode())
+            return False
+
+        # Handle commands and chat lines, timed per kind of line
+        with metrics.COMMAND_SECONDS.labels(command_label(data)).time():
+            if data.startswith('/'):
+                return (yield from self.handle_command(username, conn, data))
+            return (yield from self.handle_message(username, conn, data))
+
+    def handle_message(self, username, conn, data):
+        """Publish a chat line to the sender's room or subscribers; True to disconnect"""
+        # Room and session validity are local state, kept current by /join,
+        # /leave and force_logout/session_ended notices: no Redis read here
+        with self.clients_lock:
+            registered = self._is_registered(conn)
+            current_room = conn.room
+        if not registered:
+            yield self._reply(conn, SESSION_EXPIRED_TEXT.encode())
+            return True
+
+        if current_room:
+            if not self.room_limiter.allow(current_room):
+                metrics.RATE_LIMITED.labels('room').inc()
+                yield self._reply(conn, RATE_LIMITED_TEXT.encode())
+                return False
+            # Room-based messaging
+            yield from self._publish_message('room_message', username, data, room=current_room)
+            # Echo to sender
+            yield self._reply(conn, f"[{current_room}] {username}: {data}\n".encode())
+        else:
+            # Pub-sub mode
+            yield from self._publish_message('pubsub_message', username, data)
+            # Echo to sender
+            yield self._reply(conn, f"[@{username}]: {data}\n".encode())
+        return False
+
+    def handle_command(self, username, conn, command):
+        """Handle client commands; True to disconnect"""
         parts = command.split()
         cmd = parts[0].lower()
-        
+
         try:
             if cmd == '/join':
                 if len(parts) < 2:
-                    client_socket.sendall(b"ERROR: Usage: /join <room>\n")
-                    return
-                
+                    yield self._reply(conn, b"ERROR: Usage: /join <room>\n")
+                    return False
+
                 room_name = parts[1]
-                session = self.redis_client.hgetall(f'session:{username}')
-                old_room = session.get('room')
-                
-                # Leave old room
-                if old_room:
-                    self.redis_client.srem(f'room:{old_room}', username)
-                
-                # Join new room
-                self.redis_client.sadd(f'room:{room_name}', username)
-                self.redis_client.hset(f'session:{username}', 'room', room_name)
-                
-                client_socket.sendall(f"SUCCESS: Joined room '{room_name}'\n".encode())
-            
+
+                # One script when both rooms share the session's node
+                with self.clients_lock:
+                    here = self._rooms_here(username, conn.room, room_name)
+                yield from self._join_elsewhere(username, room_name, here)
+                old_room = yield self.join_room_script(
+                    keys=[f'session:{username}'] + [room_key(room) for room in here],
+                    args=[username, room_name] + here
+                )
+                if old_room is None:
+                    yield from self._leave_elsewhere(username, room_name, None, here)
+                    yield self._reply(conn, SESSION_EXPIRED_TEXT.encode())
+                    return True
+                yield from self._leave_elsewhere(username, old_room, room_name, here)
+                replay = HISTORY_ON_JOIN > 0 and ROOM_HISTORY_MAXLEN > 0
+                with self.clients_lock:
+                    self._set_local_room(conn, room_name)
+                    if replay and conn.room == room_name:
+                        # The channel is already subscribed: messages arriving
+                        # now may also be in the replay, so they wait for it
+                        conn.held = []
+
+                yield self._reply(conn, f"SUCCESS: Joined room '{room_name}'\n".encode())
+                if replay:
+                    replayed_until = None
+                    try:
+                        replayed_until = yield from self._replay_history(
+                            conn, room_name, min(HISTORY_ON_JOIN, ROOM_HISTORY_MAXLEN))
+                    finally:
+                        with self.clients_lock:
+                            self._end_join_replay(conn, replayed_until)
+
             elif cmd == '/leave':
-                session = self.redis_client.hgetall(f'session:{username}')
-                current_room = session.get('room')
-                
+                with self.clients_lock:
+                    here = self._rooms_here(username, conn.room)
+                current_room = yield self.leave_room_script(
+                    keys=[f'session:{username}'] + [room_key(room) for room in here],
+                    args=[username] + here
+                )
+
+                if current_room is None:
+                    yield self._reply(conn, SESSION_EXPIRED_TEXT.encode())
+                    return True
                 if current_room:
-                    self.redis_client.srem(f'room:{current_room}', username)
-                    self.redis_client.hset(f'session:{username}', 'room', '')
-                    client_socket.sendall(f"SUCCESS: Left room '{current_room}'\n".encode())
+                    yield from self._leave_elsewhere(username, current_room, None, here)
+                    with self.clients_lock:
+                        self._set_local_room(conn, None)
+                    yield self._reply(conn, f"SUCCESS: Left room '{current_room}'\n".encode())
                 else:
-                    client_socket.sendall(b"ERROR: You are not in any room\n")
-            
+                    yield self._reply(conn, b"ERROR: You are not in any room\n")
+
             elif cmd == '/rooms':
-                # Get all rooms from Redis
-                keys = self.redis_client.keys('room:*')
-                rooms = [key.split(':')[1] for key in keys]
-                
-                if rooms:
-                    client_socket.sendall(f"Available rooms: {', '.join(rooms)}\n".encode())
+                cursor = parse_cursor(parts)
+                if cursor is None:
+                    yield self._reply(conn, b"ERROR: Usage: /rooms [cursor]\n")
+                    return False
+
+                # One page of the rooms registries, with member counts
+                cursor, rooms = yield from self._scan_rooms(cursor)
+                yield self._reply(conn, format_rooms_page(rooms, cursor).encode())
+
+            elif cmd == '/history':
+                count = parse_history_count(parts)
+                if count is None:
+                    yield self._reply(conn, b"ERROR: Usage: /history [n]\n")
+                    return False
+                if ROOM_HISTORY_MAXLEN <= 0:
+                    yield self._reply(conn, b"ERROR: Room history is disabled\n")
+                    return False
+
+                with self.clients_lock:
+                    current_room = conn.room
+                if not current_room:
+                    yield self._reply(conn, b"ERROR: You are not in any room\n")
+                elif not (yield from self._replay_history(conn, current_room, count)):
+                    yield self._reply(conn, f"No history for room '{current_room}'\n".encode())
+
+            elif cmd == '/msg':
+                parts = command.split(None, 2)
+                if len(parts) < 3:
+                    yield self._reply(conn, b"ERROR: Usage: /msg <user> <text>\n")
+                    return False
+
+                target_user, text = parts[1], parts[2]
+                if target_user == username:
+                    yield self._reply(conn, b"ERROR: Cannot message yourself\n")
+                    return False
+
+                # A local recipient needs no Redis at all
+                with self.clients_lock:
+                    target_conn = self.users.get(target_user)
+                if target_conn is not None:
+                    self._deliver(target_conn, format_direct_message(username, text).encode())
+                    owner = self.server_id
+                else:
+                    owner = yield from self._route_direct_message(self._message(
+                        'direct_message', sender=username, content=text, target=target_user))
+
+                if owner is None:
+                    yield self._reply(conn, f"ERROR: User '{target_user}' does not exist\n".encode())
+                elif owner:
+                    yield self._reply(conn, f"[DM to {target_user}]: {text}\n".encode())
                 else:
-                    client_socket.sendall(b"No rooms available\n")
-            
+                    yield self._reply(conn, f"[DM to {target_user}]: {text}\n{target_user} is offline; they will get it at their next login\n".encode())
+
             elif cmd == '/subscribe':
                 if len(parts) < 2:
-                    client_socket.sendall(b"ERROR: Usage: /subscribe <username>\n")
-                    return
-                
+                    yield self._reply(conn, b"ERROR: Usage: /subscribe <username>\n")
+                    return False
+
                 target_user = parts[1]
-                
+
                 # Check if target user exists
-                if not self.redis_client.exists(f'user:{target_user}'):
-                    client_socket.sendall(f"ERROR: User '{target_user}' does not exist\n".encode())
-                    return
-                
+                if not (yield self.redis_client.exists(f'user:{target_user}')):
+                    yield self._reply(conn, f"ERROR: User '{target_user}' does not exist\n".encode())
+                    return False
+
                 if target_user == username:
-                    client_socket.sendall(b"ERROR: Cannot subscribe to yourself\n")
-                    return
-                
-                # Add to subscriber list
-                self.redis_client.sadd(f'subscribers:{target_user}', username)
-                client_socket.sendall(f"SUCCESS: Subscribed to @{target_user}\n".encode())
-            
+                    yield self._reply(conn, b"ERROR: Cannot subscribe to yourself\n")
+                    return False
+
+                # Add to subscriber list (and the reverse index used at login)
+                pipe = self.redis_client.pipeline(transaction=True)
+                pipe.sadd(f'subscribers:{target_user}', username)
+                pipe.sadd(f'subscriptions:{username}', target_user)
+                yield pipe.execute()
+                with self.clients_lock:
+                    self._set_local_subscription(conn, target_user, True)
+                yield from self._publish_subscribers_changed(target_user)
+                yield self._reply(conn, f"SUCCESS: Subscribed to @{target_user}\n".encode())
+
             elif cmd == '/unsubscribe':
                 if len(parts) < 2:
-                    client_socket.sendall(b"ERROR: Usage: /unsubscribe <username>\n")
-                    return
-                
+                    yield self._reply(conn, b"ERROR: Usage: /unsubscribe <username>\n")
+                    return False
+
                 target_user = parts[1]
-                self.redis_client.srem(f'subscribers:{target_user}', username)
-                client_socket.sendall(f"SUCCESS: Unsubscribed from @{target_user}\n".encode())
-            
+                pipe = self.redis_client.pipeline(transaction=True)
+                pipe.srem(f'subscribers:{target_user}', username)
+                pipe.srem(f'subscriptions:{username}', target_user)
+                yield pipe.execute()
+                with self.clients_lock:
+                    self._set_local_subscription(conn, target_user, False)
+                yield from self._publish_subscribers_changed(target_user)
+                yield self._reply(conn, f"SUCCESS: Unsubscribed from @{target_user}\n".encode())
+
             elif cmd == '/subscriptions':
-                # Show who this user is subscribed to
-                keys = self.redis_client.keys('subscribers:*')
-                subscribed_to = []
-                
-                for key in keys:
-                    if self.redis_client.sismember(key, username):
-                        publisher = key.split(':')[1]
-                        subscribed_to.append(publisher)
-                
-                if subscribed_to:
-                    client_socket.sendall(f"You are subscribed to: {', '.join(subscribed_to)}\n".encode())
-                else:
-                    client_socket.sendall(b"You have no subscriptions\n")
-            
+                cursor = parse_cursor(parts)
+                if cursor is None:
+                    yield self._reply(conn, b"ERROR: Usage: /subscriptions [cursor]\n")
+                    return False
+
+                # One page of the reverse index kept next to subscribers:<target>
+                cursor, subscribed_to = yield self.redis_client.sscan(
+                    f'subscriptions:{username}', cursor, count=LIST_PAGE_SIZE
+                )
+                yield self._reply(conn, format_subscriptions_page(subscribed_to, cursor).encode())
+
+            elif cmd == HEARTBEAT_COMMAND:
+                yield self._reply(conn, HEARTBEAT_REPLY.encode())
+
             elif cmd == '/help':
-                help_text = """
-Available commands:
-  /join <room>          - Join a chat room
-  /leave                - Leave current room
-  /rooms                - List all rooms
-  /subscribe <user>     - Subscribe to a user's messages
-  /unsubscribe <user>   - Unsubscribe from a user
-  /subscriptions        - List your subscriptions
-  /help                 - Show this help
-  /quit                 - Disconnect
-"""
-                client_socket.sendall(help_text.encode())
-            
+                yield self._reply(conn, HELP_TEXT.encode())
+
             elif cmd == '/quit':
-                client_socket.sendall(b"Goodbye!\n")
-                try:
-                    client_socket.close()
-                except:
-                    pass
+                yield self._reply(conn, b"Goodbye!\n")
                 return True
-            
+
             else:
-                client_socket.sendall(f"ERROR: Unknown command '{cmd}'\n".encode())
-        
+                yield self._reply(conn, f"ERROR: Unknown command '{cmd}'\n".encode())
+
         except Exception as e:
-            client_socket.sendall(f"ERROR: {str(e)}\n".encode())
-        
+            yield self._reply(conn, f"ERROR: {str(e)}\n".encode())
+
         return False
-    
+
+
+class ChatServer(ChatCore):
+    """Thread-per-connection engine: runs ChatCore's flows on blocking sockets and Redis calls"""
+
+    def __init__(self):
+        # Redis connections: one pool per shard, keys routed by user or room
+        self.redis_client = sharding.ShardedRedis(
+            REDIS_NODES,
+            pubsub_node=REDIS_PUBSUB_NODE,
+            client_class=InstrumentedRedis,
+            decode_responses=True
+        )
+        # Pub/Sub payloads are binary (see wire.py), so this connection
+        # does not decode responses
+        self.redis_pubsub = redis.Redis(
+            host=REDIS_PUBSUB_NODE[0],
+            port=REDIS_PUBSUB_NODE[1]
+        ).pubsub()
+        self.clients_lock = metrics.TimedLock(metrics.LOCK_WAIT_SECONDS)
+        self._init_state()
+        self.tls_context = None  # set by start() when USE_TLS is on
+        self.handler_threads = set()  # joined at shutdown, before Redis is closed
+        self._run(self._ensure_room_registry())
+        self._run(self._ensure_subscription_index())
+
+        # The Pub/Sub connection is not thread-safe, so SUBSCRIBE and
+        # UNSUBSCRIBE are queued for the subscriber thread, which applies them in order
+        self.channel_ops = deque()  # (subscribe, channel)
+        self.redis_pubsub.subscribe(server_channel(self.server_id))
+        self.publisher = PublishBatcher(self.redis_client)
+
+        # Start Redis subscriber thread
+        self.pubsub_thread = threading.Thread(target=self._redis_subscriber, daemon=True)
+        self.pubsub_thread.start()
+        # The cluster-wide room sweep gets a thread of its own, so a long
+        # sweep cannot hold session refreshes back past SESSION_TTL
+        self.housekeeping_thread = threading.Thread(target=self._run, daemon=True, args=(self._housekeeping(
+            [(IDLE_TIMEOUT / 4, self._reap_idle), (SESSION_TTL / 3, self._refresh_sessions)]),))
+        self.housekeeping_thread.start()
+        self.reconcile_thread = threading.Thread(target=self._run, daemon=True, args=(self._housekeeping(
+            [(RECONCILE_INTERVAL, self._reconcile_rooms)]),))
+        self.reconcile_thread.start()
+
+        print(f"[Server {self.server_id}] Initialized")
+        print(f"[Server {self.server_id}] Redis nodes: {', '.join(self.redis_client.node_names)}"
+              f" (Pub/Sub on {sharding.node_name(REDIS_PUBSUB_NODE)})")
+
+    def _run(self, steps):
+        """Run a ChatCore flow; its calls have already returned by the time they are yielded"""
+        result = None
+        try:
+            while True:
+                result = steps.send(result)
+        except StopIteration as done:
+            return done.value
+
+    def _reply(self, conn, data):
+        """Send a response to a client's own command, waiting for queue space"""
+        if not conn.outbound.send(data, block=True):
+            raise ConnectionError("connection closed")
+
+    def _wait(self, future):
+        return future.result()
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _queue_channel_op(self, subscribe, channel):
+        self.channel_ops.append((subscribe, channel))
+
+    def _redis_subscriber(self):
+        """Listen for messages from Redis pub/sub, catching up after a reconnect"""
+        lost_at = None
+        while self.running:
+            try:
+                if lost_at is not None:
+                    # PING reconnects, and redis-py resubscribes every channel
+                    self.redis_pubsub.ping()
+                    self._run(self._catch_up_rooms(lost_at))
+                    print(f"[Server {self.server_id}] Pub/Sub reconnected")
+                    lost_at = None
+
+                while self.running:
+                    self._apply_channel_ops()
+                    message = self.redis_pubsub.get_message(timeout=PUBSUB_POLL_INTERVAL)
+                    if message is None or message['type'] != 'message':
+                        continue
+                    try:
+                        data = wire.decode(message['data'])
+                        metrics.RECEIVED.labels(data.get('type')).inc()
+                        # Only channels with local interest are subscribed
+                        self._run(self._local_broadcast(data))
+                    except Exception as e:
+                        print(f"[Redis Sub Error] {e}")
+            except Exception as e:
+                if not self.running:
+                    break
+                if lost_at is None:
+                    lost_at = wire.now_ms()
+                    print(f"[Redis Sub Error] Connection lost: {e}")
+                time.sleep(1)
+
+    def _apply_channel_ops(self):
+        """Send queued subscribe/unsubscribe calls in order (subscriber thread only)"""
+        while self.channel_ops:
+            subscribe, channel = self.channel_ops.popleft()
+            try:
+                if subscribe:
+                    self.redis_pubsub.subscribe(channel)
+                else:
+                    self.redis_pubsub.unsubscribe(channel)
+            except Exception:
+                # Not recorded by redis-py, so not resubscribed on reconnect: retry it then
+                self.channel_ops.appendleft((subscribe, channel))
+                raise
+
+    def _tls_handshake(self, raw_socket, client_address):
+        """Run the server-side TLS handshake with a deadline; None on failure"""
+        try:
+            raw_socket.settimeout(TLS_HANDSHAKE_TIMEOUT)
+            client_socket = self.tls_context.wrap_socket(raw_socket, server_side=True)
+            client_socket.settimeout(None)
+            return client_socket
+        except Exception as e:
+            print(f"[TLS] Handshake with {client_address} failed: {e}")
+            close_socket(raw_socket)
+            return None
+
+    def handle_client(self, client_socket, client_address):
+        """Handle individual client connection"""
+        print(f"[Connection] New connection from {client_address}")
+
+        if self.tls_context is not None:
+            client_socket = self._tls_handshake(client_socket, client_address)
+            if client_socket is None:
+                return
+
+        conn = Connection(client_socket, OutboundQueue(client_socket))
+        self.connections[client_socket] = conn
+
+        try:
+            # Send welcome message
+            self._reply(conn, WELCOME_TEXT.encode())
+
+            lines = LineReader(client_socket).lines()
+
+            # Authentication phase
+            authenticated = False
+            for data in lines:
+                authenticated = self._run(self._handle_login_line(conn, data))
+                if authenticated:
+                    break
+
+            if not authenticated:
+                return
+
+            # Main message loop: every complete line of a batch is handled
+            # before the next recv()
+            for data in lines:
+                if not self.running or self._run(self._handle_line(conn, data)):
+                    break
+
+        except LineTooLong:
+            try:
+                self._reply(conn, LINE_TOO_LONG_TEXT.encode())
+            except Exception:
+                pass
+
+        except Exception as e:
+            print(f"[Error] Client {conn.username or client_address}: {e}")
+
+        finally:
+            if conn.username:
+                self._run(self._end_session(conn))
+            self._close_connection(conn)
+            self.connections.pop(client_socket, None)
+            self.handler_threads.discard(threading.current_thread())
+
     def start(self):
         """Start the chat server"""
         # Create socket
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if REUSE_PORT:
+            # Sibling workers bind the same port; the kernel spreads connections
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind((HOST, PORT))
         server_socket.listen(5)
         
-        # Wrap with TLS if enabled
+        # TLS handshakes run on the client thread, not in accept()
         if USE_TLS:
-            if not os.path.exists(CERT_FILE) or not os.path.exists(KEY_FILE):
-                print(f"[ERROR] TLS enabled but certificate files not found!")
-                print(f"[ERROR] Looking for: {CERT_FILE}, {KEY_FILE}")
+            self.tls_context = create_server_context()
+            if self.tls_context is None:
+                server_socket.close()
                 return
-            
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            context.load_cert_chain(CERT_FILE, KEY_FILE)
-            server_socket = context.wrap_socket(server_socket, server_side=True)
             print(f"[Server] TLS enabled")
         
+        # SIGTERM (docker stop, Popen.terminate) shuts down like Ctrl+C,
+        # so the finally below stops the hash pool's workers too
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        
+        self.hash_pool.calibrate()
+        metrics.start_http_server()
         print(f"[Server] Listening on {HOST}:{PORT}")
         print(f"[Server] ID: {self.server_id}")
         
@@ -526,12 +2082,19 @@ Available commands:
                 try:
                     client_socket, client_address = server_socket.accept()
                     
+                    # Refused before it costs a handshake or any threads
+                    if not self.connect_limiter.allow():
+                        metrics.RATE_LIMITED.labels('connect').inc()
+                        close_socket(client_socket)
+                        continue
+                    
                     # Create new thread for client
                     client_thread = threading.Thread(
                         target=self.handle_client,
                         args=(client_socket, client_address),
                         daemon=True
                     )
+                    self.handler_threads.add(client_thread)
                     client_thread.start()
                 
                 except Exception as e:
@@ -544,9 +2107,101 @@ Available commands:
         finally:
             self.running = False
             server_socket.close()
+            # Sessions are removed by their handlers, so Redis stays open until they end
+            self._close_connections()
+            deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+            for thread in list(self.handler_threads):
+                thread.join(max(0, deadline - time.monotonic()))
+            self.publisher.close()
             self.redis_pubsub.close()
             self.redis_client.close()
+            self.hash_pool.shutdown()
+
+
+def create_server():
+    """The server engine selected by SERVER_MODE"""
+    if SERVER_MODE == 'asyncio':
+        from async_server import AsyncChatServer
+        return AsyncChatServer()
+    return ChatServer()
+
+
+class Supervisor:
+    """Runs WORKERS server processes on one port with SO_REUSEPORT"""
+    
+    def __init__(self, count=WORKERS):
+        self.count = count
+        # Workers are ordinary servers; their ids derive from this one
+        self.server_id = os.getenv('SERVER_ID', f'server_{os.getpid()}')
+        self.workers = {}  # index -> Popen
+        self.running = True
+    
+    def _worker_env(self, index):
+        env = dict(os.environ)
+        env['WORKERS'] = '1'
+        env['REUSE_PORT'] = 'true'
+        env['SERVER_ID'] = f'{self.server_id}_w{index}'
+        if 'BCRYPT_WORKERS' not in os.environ:
+            # Share the cores between the workers' hash pools
+            env['BCRYPT_WORKERS'] = str(max(1, BCRYPT_WORKERS // self.count))
+        if metrics.METRICS_PORT:
+            env['METRICS_PORT'] = str(metrics.METRICS_PORT + index)
+        return env
+    
+    def _spawn(self, index):
+        # A new session keeps a terminal Ctrl+C away from the workers, so
+        # they get exactly one SIGINT, from stop()
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            env=self._worker_env(index),
+            start_new_session=True
+        )
+        self.workers[index] = process
+        print(f"[Supervisor] Worker {index} started (pid {process.pid}, id {self.server_id}_w{index})")
+    
+    def _stop(self, signum, frame):
+        self.running = False
+    
+    def stop(self, timeout=CLOSE_FLUSH_TIMEOUT + 5):
+        """Shut the workers down cleanly, killing any that do not exit in time"""
+        for process in self.workers.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        deadline = time.monotonic() + timeout
+        for index, process in self.workers.items():
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                print(f"[Supervisor] Worker {index} did not exit, killing it")
+                process.kill()
+                process.wait()
+    
+    def start(self):
+        """Start the workers and restart any that exit until stopped"""
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            print("[Error] SO_REUSEPORT is not available on this platform; running one process")
+            create_server().start()
+            return
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+        print(f"[Supervisor] Starting {self.count} workers on {HOST}:{PORT}")
+        for index in range(self.count):
+            self._spawn(index)
+        try:
+            while self.running:
+                time.sleep(WORKER_RESTART_DELAY)
+                for index, process in list(self.workers.items()):
+                    code = process.poll()
+                    if code is not None and self.running:
+                        print(f"[Supervisor] Worker {index} exited with code {code}, restarting")
+                        self._spawn(index)
+        finally:
+            print("[Supervisor] Shutting down workers...")
+            self.stop()
+
 
 if __name__ == '__main__':
-    server = ChatServer()
-    server.start()
+    if WORKERS > 1:
+        Supervisor().start()
+        sys.exit(0)
+    create_server().start()
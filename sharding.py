@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Redis sharding for the chat server: keys are spread over several Redis nodes
+by consistent hashing of the entity they belong to
+
+Keys are named '<kind>:<entity>' (user:alice, session:alice, inbox:alice,
+room:lobby, history:lobby, ...). The entity name is hashed onto a ring of
+virtual nodes, so every key of one user or one room lives on the same node
+(the Lua scripts rely on that), and adding a node moves only the entities
+whose ring segments it takes over, about 1/N of them, where hash % N would
+move almost all of them.
+
+Pub/Sub is not sharded: every publish and subscription goes to one node
+over connections of its own, so each server still needs one subscriber.
+
+    python sharding.py rebalance OLD_NODES NEW_NODES
+
+moves the keys whose owner changes when the node list does (run it with the
+servers stopped, then start them with the new REDIS_NODES).
+"""
+
+import asyncio
+import bisect
+import hashlib
+import sys
+
+import redis
+import redis.asyncio as aioredis
+
+VIRTUAL_NODES = 256  # ring points per node; more spreads keys more evenly
+NODE_LOCAL_KEYS = ('rooms', 'subscriptions-indexed')  # kept by every node about its own keys, never moved
+
+
+def parse_nodes(spec):
+    """'host:port,host:port' -> [(host, port), ...]"""
+    nodes = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.rpartition(':')
+        nodes.append((host or 'localhost', int(port)))
+    if not nodes:
+        raise ValueError(f"No Redis nodes in {spec!r}")
+    return nodes
+
+
+def node_name(node):
+    return f'{node[0]}:{node[1]}'
+
+
+def key_entity(key):
+    """The entity a key is placed by: 'alice' for session:alice, the key itself without a ':'"""
+    if isinstance(key, bytes):
+        key = key.decode()
+    _, sep, entity = key.partition(':')
+    return entity if sep else key
+
+
+def _hash(text):
+    return int.from_bytes(hashlib.md5(text.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring over node names, VIRTUAL_NODES points per node"""
+
+    def __init__(self, names, replicas=VIRTUAL_NODES):
+        points = sorted((_hash(f'{name}#{i}'), index)
+                        for index, name in enumerate(names) for i in range(replicas))
+        self.points = [point for point, _ in points]
+        self.owners = [index for _, index in points]
+
+    def index_for(self, entity):
+        """Index (into the names given) of the node owning entity"""
+        i = bisect.bisect(self.points, _hash(entity))
+        return self.owners[i % len(self.owners)]
+
+
+class _Router:
+    """Key -> node routing shared by the blocking and asyncio clients"""
+
+    def _setup(self, nodes, pubsub_node, client_class, options):
+        self.node_names = [node_name(node) for node in nodes]
+        self.nodes = [client_class(host=host, port=port, **options) for host, port in nodes]
+        pubsub_host, pubsub_port = pubsub_node or nodes[0]
+        # Its own pool even when it is also a data node
+        self.pubsub_client = client_class(host=pubsub_host, port=pubsub_port, **options)
+        self.ring = HashRing(self.node_names)
+        # register_script() hashes scripts with this pool's encoder
+        self.connection_pool = self.nodes[0].connection_pool
+
+    def node_for(self, key):
+        """Client of the node holding key"""
+        return self.nodes[self.ring.index_for(key_entity(key))]
+
+    def _route(self, args):
+        command = str(args[0]).upper()
+        if command == 'PUBLISH':
+            return self.pubsub_client
+        if command in ('EVALSHA', 'EVAL'):
+            # Scripts run where their first key lives; the others must share its entity
+            if int(args[2]) < 1:
+                raise ValueError(f"{command} without keys cannot be routed to a shard")
+            return self.node_for(args[3])
+        if len(args) < 2:
+            raise ValueError(f"{command} has no key to route by")
+        return self.node_for(args[1])
+
+    def _all_clients(self):
+        return self.nodes + [self.pubsub_client]
+
+
+class ShardedRedis(_Router, redis.Redis):
+    """
+    redis.Redis that sends every command to the node owning its key.
+    Multi-key commands must stay within one entity; SCRIPT LOAD goes to
+    every node and PUBLISH to the Pub/Sub node.
+    """
+
+    def __init__(self, nodes, pubsub_node=None, client_class=redis.Redis, **options):
+        self._setup(nodes, pubsub_node, client_class, options)
+
+    def execute_command(self, *args, **options):
+        if str(args[0]).upper() == 'SCRIPT LOAD':
+            return [node.execute_command(*args, **options) for node in self.nodes][0]
+        return self._route(args).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+    def close(self):
+        for client in self._all_clients():
+            client.close()
+
+
+class ShardedPipeline(redis.commands.CoreCommands):
+    """
+    Pipeline over ShardedRedis: commands are grouped by node and each group
+    runs as one pipeline (one MULTI per node when transactional, so there
+    is no atomicity across nodes). Results come back in command order.
+    """
+
+    def __init__(self, router, transaction=True):
+        self.router = router
+        self.transaction = transaction
+        self.commands = []  # (client, args, options)
+
+    def execute_command(self, *args, **options):
+        self.commands.append((self.router._route(args), args, options))
+        return self
+
+    def _groups(self):
+        groups = {}  # id(client) -> (node pipeline, command positions)
+        for position, (client, args, options) in enumerate(self.commands):
+            entry = groups.get(id(client))
+            if entry is None:
+                entry = groups[id(client)] = (client.pipeline(transaction=self.transaction), [])
+            entry[0].execute_command(*args, **options)
+            entry[1].append(position)
+        self.commands = []
+        return list(groups.values())
+
+    @staticmethod
+    def _merge(groups, outputs, count):
+        results = [None] * count
+        for (_, positions), output in zip(groups, outputs):
+            for position, result in zip(positions, output):
+                results[position] = result
+        return results
+
+    def execute(self, raise_on_error=True):
+        count = len(self.commands)
+        groups = self._groups()
+        outputs = [pipe.execute(raise_on_error) for pipe, _ in groups]
+        return self._merge(groups, outputs, count)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.commands = []
+
+
+class AsyncShardedRedis(_Router, aioredis.Redis):
+    """redis.asyncio.Redis counterpart of ShardedRedis"""
+
+    def __init__(self, nodes, pubsub_node=None, client_class=aioredis.Redis, **options):
+        self._setup(nodes, pubsub_node, client_class, options)
+
+    async def execute_command(self, *args, **options):
+        if str(args[0]).upper() == 'SCRIPT LOAD':
+            results = await asyncio.gather(*(node.execute_command(*args, **options) for node in self.nodes))
+            return results[0]
+        return await self._route(args).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AsyncShardedPipeline(self, transaction)
+
+    async def aclose(self, close_connection_pool=None):
+        for client in self._all_clients():
+            await client.aclose()
+
+
+class AsyncShardedPipeline(ShardedPipeline):
+    """ShardedPipeline for AsyncShardedRedis; the nodes' pipelines run concurrently"""
+
+    async def execute(self, raise_on_error=True):
+        count = len(self.commands)
+        groups = self._groups()
+        outputs = await asyncio.gather(*(pipe.execute(raise_on_error) for pipe, _ in groups))
+        return self._merge(groups, outputs, count)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.commands = []
+
+
+def rebalance(old_nodes, new_nodes, batch=500):
+    """
+    Copy every key whose owner differs between two node lists to its new
+    node (DUMP/RESTORE), then delete it from the old one. NODE_LOCAL_KEYS
+    are dropped instead, so servers rebuild them at start. Returns
+    (keys scanned, keys moved).
+    """
+    old = ShardedRedis(old_nodes)
+    new = ShardedRedis(new_nodes)
+    new_index = {name: client for name, client in zip(new.node_names, new.nodes)}
+    scanned = moved = 0
+    for name, source in zip(old.node_names, old.nodes):
+        keys = []
+        for key in source.scan_iter(count=batch):
+            if (key.decode() if isinstance(key, bytes) else key) in NODE_LOCAL_KEYS:
+                continue
+            scanned += 1
+            target = new.node_for(key)
+            if new_index.get(name) is not target:
+                keys.append((key, target))
+        for key, target in keys:
+            pipe = source.pipeline(transaction=False)
+            pipe.pttl(key)
+            pipe.dump(key)
+            ttl, payload = pipe.execute()
+            if payload is None:
+                continue
+            target.restore(key, max(ttl, 0), payload, replace=True)
+            source.delete(key)
+            moved += 1
+    for client in new.nodes:
+        client.delete(*NODE_LOCAL_KEYS)
+    return scanned, moved
+
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] != 'rebalance':
+        sys.exit("Usage: python sharding.py rebalance OLD_NODES NEW_NODES  (host:port,host:port,...)")
+    scanned, moved = rebalance(parse_nodes(sys.argv[2]), parse_nodes(sys.argv[3]))
+    print(f"[Rebalance] Moved {moved} of {scanned} keys ({moved / max(scanned, 1):.1%})")
+
+
+if __name__ == '__main__':
+    main()
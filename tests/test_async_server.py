@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Unit tests for async_server.py, against fakeredis instead of a Redis server.
+
+Usage: python -m unittest discover tests
+"""
+
+import asyncio
+import os
+import sys
+import unittest
+import uuid
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import async_server  # noqa: E402
+import wire  # noqa: E402
+from server import room_channel  # noqa: E402
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+async def next_message(pubsub, timeout=2):
+    """The next published payload on pubsub, decoded"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.05)
+        if message is not None:
+            return wire.decode(message['data'])
+    raise AssertionError("nothing published")
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class AsyncServerTest(unittest.TestCase):
+    def setUp(self):
+        # A node of its own, so no data is shared with other tests
+        self.node = (f'test-{uuid.uuid4().hex}', 6379)
+        for patch in (
+            mock.patch.object(async_server, 'REDIS_NODES', [self.node]),
+            mock.patch.object(async_server, 'REDIS_PUBSUB_NODE', self.node),
+            mock.patch.object(async_server, 'InstrumentedAsyncRedis', fakeredis.FakeAsyncRedis),
+            mock.patch.object(async_server.aioredis, 'Redis', fakeredis.FakeAsyncRedis),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        # Built outside any event loop, as server.py's __main__ builds it
+        self.chat = async_server.AsyncChatServer()
+        self.addCleanup(self.chat.hash_pool.shutdown)
+
+    def test_publish_after_building_outside_a_loop(self):
+        async def scenario():
+            listener = fakeredis.FakeAsyncRedis(host=self.node[0], port=self.node[1]).pubsub()
+            await listener.subscribe(room_channel('lobby'))
+            publisher = asyncio.create_task(self.chat.publisher.run())
+            await asyncio.sleep(0)
+            received = []
+            for text in ('one', 'two'):
+                await self.chat._run(self.chat._publish_message('room_message', 'alice', text, room='lobby'))
+                received.append(await next_message(listener))
+            publisher.cancel()
+            await asyncio.gather(publisher, return_exceptions=True)
+            return received
+
+        received = asyncio.run(scenario())
+        self.assertEqual([data['content'] for data in received], ['one', 'two'])
+        self.assertTrue(all(data.get('id') for data in received))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Unit tests for metrics.py: Prometheus text output and the /metrics endpoint.
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import socket
+import sys
+import unittest
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import metrics  # noqa: E402
+
+
+class RenderTest(unittest.TestCase):
+    def metric(self, metric_class, *args, **kwargs):
+        metric = metric_class(*args, **kwargs)
+        self.addCleanup(metrics.REGISTRY.remove, metric)
+        return metric
+
+    def test_counter(self):
+        counter = self.metric(metrics.Counter, 'test_events_total', 'Events seen', ('kind',))
+        counter.labels('a').inc()
+        counter.labels('a').inc()
+        counter.labels('b"\n\\').inc(2.5)
+        self.assertEqual(counter.render(), [
+            '# HELP test_events_total Events seen',
+            '# TYPE test_events_total counter',
+            'test_events_total{kind="a"} 2',
+            'test_events_total{kind="b\\"\\n\\\\"} 2.5',
+        ])
+
+    def test_gauge(self):
+        gauge = self.metric(metrics.Gauge, 'test_open', 'Open things')
+        gauge.set(3.0)
+        self.assertEqual(gauge.render(), ['# HELP test_open Open things', '# TYPE test_open gauge', 'test_open 3'])
+        gauge.set_function(lambda: 7)
+        self.assertEqual(gauge.render()[2], 'test_open 7')
+        gauge.set_function(lambda: 1 / 0)  # a failing function leaves the sample out
+        self.assertEqual(gauge.render(), ['# HELP test_open Open things', '# TYPE test_open gauge'])
+
+    def test_histogram(self):
+        histogram = self.metric(metrics.Histogram, 'test_seconds', 'Time taken', ('op',), buckets=(1, 0.25))
+        for value in (0.25, 0.5, 4):
+            histogram.labels('x').observe(value)
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Time taken',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{op="x",le="0.25"} 1',
+            'test_seconds_bucket{op="x",le="1"} 2',
+            'test_seconds_bucket{op="x",le="+Inf"} 3',
+            'test_seconds_sum{op="x"} 4.75',
+            'test_seconds_count{op="x"} 3',
+        ])
+
+    def test_metric_needs_a_child_type(self):
+        with self.assertRaises(TypeError):
+            metrics._Metric('test_abstract', 'No child type')
+
+
+class EndpointTest(unittest.TestCase):
+    def setUp(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        httpd = metrics.start_http_server('127.0.0.1', port)
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        self.url = f'http://127.0.0.1:{port}'
+
+    def test_metrics(self):
+        with urllib.request.urlopen(self.url + '/metrics') as response:
+            self.assertEqual(response.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+            body = response.read().decode()
+        self.assertTrue(body.endswith('\n'))
+        self.assertIn('# TYPE chat_command_seconds histogram\n', body)
+        self.assertIn('# TYPE chat_published_total counter\n', body)
+        self.assertIn('# TYPE chat_connections gauge\n', body)
+
+    def test_other_paths(self):
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            urllib.request.urlopen(self.url + '/')
+        self.assertEqual(raised.exception.code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+"""
+Unit tests for server.py. ChatServer runs against fakeredis instead of a
+Redis server.
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+import uuid
+from collections import deque
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import server  # noqa: E402
+import wire  # noqa: E402
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class FakeSocket:
+    """recv() hands out the given chunks in order, then b'' as a closed peer would"""
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+class LineReaderTest(unittest.TestCase):
+    def read(self, *chunks, max_line=16):
+        return server.LineReader(FakeSocket(*chunks), max_line).lines()
+
+    def test_pipelined_and_split_lines(self):
+        lines = self.read(b'LOGIN a b\n/join lo', b'bby\n\n  hi  \r\n', b'tail')
+        self.assertEqual(list(lines), ['LOGIN a b', '/join lobby', 'hi'])
+
+    def test_line_at_the_limit(self):
+        self.assertEqual(list(self.read(b'x' * 16 + b'\n')), ['x' * 16])
+
+    def test_complete_line_over_the_limit(self):
+        with self.assertRaises(server.LineTooLong):
+            list(self.read(b'x' * 17 + b'\n'))
+
+    def test_fragment_over_the_limit_without_newline(self):
+        lines = self.read(b'x' * 10, b'x' * 10)
+        with self.assertRaises(server.LineTooLong):
+            next(lines)
+
+    def test_lines_before_an_over_long_fragment_are_kept(self):
+        lines = self.read(b'one\ntwo\n' + b'x' * 17)
+        self.assertEqual(next(lines), 'one')
+        self.assertEqual(next(lines), 'two')
+        with self.assertRaises(server.LineTooLong):
+            next(lines)
+
+
+class GatedSocket:
+    """sendall() waits until the gate opens; keeps what was sent and whether it was closed"""
+
+    def __init__(self):
+        self.sent = []
+        self.sending = threading.Event()
+        self.gate = threading.Event()
+        self.closed = False
+
+    def sendall(self, data):
+        self.sending.set()
+        self.gate.wait(5)
+        self.sent.append(data)
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class OutboundQueueTest(unittest.TestCase):
+    def stalled_queue(self, policy, max_size=3):
+        """A queue whose writer is stuck sending b'first', with max_size free slots"""
+        sock = GatedSocket()
+        self.addCleanup(sock.gate.set)
+        queue = server.OutboundQueue(sock, max_size=max_size, policy=policy)
+        queue.send(b'first')
+        self.assertTrue(sock.sending.wait(2))
+        return sock, queue
+
+    def test_full_queue_drops_the_oldest(self):
+        sock, queue = self.stalled_queue('drop')
+        for data in (b'a', b'b', b'c', b'd'):
+            self.assertTrue(queue.send(data))
+        self.assertEqual(queue.dropped, 1)
+        queue.close()
+        sock.gate.set()
+        queue.thread.join(2)
+        self.assertEqual(b''.join(sock.sent), b'firstbcd')
+
+    def test_full_queue_disconnects(self):
+        sock, queue = self.stalled_queue('disconnect')
+        for data in (b'a', b'b', b'c'):
+            self.assertTrue(queue.send(data))
+        self.assertFalse(queue.send(b'd'))
+        self.assertTrue(queue.closing)
+        self.assertTrue(sock.closed)
+        self.assertFalse(queue.send(b'e'))
+
+    def test_blocking_send_waits_for_room(self):
+        sock, queue = self.stalled_queue('disconnect', max_size=1)
+        queue.send(b'a')
+        sent = []
+        sender = threading.Thread(target=lambda: sent.append(queue.send(b'b', block=True)))
+        sender.start()
+        sender.join(0.1)
+        self.assertTrue(sender.is_alive())
+        sock.gate.set()
+        sender.join(2)
+        self.assertEqual(sent, [True])
+        self.assertFalse(queue.closing)
+
+    def test_order_is_kept_under_a_burst(self):
+        near, far = socket.socketpair()
+        self.addCleanup(far.close)
+        queue = server.OutboundQueue(near, max_size=16)
+        chunks = []
+
+        def read():
+            while True:
+                chunk = far.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        messages = [f'message {i}\n'.encode() for i in range(5000)]
+        for data in messages:
+            self.assertTrue(queue.send(data, block=True))
+        queue.close()
+        reader.join(5)
+        self.assertEqual(b''.join(chunks), b''.join(messages))
+        self.assertEqual(queue.dropped, 0)
+
+    def test_writer_exits_on_close(self):
+        sock = GatedSocket()
+        sock.gate.set()
+        queue = server.OutboundQueue(sock)
+        queue.send(b'last words\n')
+        queue.close()
+        queue.thread.join(2)
+        self.assertFalse(queue.thread.is_alive())
+        self.assertEqual(sock.sent, [b'last words\n'])
+        self.assertTrue(sock.closed)
+        self.assertFalse(queue.send(b'too late\n'))
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(server.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_refill(self):
+        limiter = server.RateLimiter(rate=2, burst=3)
+        self.assertEqual([limiter.allow('a') for _ in range(4)], [True, True, True, False])
+        self.now += 0.25  # half a token
+        self.assertFalse(limiter.allow('a'))
+        self.now += 0.25
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+
+    def test_refill_is_capped_at_burst(self):
+        limiter = server.RateLimiter(rate=2, burst=3)
+        self.assertTrue(limiter.allow('a'))
+        self.now += 60
+        self.assertEqual([limiter.allow('a') for _ in range(4)], [True, True, True, False])
+
+    def test_keys_have_their_own_buckets(self):
+        limiter = server.RateLimiter(rate=1, burst=1)
+        self.assertTrue(limiter.allow('a'))
+        self.assertFalse(limiter.allow('a'))
+        self.assertTrue(limiter.allow('b'))
+
+    def test_zero_rate_disables(self):
+        limiter = server.RateLimiter(rate=0, burst=1)
+        self.assertTrue(all(limiter.allow('a') for _ in range(100)))
+
+    def test_full_buckets_are_pruned_at_max_keys(self):
+        limiter = server.RateLimiter(rate=1, burst=2, max_keys=2)
+        limiter.allow('a')
+        limiter.allow('b')
+        self.now += 1  # both buckets full again
+        limiter.allow('c')
+        self.assertEqual(set(limiter.buckets), {'c'})
+
+
+class RouteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(server.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = server.RouteCache(ttl=5)
+        cache.store('alice', 'server-a')
+        self.now += 4.9
+        self.assertEqual(cache.get('alice'), 'server-a')
+        self.now += 0.1
+        self.assertIsNone(cache.get('alice'))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = server.RouteCache(max_size=2, ttl=5)
+        cache.store('alice', 'server-a')
+        cache.store('bob', 'server-a')
+        cache.get('alice')
+        cache.store('carol', 'server-b')
+        self.assertIsNone(cache.get('bob'))
+        self.assertEqual(cache.get('alice'), 'server-a')
+
+    def test_a_move_replaces_the_route(self):
+        cache = server.RouteCache(ttl=5)
+        cache.store('alice', 'server-a')
+        cache.invalidate('alice')
+        self.assertIsNone(cache.get('alice'))
+        cache.store('alice', 'server-b')
+        self.assertEqual(cache.get('alice'), 'server-b')
+
+
+class TakeBatchTest(unittest.TestCase):
+    def test_single_message(self):
+        queue = deque([b'one\n'])
+        self.assertEqual(server.take_batch(queue, 100), b'one\n')
+        self.assertFalse(queue)
+
+    def test_joins_up_to_the_limit(self):
+        queue = deque([b'aaaa', b'bbbb', b'cccc'])
+        self.assertEqual(server.take_batch(queue, 8), b'aaaabbbb')
+        self.assertEqual(list(queue), [b'cccc'])
+        self.assertEqual(server.take_batch(queue, 8), b'cccc')
+
+    def test_oversized_message_goes_alone(self):
+        queue = deque([b'x' * 20, b'y'])
+        self.assertEqual(server.take_batch(queue, 8), b'x' * 20)
+        self.assertEqual(server.take_batch(queue, 8), b'y')
+
+
+class HashPoolTest(unittest.TestCase):
+    def test_full_pool_refuses_instead_of_queueing(self):
+        pool = server.HashPool(workers=1, max_pending=2)
+        self.addCleanup(pool.shutdown)
+        running = [pool.submit(time.sleep, 0.5) for _ in range(2)]
+        start = time.monotonic()
+        with self.assertRaises(server.Overloaded):
+            pool.submit(time.sleep, 0.5)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(pool.pending, 2)
+        for future in running:
+            self.assertIsNone(future.result(10))
+
+
+class SubscriberCacheTest(unittest.TestCase):
+    def test_hit_after_a_fill(self):
+        cache = server.SubscriberCache()
+        self.assertEqual(cache.get('alice', lambda: ['bob']), {'bob'})
+        self.assertEqual(cache.get('alice', lambda: ['carol']), {'bob'})
+
+    def test_invalidation_during_a_fill_is_not_overwritten(self):
+        cache = server.SubscriberCache()
+
+        def loader():
+            # bob unsubscribes while the old set is being read
+            cache.invalidate('alice')
+            return ['bob']
+
+        self.assertEqual(cache.get('alice', loader), {'bob'})  # the caller still gets its result
+        self.assertEqual(cache.lookup('alice')[0], None)
+        self.assertEqual(cache.get('alice', lambda: []), set())
+
+
+class RecordingQueue:
+    """Stands in for OutboundQueue: keeps what was sent, in order"""
+
+    def __init__(self):
+        self.sent = []
+        self.closing = False
+
+    def send(self, data, block=False):
+        if self.closing:
+            return False
+        self.sent.append(data)
+        return True
+
+    def close(self):
+        self.closing = True
+
+    def text(self):
+        return b''.join(self.sent).decode()
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class ChatServerTest(unittest.TestCase):
+    node_count = 1
+
+    def setUp(self):
+        # Nodes of its own, so no data is shared with other tests
+        nodes = [(f'test-{uuid.uuid4().hex}', 6379) for _ in range(self.node_count)]
+        self.pubsub_node = nodes[0]
+        for patch in (
+            mock.patch.object(server, 'REDIS_NODES', nodes),
+            mock.patch.object(server, 'REDIS_PUBSUB_NODE', self.pubsub_node),
+            mock.patch.object(server, 'InstrumentedRedis', fakeredis.FakeRedis),
+            mock.patch.object(server.redis, 'Redis', fakeredis.FakeRedis),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.chat = server.ChatServer()
+        self.addCleanup(self.stop)
+        self.redis = self.chat.redis_client
+
+    def stop(self):
+        self.chat.running = False
+        self.chat.publisher.close()
+        self.chat.hash_pool.shutdown()
+
+    def login(self, username):
+        conn = server.Connection(None, RecordingQueue())
+        self.chat._run(self.chat.create_session(username, conn))
+        return conn
+
+    def command(self, conn, line):
+        return self.chat._run(self.chat.handle_command(conn.username, conn, line))
+
+    def node(self, key):
+        return self.redis.node_for(key)
+
+    def name(self, prefix, key_for, node, same=True):
+        """The first of prefix0, prefix1, ... whose key is (or is not) on node"""
+        return next(name for name in (f'{prefix}{i}' for i in range(1000))
+                    if (self.node(key_for(name)) is node) == same)
+
+    def assertMembership(self, usernames, rooms):
+        """room:* sets and registry counts match the rooms in the sessions"""
+        for room in rooms:
+            expected = {username for username in usernames if self.redis.hget(f'session:{username}', 'room') == room}
+            self.assertEqual(self.redis.smembers(server.room_key(room)), expected, room)
+            count = self.node(server.room_key(room)).zscore(server.ROOMS_REGISTRY, room)
+            self.assertEqual(count or 0, len(expected), room)
+
+    def room_message(self, entry_id, content):
+        return {'type': 'room_message', 'sender': 'bob', 'content': content, 'room': 'den', 'id': entry_id}
+
+    def test_create_session(self):
+        self.redis.sadd('subscriptions:alice', 'bob')
+        conn = self.login('alice')
+        session = self.redis.hgetall('session:alice')
+        self.assertEqual(session['server_id'], self.chat.server_id)
+        self.assertEqual(session['session_id'], conn.session_id)
+        self.assertEqual(session['room'], 'lobby')
+        self.assertGreater(self.redis.ttl('session:alice'), 0)
+        self.assertEqual(conn.subscriptions, {'bob'})
+        self.assertIs(self.chat.users['alice'], conn)
+        self.assertMembership(['alice'], ['lobby'])
+
+    def test_join_and_leave(self):
+        conn = self.login('alice')
+        self.assertFalse(self.command(conn, '/join den'))
+        self.assertEqual(self.redis.hget('session:alice', 'room'), 'den')
+        self.assertEqual(conn.room, 'den')
+        self.assertMembership(['alice'], ['lobby', 'den'])
+        self.assertFalse(self.command(conn, '/leave'))
+        self.assertEqual(self.redis.hget('session:alice', 'room'), '')
+        self.assertIsNone(conn.room)
+        self.assertMembership(['alice'], ['lobby', 'den'])
+        self.assertFalse(self.command(conn, '/leave'))
+        self.assertTrue(conn.outbound.text().endswith("ERROR: You are not in any room\n"))
+
+    def test_join_with_an_expired_session(self):
+        conn = self.login('alice')
+        self.redis.delete('session:alice')
+        self.assertTrue(self.command(conn, '/join den'))
+        self.assertTrue(conn.outbound.text().endswith(server.SESSION_EXPIRED_TEXT))
+        self.assertFalse(self.redis.exists('session:alice'))
+        self.assertEqual(self.redis.smembers(server.room_key('den')), set())
+
+    def test_remove_session_needs_the_owning_connection(self):
+        conn = self.login('alice')
+        stale = server.Connection(None, RecordingQueue())
+        stale.session_id = 'an-older-session'
+        self.chat._run(self.chat.remove_session('alice', stale))
+        self.assertEqual(self.redis.hget('session:alice', 'session_id'), conn.session_id)
+        self.chat._run(self.chat.remove_session('alice', conn))
+        self.assertFalse(self.redis.exists('session:alice'))
+        self.assertNotIn('alice', self.chat.users)
+        self.assertMembership(['alice'], ['lobby'])
+
+    def test_takeover_on_this_server(self):
+        old = self.login('alice')
+        self.command(old, '/join den')
+        has_session, session = self.chat._run(self.chat.check_duplicate_login('alice'))
+        self.assertTrue(has_session)
+        self.chat._run(self.chat._take_over_session('alice', session))
+        self.assertTrue(old.outbound.closing)
+        self.assertIn('logged out', old.outbound.text())
+        self.assertFalse(self.redis.exists('session:alice'))
+        self.assertMembership(['alice'], ['lobby', 'den'])
+        new = self.login('alice')
+        self.assertIs(self.chat.users['alice'], new)
+        self.assertMembership(['alice'], ['lobby', 'den'])
+
+    def test_takeover_from_another_server(self):
+        self.redis.hset('session:alice', mapping={
+            'username': 'alice', 'server_id': 'other', 'session_id': 'theirs', 'room': 'den'})
+        self.redis.sadd(server.room_key('den'), 'alice')
+        self.node(server.room_key('den')).zincrby(server.ROOMS_REGISTRY, 1, 'den')
+        # Payloads are binary, so the listener does not decode responses
+        listener = fakeredis.FakeRedis(host=self.pubsub_node[0], port=self.pubsub_node[1]).pubsub()
+        listener.subscribe(server.server_channel('other'))
+        # The other server has already acknowledged, so BLPOP returns at once
+        self.redis.rpush(server.takeover_key('theirs'), 'other')
+        _, session = self.chat._run(self.chat.check_duplicate_login('alice'))
+        self.chat._run(self.chat._take_over_session('alice', session))
+        self.assertFalse(self.redis.exists('session:alice'))
+        self.assertMembership(['alice'], ['den'])
+        deadline = time.monotonic() + 2
+        while time.monotonic() < deadline:
+            message = listener.get_message(ignore_subscribe_messages=True, timeout=0.05)
+            if message is not None:
+                break
+        else:
+            self.fail("no force_logout published")
+        data = wire.decode(message['data'])
+        self.assertEqual((data['type'], data['target'], data['id']), ('force_logout', 'alice', 'theirs'))
+        listener.close()
+
+    def test_takeover_elsewhere_drops_the_cached_route(self):
+        self.chat.route_cache.store('alice', 'other')
+        self.chat._run(self.chat._local_broadcast(
+            {'type': 'force_logout', 'target': 'alice', 'old_server_id': 'other', 'id': 'theirs'}))
+        self.assertIsNone(self.chat.route_cache.get('alice'))
+
+    def test_join_replay_drops_live_messages_it_includes(self):
+        self.redis.xadd(server.history_key('den'), {'sender': 'bob', 'content': 'old'})
+        raced = self.redis.xadd(server.history_key('den'), {'sender': 'bob', 'content': 'raced'})
+        conn = self.login('alice')
+        xrevrange = self.chat.redis_client.xrevrange
+
+        def read_history(*args, **kwargs):
+            # Live delivery of a message the replay is about to include...
+            self.chat._run(self.chat._local_broadcast(self.room_message(raced, 'raced')))
+            entries = xrevrange(*args, **kwargs)
+            # ...and of one published after the replay read the stream
+            newer = self.redis.xadd(server.history_key('den'), {'sender': 'bob', 'content': 'newer'})
+            self.chat._run(self.chat._local_broadcast(self.room_message(newer, 'newer')))
+            return entries
+
+        with mock.patch.object(self.chat.redis_client, 'xrevrange', read_history):
+            self.assertFalse(self.command(conn, '/join den'))
+        text = conn.outbound.text()
+        self.assertEqual(text.count('raced'), 1)
+        self.assertLess(text.index('old'), text.index('raced'))
+        self.assertLess(text.index('--- End of history ---'), text.index('[den] bob: newer'))
+        self.assertIsNone(conn.held)
+        self.assertEqual(conn.replayed_until, server.stream_id_key(raced))
+
+        # Late live copies of replayed messages are dropped too
+        conn.outbound.sent.clear()
+        self.chat._run(self.chat._local_broadcast(self.room_message(raced, 'raced')))
+        self.assertEqual(conn.outbound.text(), '')
+
+    def test_leave_with_an_expired_session(self):
+        conn = self.login('alice')
+        self.redis.delete('session:alice')
+        self.assertTrue(self.command(conn, '/leave'))
+        self.assertEqual(conn.outbound.text(), server.SESSION_EXPIRED_TEXT)
+
+
+    def test_transitions_on_one_node_are_one_script(self):
+        lobby_node = self.node(server.room_key('lobby'))
+        username = self.name('user', lambda name: f'session:{name}', lobby_node)
+        room = self.name('room', server.room_key, lobby_node)
+        with mock.patch.object(self.chat, 'room_member_script', wraps=self.chat.room_member_script) as room_member:
+            conn = self.login(username)
+            self.command(conn, f'/join {room}')
+            self.assertMembership([username], ['lobby', room])
+            self.command(conn, '/leave')
+            self.command(conn, '/join lobby')
+            self.assertMembership([username], ['lobby', room])
+            self.chat._run(self.chat.remove_session(username, conn))
+        room_member.assert_not_called()
+        self.assertNotIn('ERROR', conn.outbound.text())
+        self.assertMembership([username], ['lobby', room])
+
+
+class ShardedChatServerTest(ChatServerTest):
+    """The same on two nodes, plus moves between rooms on another node than the session"""
+    node_count = 2
+
+    def test_failure_before_the_session_script(self):
+        conn = self.login('alice')
+        room = self.name('room', server.room_key, self.node('session:alice'), same=False)
+        with mock.patch.object(self.chat, 'join_room_script', side_effect=ConnectionError('node down')):
+            self.command(conn, f'/join {room}')
+        self.assertIn('ERROR: node down', conn.outbound.text())
+        self.chat._run(self.chat._reconcile_rooms())
+        self.assertMembership(['alice'], ['lobby', room])
+
+    def test_failure_after_the_session_script(self):
+        session_node = self.node('session:alice')
+        old = self.name('room', server.room_key, session_node, same=False)
+        new = self.name('hall', server.room_key, session_node, same=False)
+        conn = self.login('alice')
+        self.command(conn, f'/join {old}')
+        room_member = self.chat.room_member_script
+
+        def leave_fails(keys, args):
+            if args[1]:
+                raise ConnectionError('node down')
+            return room_member(keys=keys, args=args)
+
+        with mock.patch.object(self.chat, 'room_member_script', side_effect=leave_fails):
+            self.command(conn, f'/join {new}')
+        # The session has moved, and its new room already lists the user
+        self.assertEqual(self.redis.hget('session:alice', 'room'), new)
+        self.assertIn('alice', self.redis.smembers(server.room_key(new)))
+        # Being left in the old room is what the sweep repairs
+        self.chat._run(self.chat._reconcile_rooms())
+        self.assertMembership(['alice'], ['lobby', old, new])
+
+
+if __name__ == '__main__':
+    unittest.main()
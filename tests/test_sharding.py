@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Unit tests for sharding.py: hash ring placement and stability, key parsing.
+
+Usage: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import server  # noqa: E402
+import sharding  # noqa: E402
+
+ENTITIES = [f'user{i}' for i in range(5000)]
+
+
+def owners(names):
+    ring = sharding.HashRing(names)
+    return {entity: names[ring.index_for(entity)] for entity in ENTITIES}
+
+
+class HashRingTest(unittest.TestCase):
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        names = ['redis-1:6379', 'redis-2:6379', 'redis-3:6379']
+        before = owners(names)
+        after = owners(names + ['redis-4:6379'])
+        moved = [entity for entity in ENTITIES if before[entity] != after[entity]]
+        self.assertTrue(all(after[entity] == 'redis-4:6379' for entity in moved))
+        # About 1/4 of the keys should move to the fourth node
+        self.assertGreater(len(moved), len(ENTITIES) * 0.15)
+        self.assertLess(len(moved), len(ENTITIES) * 0.35)
+
+    def test_placement_ignores_node_order(self):
+        names = ['redis-1:6379', 'redis-2:6379', 'redis-3:6379']
+        self.assertEqual(owners(names), owners(list(reversed(names))))
+
+    def test_every_node_gets_a_share(self):
+        names = ['redis-1:6379', 'redis-2:6379', 'redis-3:6379']
+        counts = {name: 0 for name in names}
+        for name in owners(names).values():
+            counts[name] += 1
+        for count in counts.values():
+            self.assertGreater(count, len(ENTITIES) / len(names) * 0.7)
+
+    def test_single_node(self):
+        ring = sharding.HashRing(['localhost:6379'])
+        self.assertEqual({ring.index_for(entity) for entity in ENTITIES}, {0})
+
+
+class KeyTest(unittest.TestCase):
+    def test_key_entity(self):
+        self.assertEqual(sharding.key_entity('session:alice'), 'alice')
+        self.assertEqual(sharding.key_entity(b'subscribers:bob'), 'bob')
+        self.assertEqual(sharding.key_entity('history:lobby'), 'lobby')
+        self.assertEqual(sharding.key_entity('rooms'), 'rooms')
+
+    def test_room_keys_share_a_node(self):
+        room = 'lobby'
+        self.assertEqual(sharding.key_entity(server.room_key(room)),
+                         sharding.key_entity(server.history_key(room)))
+
+    def test_parse_nodes(self):
+        self.assertEqual(sharding.parse_nodes('redis-1:6379, :6380,'),
+                         [('redis-1', 6379), ('localhost', 6380)])
+        with self.assertRaises(ValueError):
+            sharding.parse_nodes(' , ')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Unit tests for wire.py: binary round trips, the JSON fallback, attach_id.
+
+Usage: python -m unittest discover tests
+"""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import wire  # noqa: E402
+
+
+class WireTest(unittest.TestCase):
+    def test_binary_round_trip(self):
+        data = {'type': 'room_message', 'sender': 'alice', 'content': 'héllo, world',
+                'room': 'lobby', 'server_id': 'server_1', 'timestamp': 1700000000123}
+        payload = wire.encode(data, 'binary')
+        self.assertNotEqual(payload[:1], b'{')
+        self.assertEqual(wire.decode(payload), data)
+
+    def test_every_type_and_field(self):
+        for msg_type in wire.TYPE_CODES:
+            data = {name: f'{name}-value' for name in wire.FIELDS}
+            data.update(type=msg_type, timestamp=42)
+            self.assertEqual(wire.decode(wire.encode(data, 'binary')), data)
+
+    def test_missing_timestamp_is_filled_in(self):
+        before = wire.now_ms()
+        decoded = wire.decode(wire.encode({'type': 'system', 'content': 'hi'}, 'binary'))
+        self.assertGreaterEqual(decoded['timestamp'], before)
+        self.assertEqual(decoded['content'], 'hi')
+
+    def test_json_fallback_for_unknown_type(self):
+        data = {'type': 'not_a_wire_type', 'content': 'x'}
+        payload = wire.encode(data, 'binary')
+        self.assertEqual(json.loads(payload), data)
+        self.assertEqual(wire.decode(payload), data)
+
+    def test_json_fallback_for_oversized_field(self):
+        data = {'type': 'room_message', 'content': 'x' * (wire._MAX_FIELD + 1), 'timestamp': 1}
+        payload = wire.encode(data, 'binary')
+        self.assertEqual(payload[:1], b'{')
+        self.assertEqual(wire.decode(payload), data)
+
+    def test_json_format_and_str_payload(self):
+        data = {'type': 'system', 'content': 'hi', 'timestamp': 1}
+        payload = wire.encode(data, 'json')
+        self.assertEqual(payload[:1], b'{')
+        self.assertEqual(wire.decode(payload), data)
+        self.assertEqual(wire.decode(payload.decode()), data)
+
+    def test_attach_id(self):
+        data = {'type': 'room_message', 'sender': 'alice', 'content': 'hi', 'room': 'lobby', 'timestamp': 7}
+        for wire_format in ('binary', 'json'):
+            payload = wire.attach_id(wire.encode(data, wire_format), '1700000000123-0')
+            self.assertEqual(wire.decode(payload), dict(data, id='1700000000123-0'))
+
+    def test_unknown_version_rejected(self):
+        payload = bytearray(wire.encode({'type': 'system', 'timestamp': 1}, 'binary'))
+        payload[0] = wire.WIRE_VERSION + 1
+        with self.assertRaises(ValueError):
+            wire.decode(bytes(payload))
+
+
+if __name__ == '__main__':
+    unittest.main()
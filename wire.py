@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Wire format for messages published between chat servers over Redis Pub/Sub
+
+Binary layout (version 1), network byte order:
+
+    version   u8    WIRE_VERSION
+    type      u8    code from TYPE_CODES
+    fields    u8    bit i set when FIELDS[i] is present
+    timestamp u64   epoch milliseconds
+    then, for each present field in FIELDS order:
+    length    u16   followed by that many UTF-8 bytes
+
+JSON payloads always start with '{', which is never a valid version byte, so
+decode() accepts both formats. Servers can publish JSON (WIRE_FORMAT=json)
+while a rolling upgrade is in progress and switch to binary afterwards.
+"""
+
+import json
+import os
+import struct
+import time
+
+WIRE_FORMAT = os.getenv('WIRE_FORMAT', 'binary').lower()  # binary or json
+WIRE_VERSION = 1
+
+TYPE_CODES = {
+    'room_message': 1,
+    'pubsub_message': 2,
+    'system': 3,
+    'force_logout': 4,
+    'subscribers_changed': 5,
+    'session_ended': 6,
+    'direct_message': 7,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# Optional string fields, in encoding order (at most 8). 'id' is the room
+# history stream id of a room_message, or the session a force_logout ends;
+# it stays last so attach_id() can append it.
+FIELDS = ('sender', 'content', 'room', 'target', 'server_id', 'old_server_id', 'target_server_id', 'id')
+_ID_FLAG = 1 << FIELDS.index('id')
+
+_HEADER = struct.Struct('!BBBQ')
+_LENGTH = struct.Struct('!H')
+_MAX_FIELD = 0xFFFF
+
+
+def now_ms():
+    """Current time as epoch milliseconds, the timestamp carried on the wire"""
+    return int(time.time() * 1000)
+
+
+def encode_binary(data):
+    """Encode a message dict, or return None if it does not fit the binary format"""
+    code = TYPE_CODES.get(data.get('type'))
+    if code is None:
+        return None
+
+    flags = 0
+    parts = []
+    for bit, name in enumerate(FIELDS):
+        value = data.get(name)
+        if value is None:
+            continue
+        raw = value.encode() if isinstance(value, str) else str(value).encode()
+        if len(raw) > _MAX_FIELD:
+            return None
+        flags |= 1 << bit
+        parts.append(_LENGTH.pack(len(raw)))
+        parts.append(raw)
+
+    timestamp = data.get('timestamp')
+    if not isinstance(timestamp, int):
+        timestamp = now_ms()
+    return _HEADER.pack(WIRE_VERSION, code, flags, timestamp) + b''.join(parts)
+
+
+def encode(data, wire_format=None):
+    """Encode a message dict for publishing, falling back to JSON when needed"""
+    if (wire_format or WIRE_FORMAT) == 'binary':
+        payload = encode_binary(data)
+        if payload is not None:
+            return payload
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def attach_id(payload, entry_id):
+    """Add a history stream id to an already encoded message that has none"""
+    if payload[:1] == b'{':
+        return payload[:-1] + b',"id":' + json.dumps(entry_id).encode() + b'}'
+    raw = entry_id.encode()
+    return (payload[:2] + bytes([payload[2] | _ID_FLAG]) + payload[3:]
+            + _LENGTH.pack(len(raw)) + raw)
+
+
+def decode(payload):
+    """Decode a published message in either format"""
+    if isinstance(payload, str):
+        return json.loads(payload)
+    if payload[:1] == b'{':
+        return json.loads(payload)
+
+    version, code, flags, timestamp = _HEADER.unpack_from(payload, 0)
+    if version != WIRE_VERSION:
+        raise ValueError(f"unsupported wire version {version}")
+
+    data = {'type': TYPE_NAMES.get(code), 'timestamp': timestamp}
+    offset = _HEADER.size
+    for bit, name in enumerate(FIELDS):
+        if flags & (1 << bit):
+            (length,) = _LENGTH.unpack_from(payload, offset)
+            offset += _LENGTH.size
+            data[name] = payload[offset:offset + length].decode()
+            offset += length
+    return data